@@ -0,0 +1,174 @@
+import argparse
+import json
+import os
+import random
+import time
+from collections import Counter
+
+from tracing import JsonLinesLog, read_traces
+
+# Trace drop reasons that mean the message was never the agent's business
+# (not a reply to it, its own message, ...). They aren't agent actions and are not logged.
+NOT_ACTIONS = frozenset({
+    'own_message', 'before_start', 'not_a_reply', 'not_reply_to_account', 'no_text', 'no_linked_account',
+    'chat_not_assigned', 'no_chat_group', 'no_original_message', 'claimed_by_other_client', 'cancelled',
+    'unfinished', 'queue_full_chatter', 'queue_full_oldest_chatter',
+})
+
+
+class ActionLog(JsonLinesLog):
+    """
+    Append-only log of what the agents did: replies and autoposts sent (or
+    logged in shadow mode), drops for rate limits, links, bots, dedupe or
+    overload, errors, and FloodWaits, one compact JSON line each. It is fed
+    from finished traces (see Tracer.listeners) and shares their buffered,
+    rotated writer; `python actions.py` aggregates it.
+    """
+
+    def from_trace(self, trace):
+        if trace['outcome'] == 'dropped' and trace.get('drop_reason') in NOT_ACTIONS:
+            return
+        spans = trace.get('spans', [])
+        action = {
+            'ts': trace['ts'],
+            'action': trace['kind'],
+            'outcome': trace['outcome'],
+            'owner_id': trace.get('owner_id'),
+            'telegram_id': trace.get('telegram_id'),
+            'chat_id': trace.get('chat_id'),
+        }
+        if trace.get('drop_reason'):
+            action['reason'] = trace['drop_reason']
+        if trace.get('tier'):
+            action['tier'] = trace['tier']
+        if trace.get('interval_s'):
+            action['interval_s'] = trace['interval_s']
+        if trace['outcome'] in ('sent', 'shadow'):
+            action['latency_ms'] = trace['duration_ms']
+            action['delay_ms'] = sum(span['duration_ms'] for span in spans if span['name'] == 'delay')
+        flood_waits = [span.get('seconds', 0) for span in spans if span['name'] == 'flood_wait']
+        if flood_waits:
+            action['flood_waits'] = len(flood_waits)
+            action['flood_wait_s'] = sum(flood_waits)
+        self.record(action)
+
+
+class _Reservoir:
+    """Fixed-size uniform sample of a stream, for percentiles in one pass."""
+
+    __slots__ = ('size', 'seen', 'values')
+
+    def __init__(self, size=1000):
+        self.size = size
+        self.seen = 0
+        self.values = []
+
+    def add(self, value):
+        self.seen += 1
+        if len(self.values) < self.size:
+            self.values.append(value)
+        else:
+            index = random.randrange(self.seen)
+            if index < self.size:
+                self.values[index] = value
+
+    def percentile(self, pct):
+        if not self.values:
+            return None
+        ordered = sorted(self.values)
+        return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class _Rates:
+    __slots__ = ('outcomes', 'reasons', 'tiers', 'latency', 'busy', 'flood_waits', 'flood_wait_s')
+
+    def __init__(self):
+        self.outcomes = Counter()
+        self.reasons = Counter()
+        self.tiers = Counter()
+        self.latency = _Reservoir()
+        self.busy = _Reservoir()
+        self.flood_waits = 0
+        self.flood_wait_s = 0
+
+    def add(self, action):
+        self.outcomes[f"{action['action']}:{action['outcome']}"] += 1
+        if action.get('reason'):
+            self.reasons[action['reason']] += 1
+        if action.get('tier'):
+            self.tiers[action['tier']] += 1
+        if 'latency_ms' in action:
+            self.latency.add(action['latency_ms'])
+            self.busy.add(round(action['latency_ms'] - action.get('delay_ms', 0), 1))
+        self.flood_waits += action.get('flood_waits', 0)
+        self.flood_wait_s += action.get('flood_wait_s', 0)
+
+    def summary(self, hours):
+        sent = self.outcomes['reply:sent'] + self.outcomes['reply:shadow']
+        autoposts = self.outcomes['autopost:sent'] + self.outcomes['autopost:shadow']
+        return {
+            'replies_per_hour': round(sent / hours, 2),
+            'autoposts_per_hour': round(autoposts / hours, 2),
+            'outcomes': dict(self.outcomes.most_common()),
+            'drop_reasons': dict(self.reasons.most_common()),
+            'tiers': dict(self.tiers),
+            'latency_ms': {'p50': self.latency.percentile(50), 'p95': self.latency.percentile(95)},
+            'busy_ms': {'p50': self.busy.percentile(50), 'p95': self.busy.percentile(95)},
+            'flood_waits': self.flood_waits,
+            'flood_wait_s': self.flood_wait_s,
+        }
+
+
+def aggregate(actions, since=None, top=20):
+    """
+    One streaming pass over the action log: per-group and per-account rates
+    (per hour over the span of the log), outcomes, drop reasons and latency
+    percentiles. Latency is receipt to send; busy_ms leaves out the reply delay.
+    """
+    groups = {}
+    accounts = {}
+    total = _Rates()
+    first = last = None
+    count = 0
+    for action in actions:
+        if since is not None and action['ts'] < since:
+            continue
+        count += 1
+        first = action['ts'] if first is None else min(first, action['ts'])
+        last = action['ts'] if last is None else max(last, action['ts'])
+        total.add(action)
+        if action.get('chat_id') is not None:
+            groups.setdefault(action['chat_id'], _Rates()).add(action)
+        if action.get('owner_id') is not None:
+            accounts.setdefault(f"{action['owner_id']}:{action.get('telegram_id')}", _Rates()).add(action)
+
+    hours = max((last - first) / 3600, 1 / 60) if count else 1.0
+
+    def busiest(rates):
+        ranked = sorted(rates.items(), key=lambda item: sum(item[1].outcomes.values()), reverse=True)
+        return {str(key): value.summary(hours) for key, value in ranked[:top]}
+
+    return {
+        'actions': count,
+        'hours': round(hours, 2),
+        'total': total.summary(hours),
+        'groups': busiest(groups),
+        'accounts': busiest(accounts),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggregate the agent action log into per-group and per-account rates.")
+    parser.add_argument('--file', default=os.environ.get('ACTION_LOG_FILE', 'actions.jsonl'),
+                        help="action log; its rotated backups (.1, .2, ...) are read too")
+    parser.add_argument('--since', type=float, help="only the last N hours")
+    parser.add_argument('--top', type=int, default=20, help="groups and accounts to list, busiest first")
+    args = parser.parse_args()
+
+    paths = JsonLinesLog(args.file, backups=100).files()
+    since = time.time() - args.since * 3600 if args.since else None
+    print(json.dumps(aggregate(read_traces(paths), since, args.top), indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import datetime
+
+# Message IDs remembered per chat for the "already answered" checks; the oldest are forgotten first.
+MAX_TRACKED_IDS = 1000
+
+
+def _remember(ids, message_id):
+    """Add message_id to a set created on first use; returns the set."""
+    if ids is None:
+        ids = set()
+    ids.add(message_id)
+    if len(ids) > MAX_TRACKED_IDS:
+        # Message IDs only grow within a chat, so the smallest are the oldest.
+        for old in sorted(ids)[:len(ids) - MAX_TRACKED_IDS // 2]:
+            ids.discard(old)
+    return ids
+
+
+class ChatState:
+    """
+    Counters for one chat group of a linked account. The containers are
+    created on first use, since most chats never see a reply or an autopost.
+    """
+
+    __slots__ = ('reply_times', 'pending', 'replied', 'autoreplied')
+
+    def __init__(self):
+        self.reply_times = ()     # time.time() of recent replies, for the per-chat reply limit
+        self.pending = 0          # replies waiting out their delay; they count towards the limit
+        self.replied = None       # message IDs already replied to
+        self.autoreplied = None   # message IDs already answered by an autopost
+
+    def recent_replies(self, now, window):
+        """Forget reply times older than `window` seconds and return how many are left."""
+        if self.reply_times:
+            self.reply_times = tuple(ts for ts in self.reply_times if now - ts < window)
+        return len(self.reply_times)
+
+    def reply_slots_used(self, now, window):
+        """Replies sent in the last `window` seconds plus the ones still pending."""
+        return self.recent_replies(now, window) + self.pending
+
+    def reserve_reply(self):
+        self.pending += 1
+
+    def release_reply(self):
+        self.pending -= 1
+
+    def has_replied(self, message_id):
+        return self.replied is not None and message_id in self.replied
+
+    def has_autoreplied(self, message_id):
+        return self.autoreplied is not None and message_id in self.autoreplied
+
+    def replied_to(self, message_id, at):
+        self.reply_times += (at,)
+        self.replied = _remember(self.replied, message_id)
+
+    def autoreplied_to(self, message_id):
+        self.autoreplied = _remember(self.autoreplied, message_id)
+
+
+class AgentState:
+    """
+    Runtime state of one linked account: its Telegram client and identity,
+    the chat groups it serves, per-chat counters, and the tasks and queues
+    working for it. Chat state is only created for chats that have seen
+    traffic.
+    """
+
+    __slots__ = (
+        'client', 'user_id', 'telegram_id', 'me', 'session_string', 'started_at', 'chat_group_ids', 'chats',
+        'sent_index', 'read_cursor', 'events', 'pending_replies', 'autopost', 'task', 'on_demand_at',
+    )
+
+    def __init__(self, client, user_id, session_string):
+        self.client = client
+        self.user_id = int(user_id)
+        self.telegram_id = None
+        self.me = None
+        self.session_string = session_string
+        self.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self.chat_group_ids = ()  # a handful of IDs: a tuple is smaller than a set and as quick to search
+        self.chats = {}  # {chat_id: ChatState}; replaced by the account's entry in the bot's registry once known
+        self.sent_index = None
+        self.read_cursor = None
+        self.events = None
+        self.pending_replies = None  # set of delayed reply tasks, created with the first one
+        self.autopost = None
+        self.task = None  # run_until_disconnected
+        self.on_demand_at = None  # monotonic time it was connected for an owner action while dormant
+
+    @property
+    def key(self):
+        return (self.user_id, self.telegram_id)
+
+    def chat(self, chat_id):
+        state = self.chats.get(chat_id)
+        if state is None:
+            state = self.chats[chat_id] = ChatState()
+        return state
+
+    def set_chat_groups(self, linked_account):
+        """Take the chat group IDs from the account's entry in chat_groups.json (or None)."""
+        groups = linked_account.get('chat_groups', []) if linked_account else []
+        self.chat_group_ids = tuple(int(group['chat_group_id']) for group in groups)
+
+    def add_chat_group(self, chat_group_id):
+        if chat_group_id not in self.chat_group_ids:
+            self.chat_group_ids += (chat_group_id,)
+
+    def add_pending_reply(self, task):
+        if self.pending_replies is None:
+            self.pending_replies = set()
+        self.pending_replies.add(task)
+        task.add_done_callback(self.pending_replies.discard)
+
+    def pending_reply_count(self):
+        return len(self.pending_replies) if self.pending_replies else 0
+
+    def is_running(self):
+        return self.task is not None and not self.task.done()
+
+    def cancel_tasks(self):
+        if self.autopost is not None:
+            self.autopost.cancel()
+        if self.events is not None:
+            self.events.stop()
+        for reply in list(self.pending_replies or ()):
+            reply.cancel()
+        if self.task is not None:
+            self.task.cancel()
@@ -1,26 +1,53 @@
+import csv
+import hashlib
+import io
 import json
-import logging
 import os
 import random
+import signal
 import asyncio
 import time
 import re  # For regex operations to remove emojis and hashtags
 import datetime  # For handling dates and times
 from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import Counter
 
 from telethon import TelegramClient, events, Button, errors
 from telethon.sessions import StringSession
+from telethon.tl import types
 from dotenv import load_dotenv
 from cryptography.fernet import Fernet
 
-# If your custom LLM is accessible via HTTP, for example, you can import requests:
-# import requests
+from storage import JsonStore, store_executor
+from session_store import SessionDatabase, EncryptedSession, session_key
+from sent_index import SentMessageIndex
+from catchup import CatchUp, MissedMessage, ReadCursors
+from agent_state import AgentState
+from llm import LLMDispatcher, HTTPBackend, PlaceholderBackend, EndpointPool, Endpoint, CircuitBreaker
+from prompts import PromptBuilder, group_prompt_key
+from scheduler import LLMScheduler, Overloaded, INTERACTIVE, REPLY, AUTOPOST, DRAFT
+from tracing import Tracer, read_traces, summarize
+from actions import ActionLog
+from coordinator import ChatCoordinator
+from shadow import ShadowStats
+from jobs import JobQueue, TooManyJobs
+from event_queue import EventQueue, DROP_POLICIES
+from memory import MemoryMonitor
+from supervisor import ClientSupervisor
+from logs import configure_logging, get_logger, parse_module_levels, stop_logging
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Set up logging to include more details
-logging.basicConfig(level=logging.INFO)
+# Logging is formatted and written on a background thread. LOG_LEVELS sets per-module levels,
+# e.g. "telethon=WARNING,bot=DEBUG"; LOG_FILE adds a rotating log file; LOG_JSON=1 writes JSON lines.
+configure_logging(
+    level=os.environ.get('LOG_LEVEL', 'INFO'),
+    module_levels=parse_module_levels(os.environ.get('LOG_LEVELS')),
+    log_file=os.environ.get('LOG_FILE') or None,
+    json_lines=os.environ.get('LOG_JSON', '').lower() in ('1', 'true', 'yes'),
+)
+log = get_logger('bot')
 
 # Your provided API ID and Hash from the .env file
 api_id = int(os.environ.get('API_ID'))
@@ -42,6 +69,81 @@ fernet = Fernet(encryption_key)
 
 bot = TelegramClient('bot_session', api_id, api_hash)
 
+# Telegram user IDs allowed to use admin commands, comma-separated
+ADMIN_IDS = {int(x) for x in os.environ.get('ADMIN_IDS', '').split(',') if x.strip()}
+
+# LLM backends: set LLM_ENDPOINTS (or LLM_ENDPOINT) to your VPS or locally hosted model servers,
+# comma-separated; without them a placeholder is used
+LLM_ENDPOINTS = [u.strip() for u in (os.environ.get('LLM_ENDPOINTS') or os.environ.get('LLM_ENDPOINT') or '').split(',') if u.strip()]
+LLM_TIMEOUT = float(os.environ.get('LLM_TIMEOUT', '60'))
+LLM_BATCH_WINDOW_MS = float(os.environ.get('LLM_BATCH_WINDOW_MS', '50'))
+LLM_MAX_BATCH = int(os.environ.get('LLM_MAX_BATCH', '16'))
+LLM_HEDGE_PERCENTILE = float(os.environ.get('LLM_HEDGE_PERCENTILE', '95'))
+LLM_HEDGE_MIN_MS = float(os.environ.get('LLM_HEDGE_MIN_MS', '500'))
+LLM_BREAKER_FAILURES = int(os.environ.get('LLM_BREAKER_FAILURES', '3'))
+LLM_BREAKER_RESET = float(os.environ.get('LLM_BREAKER_RESET', '30'))
+# Maximum number of session strings validated at once by /bulk_import
+BULK_IMPORT_CONCURRENCY = int(os.environ.get('BULK_IMPORT_CONCURRENCY', '8'))
+
+LLM_PROMPT_CACHE = os.environ.get('LLM_PROMPT_CACHE', '').lower() in ('1', 'true', 'yes')
+LLM_CACHE_SLOTS = int(os.environ.get('LLM_CACHE_SLOTS', '0'))
+# Admission control: generations running at once, requests allowed to wait, and how long an autopost may wait
+LLM_MAX_IN_FLIGHT = int(os.environ.get('LLM_MAX_IN_FLIGHT', '32'))
+LLM_MAX_QUEUE = int(os.environ.get('LLM_MAX_QUEUE', '256'))
+LLM_AUTOPOST_MAX_WAIT = float(os.environ.get('LLM_AUTOPOST_MAX_WAIT', '120'))
+# Replies are drafted during the reply delay on spare capacity; this many slots are kept free for work due now
+LLM_DRAFT_HEADROOM = int(os.environ.get('LLM_DRAFT_HEADROOM', '4'))
+
+if LLM_ENDPOINTS:
+    llm_backend = EndpointPool(
+        [Endpoint(url, HTTPBackend(url, timeout=LLM_TIMEOUT, prompt_cache=LLM_PROMPT_CACHE),
+                  CircuitBreaker(failure_threshold=LLM_BREAKER_FAILURES, reset_timeout=LLM_BREAKER_RESET))
+         for url in LLM_ENDPOINTS],
+        timeout=LLM_TIMEOUT,
+        hedge_percentile=LLM_HEDGE_PERCENTILE,
+        hedge_min_delay=LLM_HEDGE_MIN_MS / 1000,
+    )
+else:
+    llm_backend = PlaceholderBackend()
+llm_dispatcher = LLMDispatcher(llm_backend, batch_window=LLM_BATCH_WINDOW_MS / 1000, max_batch_size=LLM_MAX_BATCH)
+prompt_builder = PromptBuilder(cache_slots=LLM_CACHE_SLOTS)
+llm_scheduler = LLMScheduler(
+    max_in_flight=LLM_MAX_IN_FLIGHT, max_queue=LLM_MAX_QUEUE, max_autopost_wait=LLM_AUTOPOST_MAX_WAIT,
+    draft_headroom=LLM_DRAFT_HEADROOM,
+)
+
+# Personality Helper generations run as background jobs: per-user limit, total running at once
+PERSONALITY_JOBS_PER_USER = int(os.environ.get('PERSONALITY_JOBS_PER_USER', '2'))
+PERSONALITY_JOBS_RUNNING = int(os.environ.get('PERSONALITY_JOBS_RUNNING', '4'))
+personality_jobs = JobQueue(max_per_owner=PERSONALITY_JOBS_PER_USER, max_running=PERSONALITY_JOBS_RUNNING)
+
+# Instructions used when Personality Helper asks a configured LLM endpoint for a description
+PERSONALITY_HELPER_INSTRUCTIONS = (
+    "Read the writing samples and describe the author's personality, tone and style "
+    "in a few sentences, written as instructions to someone imitating them."
+)
+
+# Encrypted session state (auth keys, entity cache, update state, cached profile) for linked accounts
+session_db = SessionDatabase(os.environ.get('SESSION_DB_PATH', 'sessions.db'), fernet)
+
+# Shares per-message work between linked clients that sit in the same group
+chat_coordinator = ChatCoordinator()
+
+# Per-message traces (stages, durations, drop reasons) as JSON lines; set TRACE_FILE empty to disable
+tracer = Tracer(
+    os.environ.get('TRACE_FILE', 'traces.jsonl'),
+    max_bytes=int(float(os.environ.get('TRACE_MAX_MB', '10')) * 1024 * 1024),
+    backups=int(os.environ.get('TRACE_BACKUPS', '3')),
+)
+# What the agents did (sends, drops, FloodWaits), one line per action from finished traces; see actions.py
+action_log = ActionLog(
+    os.environ.get('ACTION_LOG_FILE', 'actions.jsonl'),
+    max_bytes=int(float(os.environ.get('ACTION_LOG_MAX_MB', '50')) * 1024 * 1024),
+    backups=int(os.environ.get('ACTION_LOG_BACKUPS', '5')),
+    flush_interval=5.0,
+)
+tracer.listeners.append(action_log.from_trace)
+
 
 def encrypt_field(field_value):
     """Encrypt a sensitive field value using Fernet."""
@@ -63,82 +165,153 @@ def decrypt_field(field_value):
         return field_value
 
 
+def _encrypt_user_record(user_id, user_info):
+    """Encrypt sensitive fields of one owner's record before it is written to disk."""
+    for acc in user_info.get('linked_accounts', []):
+        if 'session_string' in acc and acc['session_string']:
+            acc['session_string'] = encrypt_field(acc['session_string'])
+        if 'phone' in acc and acc['phone']:
+            acc['phone'] = encrypt_field(acc['phone'])
+    return user_info
+
+
+def _decrypt_user_record(user_id, user_info):
+    """Decrypt sensitive fields of one owner's record read from disk."""
+    for acc in user_info.get('linked_accounts', []):
+        if 'session_string' in acc and acc['session_string']:
+            acc['session_string'] = decrypt_field(acc['session_string'])
+        if 'phone' in acc and acc['phone']:
+            acc['phone'] = decrypt_field(acc['phone'])
+    return user_info
+
+
+STORE_FLUSH_DELAY = float(os.environ.get('STORE_FLUSH_DELAY', '2'))
+
+user_store = JsonStore("user_data.json", encode_record=_encrypt_user_record,
+                       decode_record=_decrypt_user_record, flush_delay=STORE_FLUSH_DELAY)
+chat_groups_store = JsonStore("chat_groups.json", flush_delay=STORE_FLUSH_DELAY)
+# Recently sent message IDs per linked account and chat, used to detect replies without fetching
+sent_messages_store = JsonStore("sent_messages.json", flush_delay=STORE_FLUSH_DELAY, indent=None)
+# Last processed message ID per linked account and chat, where catch-up starts after a restart
+read_cursors_store = JsonStore("read_cursors.json", flush_delay=STORE_FLUSH_DELAY, indent=None)
+# Telegram media references of files the bot already uploaded, keyed by path
+media_cache_store = JsonStore("media_cache.json", flush_delay=STORE_FLUSH_DELAY)
+
+
 def load_user_data():
-    """Load user data from the JSON file and decrypt sensitive fields."""
-    if os.path.exists("user_data.json"):
-        with open("user_data.json", "r") as f:
-            data = json.load(f)
-            # Decrypt sensitive fields
-            for user_id, user_info in data.items():
-                linked_accounts = user_info.get('linked_accounts', [])
-                for acc in linked_accounts:
-                    if 'session_string' in acc and acc['session_string']:
-                        acc['session_string'] = decrypt_field(acc['session_string'])
-                    if 'phone' in acc and acc['phone']:
-                        acc['phone'] = decrypt_field(acc['phone'])
-            logging.debug(f"Loaded and decrypted user data: {data}")
-            return data
-    return {}
+    """Return a copy of the decrypted user data."""
+    return user_store.load()
 
 
 def save_user_data(data):
-    """Encrypt sensitive fields and save user data to the JSON file."""
-    data_copy = json.loads(json.dumps(data))
-    for user_id, user_info in data_copy.items():
-        linked_accounts = user_info.get('linked_accounts', [])
-        for acc in linked_accounts:
-            if 'session_string' in acc and acc['session_string']:
-                acc['session_string'] = encrypt_field(acc['session_string'])
-            if 'phone' in acc and acc['phone']:
-                acc['phone'] = encrypt_field(acc['phone'])
-
-    with open("user_data.json", "w") as f:
-        json.dump(data_copy, f, indent=4)
+    """Apply user data changes; they are journaled now and snapshotted (encrypted) shortly after."""
+    user_store.save(data)
 
 
 def load_chat_groups():
-    """Load chat group data from JSON file."""
-    if os.path.exists("chat_groups.json"):
-        with open("chat_groups.json", "r") as f:
-            data = json.load(f)
-            logging.debug(f"Loaded chat group data: {data}")
-            return data
-    return {}
+    """Return a copy of the chat group data."""
+    return chat_groups_store.load()
 
 
 def save_chat_groups(chat_groups_data):
-    """Save chat group data to JSON file."""
-    with open("chat_groups.json", "w") as f:
-        json.dump(chat_groups_data, f, indent=4)
+    """Apply chat group changes; they are journaled now and snapshotted shortly after."""
+    chat_groups_store.save(chat_groups_data)
+
+
+async def read_user_data():
+    """Return a shared, read-only snapshot of the user data, built off the event loop. Do not modify it."""
+    return await user_store.aread()
+
+
+async def read_chat_groups():
+    """Return a shared, read-only snapshot of the chat group data, built off the event loop. Do not modify it."""
+    return await chat_groups_store.aread()
+
+
+def flush_stores():
+    """Write any pending snapshots and log write amplification."""
+    read_cursors.flush()
+    for store in (user_store, chat_groups_store, sent_messages_store, read_cursors_store, media_cache_store):
+        store.flush()
+        log.info("Persistence stats", path=store.path, **store.report())
 
 
 user_data = load_user_data()
 chat_groups = load_chat_groups()
 user_state = {}
 last_bot_message_id = {}
-linked_user_clients = {}  # {(user_id, telegram_id): client}
+agents = {}  # {(user_id, telegram_id): AgentState} for every running linked account
+# {(user_id, telegram_id): {chat_id: ChatState}} reply limits and dedupe history. Kept when a client is
+# stopped, so pause/resume, relinking or a restarted client can't reset them.
+chat_states = {}
+# Held while linked clients are started or stopped, so two callers can't both start a client for one account
+clients_lock = asyncio.Lock()
+dormant_accounts = {}  # {(user_id, telegram_id): 'paused' | 'no_chat_groups'} linked accounts left disconnected
 temp_user_data = {}
-message_tracker = {}  # {(user_id, telegram_id): {chat_id: [timestamps]}}
-reply_tracker = {}    # {(user_id, telegram_id): {chat_id: set(reply_to_msg_ids)}}
-autoreply_tracker = {}  # {(user_id, telegram_id): {chat_id: set(message_ids)}}
-client_tasks = {}  # {(user_id, telegram_id): task}
+
+# Linked accounts that are paused by their owner or have no chat groups stay disconnected (DORMANT_ACCOUNTS=0 connects
+# every account). One connected on demand for an owner action is kept for DORMANT_GRACE seconds before going dormant.
+DORMANT_ACCOUNTS = os.environ.get('DORMANT_ACCOUNTS', '1').lower() in ('1', 'true', 'yes')
+DORMANT_GRACE = float(os.environ.get('DORMANT_GRACE', '600'))
+
+# Shadow mode runs the whole reply and autopost pipeline, LLM included, but logs messages instead of sending them.
+# SHADOW_MODE applies to every group; a chat group with "shadow": true (see /shadow) is shadowed on its own.
+SHADOW_MODE = os.environ.get('SHADOW_MODE', '').lower() in ('1', 'true', 'yes')
+shadow_stats = ShadowStats()
+
+# Incoming messages per linked client wait in a bounded queue drained by a few workers.
+# EVENT_DROP_POLICY: 'keep_replies' (drop the oldest event that isn't a reply to the account) or 'oldest'.
+EVENT_WORKERS = int(os.environ.get('EVENT_WORKERS', '2'))
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', '100'))
+EVENT_DROP_POLICY = os.environ.get('EVENT_DROP_POLICY', 'keep_replies')
+if EVENT_DROP_POLICY not in DROP_POLICIES:
+    raise ValueError(f"EVENT_DROP_POLICY must be one of {', '.join(DROP_POLICIES)}")
+
+
+async def catch_up_budget(agent, chat_id):
+    """How many more replies the chat's reply limit allows right now; catch-up keeps only that many."""
+    message_limit = 4 if await check_membership(agent.user_id) else 1
+    return max(0, message_limit - agent.chat(chat_id).reply_slots_used(time.time(), REPLY_LIMIT_WINDOW))
+
+
+# Replies that arrived while a client was offline are fetched after it (re)connects and fed to its queue at
+# CATCHUP_RATE per second: at most CATCHUP_MAX_MESSAGES per chat (0 disables catch-up), none older than
+# CATCHUP_MAX_AGE hours, with at most CATCHUP_CONCURRENCY clients fetching at once.
+catch_up = CatchUp(
+    reply_budget=catch_up_budget,
+    max_messages=int(os.environ.get('CATCHUP_MAX_MESSAGES', '200')),
+    max_age=float(os.environ.get('CATCHUP_MAX_AGE', '6')) * 3600,
+    rate=float(os.environ.get('CATCHUP_RATE', '1')),
+    max_concurrent=int(os.environ.get('CATCHUP_CONCURRENCY', '4')),
+)
+# Where each client's chats were read up to, saved for all clients together every CATCHUP_CURSOR_INTERVAL seconds
+read_cursors = ReadCursors(read_cursors_store, interval=float(os.environ.get('CATCHUP_CURSOR_INTERVAL', '10')))
+
+# Health checks and jittered reconnects for linked clients
+client_supervisor = ClientSupervisor(
+    agents,
+    on_reconnect=catch_up.reconnected,
+    ping_interval=float(os.environ.get('CLIENT_PING_INTERVAL', '120')),
+    max_backoff=float(os.environ.get('CLIENT_RECONNECT_MAX_BACKOFF', '300')),
+    max_concurrent_reconnects=int(os.environ.get('CLIENT_RECONNECT_CONCURRENCY', '4')),
+)
 
 
 async def check_membership(user_id):
     """Check if the user is a member of the specified group."""
     try:
         participants = await bot.get_participants(GROUP_ID)
-        logging.debug(f"Participants fetched for group: {participants}")
+        log.debug("Participants fetched for group", count=len(participants))
         return any(p.id == user_id for p in participants)
     except Exception as e:
-        logging.error(f"Error checking membership: {e}")
+        log.error("Error checking membership", error=e)
         return False
 
 
 @bot.on(events.NewMessage(pattern='/start'))
 async def start(event):
     user_id = event.sender_id
-    logging.debug(f"Received /start from user {user_id}")
+    log.debug("Received /start", user_id=user_id)
     is_member = await check_membership(user_id)
     if is_member:
         buttons = [
@@ -159,17 +332,249 @@ async def start(event):
         buttons=buttons
     )
     last_bot_message_id[user_id] = msg.id
-    logging.debug(f"Displayed start menu to user {user_id}")
+    log.debug("Displayed start menu", user_id=user_id)
+
+
+def is_admin(user_id):
+    return user_id in ADMIN_IDS
+
+
+@bot.on(events.NewMessage(pattern='/llmstats'))
+async def llm_stats_command(event):
+    """Admin: show LLM queue waits and shedding, batching, endpoint breaker state, latency and hedge rates."""
+    if not is_admin(event.sender_id):
+        return
+    report = {
+        'scheduler': llm_scheduler.report(),
+        'dispatcher': llm_dispatcher.report(),
+        'prompts': prompt_builder.report(),
+        'personality_jobs': personality_jobs.report(),
+    }
+    if isinstance(llm_backend, EndpointPool):
+        report['endpoints'] = llm_backend.report()
+    await event.respond(f"LLM stats:\n{json.dumps(report, indent=2)}")
+
+
+@bot.on(events.NewMessage(pattern=r'/traces(?:\s+(\d+))?$'))
+async def traces_command(event):
+    """Admin: summarize recent traces. Optional argument: slow threshold in seconds (default 30)."""
+    if not is_admin(event.sender_id):
+        return
+    if not tracer.path:
+        await event.respond("Tracing is disabled (TRACE_FILE is empty).")
+        return
+    slow_seconds = int(event.pattern_match.group(1) or 30)
+    tracer.flush()
+    summary = await asyncio.to_thread(lambda: summarize(read_traces(tracer.files()), slow_seconds * 1000))
+    await event.respond(f"Traces (slow = over {slow_seconds}s, not counting the reply delay):\n"
+                        f"{json.dumps(summary, indent=2)[:3900]}")
+
+
+@bot.on(events.NewMessage(pattern=r'/shadow(?:\s+(-?\d+)\s+(on|off))?$'))
+async def shadow_command(event):
+    """Admin: show what shadow mode would have sent, or turn it on or off for one chat group."""
+    if not is_admin(event.sender_id):
+        return
+    if event.pattern_match.group(1):
+        chat_id = int(event.pattern_match.group(1))
+        enabled = event.pattern_match.group(2) == 'on'
+        changed = 0
+        async with chat_groups_store.transaction() as chat_groups_data:
+            for owner in chat_groups_data.values():
+                for account in owner.get('linked_accounts', []):
+                    for chat_group in account.get('chat_groups', []):
+                        if int(chat_group['chat_group_id']) == chat_id:
+                            chat_group['shadow'] = enabled
+                            changed += 1
+        await event.respond(f"Shadow mode {'on' if enabled else 'off'} for chat {chat_id} ({changed} linked accounts).")
+        return
+    report = dict(shadow_stats.report(), deployment_wide=SHADOW_MODE)
+    await event.respond(f"Shadow mode:\n{json.dumps(report, indent=2)}")
+
+
+def is_shadow(chat_group):
+    return SHADOW_MODE or bool(chat_group.get('shadow'))
+
+
+@bot.on(events.NewMessage(pattern='/clients'))
+async def clients_command(event):
+    """Admin: show connection state, uptime, reconnect counts and event queues of linked clients, and shared message work."""
+    if not is_admin(event.sender_id):
+        return
+    report = client_supervisor.report()
+    dormant = Counter(dormant_accounts.values())
+    summary = (f"{len(agents)} connected, {len(dormant_accounts)} dormant "
+               f"({dormant['paused']} paused, {dormant['no_chat_groups']} without chat groups)")
+    if not report:
+        await event.respond(f"No linked clients are running. Accounts: {summary}.")
+        return
+    lines = [
+        f"{key}: {info['state']}, up {info['uptime_s']}s, {info['reconnects']} reconnects, "
+        f"{info['failed_attempts']} failed attempts, ping {info['last_ping_ms']} ms" + event_queue_summary(key)
+        for key, info in sorted(report.items())
+    ]
+    shared = chat_coordinator.report()
+    lines.append(
+        f"Shared message work: {shared['messages']} messages, {shared['shared']} results reused, "
+        f"{shared['claims_denied']} duplicate replies avoided"
+    )
+    caught_up = catch_up.report()
+    cursors = read_cursors.report()
+    lines.append(
+        f"Catch-up: {caught_up.get('passes', 0)} passes, {caught_up.get('fetched', 0)} messages fetched, "
+        f"{caught_up.get('queued', 0)} missed replies queued, {caught_up.get('over_limit', 0)} over the reply limit, "
+        f"{caught_up['running']} running; {cursors.get('cursors_written', 0)} read cursors saved in "
+        f"{cursors.get('writes', 0)} writes"
+    )
+    lines.append(f"Accounts: {summary}")
+    await event.respond("Linked clients:\n" + "\n".join(lines))
+
+
+def event_queue_summary(client_key):
+    agent = agents.get(client_key)
+    if agent is None or agent.events is None:
+        return ""
+    queue = agent.events.report()
+    return (f", queue {queue['depth']}/{agent.events.maxsize} (max {queue['max_depth']}), "
+            f"{queue['dropped']} dropped ({queue['dropped_priority']} replies), {agent.pending_reply_count()} pending replies")
+
+
+async def validate_session_string(owner_id, session_string, semaphore):
+    """Check that a session string is authorized and isn't the owner's own account. Returns (me, error)."""
+    async with semaphore:
+        client = TelegramClient(StringSession(session_string), api_id, api_hash)
+        try:
+            await client.connect()
+            if not await client.is_user_authorized():
+                return None, "Invalid or unauthorized session string."
+            me = await client.get_me()
+            if me.id == owner_id:
+                return None, "Session string belongs to the owner's own account."
+            return me, None
+        except Exception as e:
+            return None, str(e)
+        finally:
+            try:
+                await client.disconnect()
+            except Exception:
+                pass
+
+
+def parse_bulk_import(text):
+    """Parse `owner_user_id,session_string` lines; blank lines and lines starting with # are skipped."""
+    rows = []
+    for line_no, line in enumerate(text.splitlines(), 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        owner, _, session_string = line.partition(',')
+        row = {'line': line_no, 'owner': owner.strip(), 'session_string': session_string.strip(),
+               'status': 'pending', 'telegram_id': '', 'detail': ''}
+        if not row['owner'].isdigit() or not row['session_string']:
+            row['status'] = 'failed'
+            row['detail'] = "Expected owner_user_id,session_string"
+        rows.append(row)
+    return rows
+
+
+@bot.on(events.NewMessage(pattern='/bulk_import'))
+async def bulk_import_command(event):
+    """
+    Admin: link many accounts at once. Send a text/CSV file captioned /bulk_import with one
+    `owner_user_id,session_string` per line. Sessions are validated concurrently, all links are
+    saved in one write and only the newly added clients are started. Per-owner account limits
+    don't apply to admin imports.
+    """
+    if not is_admin(event.sender_id):
+        return
+    if not event.message.file:
+        await event.respond("Send a text file of `owner_user_id,session_string` lines with the caption /bulk_import.")
+        return
+
+    raw = await event.message.download_media(file=bytes)
+    rows = parse_bulk_import(raw.decode('utf-8-sig', errors='replace'))
+    pending = [row for row in rows if row['status'] == 'pending']
+    await event.respond(f"Validating {len(pending)} session strings...")
+
+    semaphore = asyncio.Semaphore(BULK_IMPORT_CONCURRENCY)
+    results = await asyncio.gather(*(
+        validate_session_string(int(row['owner']), row['session_string'], semaphore) for row in pending
+    ))
+
+    imported = []
+    seen_telegram_ids = set()
+    async with user_store.transaction() as current_user_data:
+        for row, (me, error) in zip(pending, results):
+            if error:
+                row['status'] = 'failed'
+                row['detail'] = error
+                continue
+            row['telegram_id'] = me.id
+            if me.id in seen_telegram_ids:
+                row['status'] = 'failed'
+                row['detail'] = "Duplicate account in file."
+                continue
+            seen_telegram_ids.add(me.id)
+
+            account = linked_account_record(me, row['session_string'])
+            owner_accounts = current_user_data.setdefault(row['owner'], {'linked_accounts': []})['linked_accounts']
+            existing = next((i for i, acc in enumerate(owner_accounts) if int(acc['telegram_id']) == me.id), None)
+            if existing is None:
+                owner_accounts.append(account)
+                row['status'] = 'linked'
+            else:
+                owner_accounts[existing] = account
+                row['status'] = 'updated'
+            imported.append((row, account))
+
+    active_keys = accounts_with_chat_groups(await read_chat_groups())
+
+    async def start_imported(row, account):
+        client_key = (int(row['owner']), int(account['telegram_id']))
+        if is_client_running(client_key, account['session_string']):
+            return
+        await stop_linked_client(client_key)
+        reason = dormant_reason(client_key, account, active_keys)
+        if reason is not None:
+            # New accounts have no chat groups yet; they connect once they get one.
+            dormant_accounts[client_key] = reason
+            if reason == 'no_chat_groups':
+                row['detail'] = "Saved; stays disconnected until it has a chat group."
+            else:
+                row['detail'] = "Saved; the account is paused."
+            return
+        try:
+            if await start_linked_client(row['owner'], account) is None:
+                row['detail'] = "Saved, but the client could not be started."
+        except Exception as e:
+            row['detail'] = f"Saved, but the client could not be started: {e}"
+
+    async with clients_lock:
+        for row, account in imported:
+            await start_imported(row, account)
+
+    report = io.StringIO()
+    writer = csv.DictWriter(report, fieldnames=['line', 'owner', 'status', 'telegram_id', 'detail'], extrasaction='ignore')
+    writer.writeheader()
+    writer.writerows(rows)
+    report_file = io.BytesIO(report.getvalue().encode('utf-8'))
+    report_file.name = "bulk_import_report.csv"
+
+    counts = {}
+    for row in rows:
+        counts[row['status']] = counts.get(row['status'], 0) + 1
+    summary = ", ".join(f"{status}: {count}" for status, count in sorted(counts.items())) or "no rows"
+    await event.respond(f"Bulk import finished ({summary}).", file=report_file)
 
 
 @bot.on(events.CallbackQuery)
 async def start_menu_handler(event):
     user_id = event.sender_id
     data = event.data.decode("utf-8")
-    logging.debug(f"Handling callback from user {user_id} with action {data}")
+    log.debug("Handling callback", user_id=user_id, action=data)
 
     if data == "start_create_npc":
-        current_user_data = load_user_data()
+        current_user_data = await read_user_data()
         linked_accounts = current_user_data.get(str(user_id), {}).get('linked_accounts', [])
         is_member = await check_membership(user_id)
         max_accounts = 2 if is_member else 1
@@ -189,23 +594,165 @@ async def start_menu_handler(event):
         await callback_query_handler(event)
 
 
+INSTRUCTIONAL_VIDEO_PATH = "NPC_BOT_Instructions.mp4"
+INSTRUCTIONAL_VIDEO_CAPTION = "NPC Bot Instructional Video"
+
+media_uploads = {}  # {path: task} uploads in flight, shared by concurrent requests
+media_fingerprints = {}  # {path: ((size, mtime_ns), sha256)} so the file is only rehashed when it changes
+
+# Sizes of the long-lived structures, live clients and tasks for /memory and SIGUSR1
+memory_monitor = MemoryMonitor(client_type=TelegramClient)
+for _name, _structure in (
+    ('user_state', user_state),
+    ('last_bot_message_id', last_bot_message_id),
+    ('temp_user_data', temp_user_data),
+    ('media_uploads', media_uploads),
+    ('media_fingerprints', media_fingerprints),
+):
+    memory_monitor.track(_name, _structure)
+memory_monitor.track('user_data', lambda: user_data)
+memory_monitor.track('chat_groups', lambda: chat_groups)
+memory_monitor.track('chat_states', chat_states)
+# Agents are registered before their sent index and queue exist, so half-started ones are skipped.
+memory_monitor.track('sent_index', lambda: {
+    key: agent.sent_index.snapshot() for key, agent in agents.items() if agent.sent_index is not None
+})
+memory_monitor.track('chat_coordinator', chat_coordinator.snapshot)
+memory_monitor.track('event_queues', lambda: {
+    key: agent.events.snapshot() for key, agent in agents.items() if agent.events is not None
+})
+
+
+def memory_report():
+    return memory_monitor.report(agents)
+
+
+@bot.on(events.NewMessage(pattern=r'/memory(?:\s+(snapshot|diff|baseline|stop))?$'))
+async def memory_command(event):
+    """
+    Admin: /memory shows structure sizes, live clients and tasks by kind.
+    /memory snapshot takes a tracemalloc snapshot (starting tracemalloc), /memory diff compares
+    the last two snapshots, /memory baseline compares the latest with the first, /memory stop ends tracing.
+    """
+    if not is_admin(event.sender_id):
+        return
+    action = event.pattern_match.group(1)
+    if action == 'snapshot':
+        count = memory_monitor.snapshot()
+        await event.respond(f"Snapshot {count} taken. Take another later and send /memory diff.")
+        return
+    if action in ('diff', 'baseline'):
+        diff = memory_monitor.diff(from_baseline=action == 'baseline')
+        if diff is None:
+            await event.respond("Need two snapshots first: send /memory snapshot now and again later.")
+            return
+        await event.respond(f"Memory growth:\n{json.dumps(diff, indent=2)[:3900]}")
+        return
+    if action == 'stop':
+        memory_monitor.stop()
+        await event.respond("tracemalloc stopped and snapshots discarded.")
+        return
+    await event.respond(f"Memory:\n{json.dumps(memory_report(), indent=2)[:3900]}")
+
+
+def log_memory_report():
+    """SIGUSR1: log the memory report, take a snapshot and log the growth since the previous one."""
+    log.info("Memory report", **memory_report())
+    memory_monitor.snapshot()
+    diff = memory_monitor.diff()
+    if diff:
+        log.info("Memory growth since last snapshot", **diff)
+
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def media_fingerprint(path):
+    """Return (sha256, mtime_ns) for a file, hashing it off the event loop only when size or mtime changed."""
+    st = os.stat(path)
+    stat_key = (st.st_size, st.st_mtime_ns)
+    cached = media_fingerprints.get(path)
+    if cached and cached[0] == stat_key:
+        return cached[1], st.st_mtime_ns
+    sha = await asyncio.to_thread(_sha256_file, path)
+    media_fingerprints[path] = (stat_key, sha)
+    return sha, st.st_mtime_ns
+
+
+def cached_media(path, sha, mtime_ns):
+    """Return the stored InputDocument for this exact file version, if any."""
+    record = media_cache_store.get(path)
+    if not record or record.get('sha256') != sha or record.get('mtime_ns') != mtime_ns:
+        return None
+    return types.InputDocument(
+        id=record['id'],
+        access_hash=record['access_hash'],
+        file_reference=urlsafe_b64decode(record['file_reference']),
+    )
+
+
+async def upload_media(user_id, path, sha, mtime_ns, caption):
+    """Upload the file by sending it to user_id and remember the resulting media reference."""
+    message = await bot.send_file(user_id, path, caption=caption, supports_streaming=True)
+    document = message.media.document
+    await media_cache_store.aput(path, {
+        'sha256': sha,
+        'mtime_ns': mtime_ns,
+        'id': document.id,
+        'access_hash': document.access_hash,
+        'file_reference': urlsafe_b64encode(document.file_reference).decode('ascii'),
+    })
+    log.info("Uploaded media and cached its reference", path=path)
+    return message
+
+
 async def send_instructional_video(event):
     try:
         user_id = event.sender_id
-        video_file_path = "NPC_BOT_Instructions.mp4"
-        if os.path.exists(video_file_path):
+        video_file_path = INSTRUCTIONAL_VIDEO_PATH
+        if not os.path.exists(video_file_path):
+            await event.respond("Instructional video not found.")
+            return
+
+        sha, mtime_ns = await media_fingerprint(video_file_path)
+        media = cached_media(video_file_path, sha, mtime_ns)
+        if media:
+            try:
+                await bot.send_file(user_id, media, caption=INSTRUCTIONAL_VIDEO_CAPTION)
+                return
+            except (errors.FileReferenceExpiredError, errors.FileReferenceInvalidError,
+                    errors.MediaEmptyError, errors.FileIdInvalidError) as e:
+                log.info("Cached media is no longer valid; uploading again", path=video_file_path, error=e)
+                await media_cache_store.adelete(video_file_path)
+
+        upload = media_uploads.get(video_file_path)
+        if upload is None:
+            # Registered before any await, so a request arriving meanwhile joins this upload.
+            upload = asyncio.create_task(
+                upload_media(user_id, video_file_path, sha, mtime_ns, INSTRUCTIONAL_VIDEO_CAPTION)
+            )
+            media_uploads[video_file_path] = upload
+            upload.add_done_callback(lambda _: media_uploads.pop(video_file_path, None))
             await event.respond("Uploading the instructional video. This could take 1-3 minutes. Please wait...")
-            await bot.send_file(user_id, video_file_path, caption="NPC Bot Instructional Video")
+            await upload
         else:
-            await event.respond("Instructional video not found.")
+            # Someone else's upload is already running; wait for it and send the same media.
+            await event.respond("The instructional video is being uploaded. Please wait...")
+            message = await upload
+            await bot.send_file(user_id, message.media, caption=INSTRUCTIONAL_VIDEO_CAPTION)
     except Exception as e:
-        logging.error(f"Error sending instructional video: {e}")
+        log.error("Error sending instructional video", error=e)
         await event.respond("Failed to send the instructional video.")
 
 
 async def createnpc(event):
     user_id = event.sender_id
-    logging.debug(f"Received createnpc from user {user_id}")
+    log.debug("Received createnpc", user_id=user_id)
     buttons = [
         [Button.inline("Link with phone #", b"link_phone")],
         [Button.inline("Link with session string", b"link_session")],
@@ -213,14 +760,14 @@ async def createnpc(event):
     ]
     msg = await event.respond("How would you like to link the account?", buttons=buttons)
     last_bot_message_id[user_id] = msg.id
-    logging.debug(f"Displaying link options for user {user_id}")
+    log.debug("Displaying link options", user_id=user_id)
 
 
 async def editnpc_command(event):
     user_id = event.sender_id
-    logging.debug(f"Received editnpc from user {user_id}")
+    log.debug("Received editnpc", user_id=user_id)
 
-    current_user_data = load_user_data()
+    current_user_data = await read_user_data()
 
     if str(user_id) not in current_user_data or not current_user_data[str(user_id)].get('linked_accounts'):
         await event.respond("You don't have any linked accounts to edit.")
@@ -240,7 +787,7 @@ async def editnpc_command(event):
 async def callback_query_handler(event):
     user_id = event.sender_id
     data = event.data.decode("utf-8")
-    logging.debug(f"Handling callback from user {user_id} with action {data}")
+    log.debug("Handling callback", user_id=user_id, action=data)
 
     if data == "back":
         await event.respond("Returning to previous menu.")
@@ -252,7 +799,7 @@ async def callback_query_handler(event):
             "To link a Telegram account using a phone number, you must enter the account info for a DIFFERENT account than the one you are using now. You need 2 or more accounts OR a trusted friend. Provide your phone number with country code (Example: +15557778888):"
         )
         last_bot_message_id[user_id] = msg.id
-        logging.debug(f"Set state to 'awaiting_phone' for user {user_id} with message ID {msg.id}")
+        log.debug("Set state", state='awaiting_phone', user_id=user_id, message_id=msg.id)
 
     elif data == "link_session":
         user_state[user_id] = 'awaiting_session_string'
@@ -260,7 +807,7 @@ async def callback_query_handler(event):
             "Enter the Session String for the account you wish to link."
         )
         last_bot_message_id[user_id] = msg.id
-        logging.debug(f"Set state to 'awaiting_session_string' for user {user_id} with message ID {msg.id}")
+        log.debug("Set state", state='awaiting_session_string', user_id=user_id, message_id=msg.id)
 
     elif data == 'confirm':
         await create_session(user_id, event)
@@ -269,7 +816,7 @@ async def callback_query_handler(event):
         user_state[user_id] = 'awaiting_phone'
         msg = await event.respond("Let's start over. Provide your phone number with country code:")
         last_bot_message_id[user_id] = msg.id
-        logging.debug(f"Set state to 'awaiting_phone' for user {user_id} with message ID {msg.id}")
+        log.debug("Set state", state='awaiting_phone', user_id=user_id, message_id=msg.id)
 
     elif data == "exit":
         await event.respond("Exited.")
@@ -277,9 +824,15 @@ async def callback_query_handler(event):
 
     elif data.startswith("chat_groups_"):
         telegram_id = int(data.split("_")[2])
+        account = await find_linked_account(user_id, telegram_id)
+        if account and account.get('paused'):
+            pause_button = Button.inline("Resume Account", data=f"resume_account_{telegram_id}")
+        else:
+            pause_button = Button.inline("Pause Account", data=f"pause_account_{telegram_id}")
         buttons = [
             [Button.inline("List of Current Chat Groups", data=f"list_groups_{telegram_id}")],
             [Button.inline("Add Chat Group", data=f"add_group_{telegram_id}")],
+            [pause_button],
             [Button.inline("UNLINK Account", data=f"unlink_account_{telegram_id}")],
             [Button.inline("Back", data=f"back_to_editnpc")]
         ]
@@ -301,6 +854,15 @@ async def callback_query_handler(event):
         )
         last_bot_message_id[user_id] = msg.id
 
+    elif data.startswith("pause_account_") or data.startswith("resume_account_"):
+        telegram_id = int(data.split("_")[2])
+        paused = data.startswith("pause_account_")
+        await set_account_paused(user_id, telegram_id, paused)
+        if paused:
+            await event.respond("Account paused. It is disconnected and won't reply or autopost until resumed.")
+        else:
+            await event.respond("Account resumed.")
+
     elif data.startswith("confirm_unlink_"):
         telegram_id = int(data.split("_")[2])
         await unlink_account(event, user_id, telegram_id)
@@ -316,7 +878,7 @@ async def callback_query_handler(event):
         )
         user_state[user_id] = f'adding_group_{telegram_id}'
         last_bot_message_id[user_id] = msg.id
-        logging.debug(f"Set state to 'adding_group_{telegram_id}' for user {user_id}")
+        log.debug("Set state", state='adding_group', telegram_id=telegram_id, user_id=user_id)
 
     elif data.startswith("view_group_"):
         parts = data.split("_")
@@ -331,7 +893,7 @@ async def callback_query_handler(event):
         user_state[user_id] = f'editing_personality_{telegram_id}_{chat_group_id}'
         msg = await event.respond("Edit the personality for this chat group (limit 2000 characters).")
         last_bot_message_id[user_id] = msg.id
-        logging.debug(f"Set state to 'editing_personality_{telegram_id}_{chat_group_id}'")
+        log.debug("Set state", state='editing_personality', telegram_id=telegram_id, chat_group_id=chat_group_id)
 
     elif data.startswith("personality_helper_"):
         parts = data.split("_")
@@ -341,11 +903,12 @@ async def callback_query_handler(event):
 
     elif data.startswith("set_personality_"):
         telegram_id, chat_group_id = map(int, data.split('_')[2:4])
-        generated_personality = temp_user_data.get(user_id, {}).get('generated_personality', '')
+        generated = temp_user_data.get(user_id, {}).get('generated_personalities', {})
+        generated_personality = generated.get((telegram_id, chat_group_id), '')
         if generated_personality:
             await handle_add_personality(event, user_id, telegram_id, chat_group_id, generated_personality)
             await event.respond("Personality description has been set for the chat group.")
-            temp_user_data[user_id].pop('generated_personality', None)
+            generated.pop((telegram_id, chat_group_id), None)
         else:
             await event.respond("No generated personality found. Please use the Personality Helper first.")
         await view_group(event, telegram_id, chat_group_id)
@@ -364,31 +927,55 @@ async def callback_query_handler(event):
         await event.respond("Unknown action.")
 
 
-async def unlink_account(event, user_id, telegram_id):
-    global user_data, chat_groups
-    user_data = load_user_data()
-    chat_groups = load_chat_groups()
+async def find_linked_account(user_id, telegram_id):
+    """The owner's linked account record from user_data.json (read-only), or None."""
+    current_user_data = await read_user_data()
+    accounts = current_user_data.get(str(user_id), {}).get('linked_accounts', [])
+    return next((acc for acc in accounts if int(acc.get('telegram_id', 0)) == int(telegram_id)), None)
 
-    if str(user_id) in user_data:
-        linked_accounts = user_data[str(user_id)]['linked_accounts']
-        user_data[str(user_id)]['linked_accounts'] = [
-            acc for acc in linked_accounts if int(acc['telegram_id']) != int(telegram_id)
-        ]
-        save_user_data(user_data)
 
-    if str(user_id) in chat_groups:
-        chat_groups[str(user_id)]['linked_accounts'] = [
-            acc for acc in chat_groups[str(user_id)]['linked_accounts'] if int(acc['telegram_id']) != int(telegram_id)
-        ]
-        save_chat_groups(chat_groups)
+async def set_account_paused(user_id, telegram_id, paused):
+    async with user_store.transaction() as user_data:
+        for account in user_data.get(str(user_id), {}).get('linked_accounts', []):
+            if int(account.get('telegram_id', 0)) == int(telegram_id):
+                if paused:
+                    account['paused'] = True
+                else:
+                    account.pop('paused', None)
+    log.info("Account paused" if paused else "Account resumed", user_id=user_id, telegram_id=telegram_id)
+    await initialize_linked_user_clients()
+
+
+async def unlink_account(event, user_id, telegram_id):
+    global user_data, chat_groups
+    async with user_store.transaction() as user_data:
+        if str(user_id) in user_data:
+            linked_accounts = user_data[str(user_id)]['linked_accounts']
+            user_data[str(user_id)]['linked_accounts'] = [
+                acc for acc in linked_accounts if int(acc['telegram_id']) != int(telegram_id)
+            ]
+
+    async with chat_groups_store.transaction() as chat_groups:
+        if str(user_id) in chat_groups:
+            chat_groups[str(user_id)]['linked_accounts'] = [
+                acc for acc in chat_groups[str(user_id)]['linked_accounts'] if int(acc['telegram_id']) != int(telegram_id)
+            ]
 
     client_key = (int(user_id), int(telegram_id))
-    if client_key in linked_user_clients:
-        client = linked_user_clients.pop(client_key)
-        await client.disconnect()
-    if client_key in client_tasks:
-        client_tasks[client_key].cancel()
-        del client_tasks[client_key]
+    agent = agents.get(client_key)
+    async with clients_lock:
+        await stop_linked_client(client_key)
+    # After the stop, which writes out the client's read cursor and session.
+    if agent is not None:
+        await agent.sent_index.forget()
+    else:
+        await sent_messages_store.adelete(session_key(user_id, telegram_id))
+    session = agent.client.session if agent is not None else None
+    if isinstance(session, EncryptedSession):
+        await session.delete()
+    else:
+        await session_db.adelete(session_key(user_id, telegram_id))
+    await read_cursors_store.adelete(session_key(user_id, telegram_id))
 
     await event.respond(f"Account with Telegram ID {telegram_id} has been unlinked.")
     await editnpc_command(event)
@@ -398,23 +985,23 @@ async def unlink_account(event, user_id, telegram_id):
 async def handle_input(event):
     user_id = event.sender_id
     if event.raw_text.startswith('/'):
-        logging.debug(f"Ignoring command input from user {user_id}: {event.raw_text}")
+        log.debug("Ignoring command input", user_id=user_id, command=event.raw_text.split()[0])
         return
 
     if user_id not in user_state or user_id not in last_bot_message_id:
-        logging.debug(f"No state is set for user {user_id}, ignoring message.")
+        log.debug("No state is set; ignoring message", user_id=user_id)
         return
 
     if event.id <= last_bot_message_id[user_id]:
-        logging.debug(f"Message {event.id} from user {user_id} was before bot's prompt.")
+        log.debug("Message was before the bot's prompt", message_id=event.id, user_id=user_id)
         return
 
     state = user_state[user_id]
-    logging.debug(f"User {user_id} in state {state} sent message: {event.raw_text}")
+    log.debug("Input received", user_id=user_id, state=state, chars=len(event.raw_text))
 
     if state == 'awaiting_session_string':
         session_string = event.raw_text.strip()
-        logging.debug(f"User {user_id} provided session string.")
+        log.debug("Session string provided", user_id=user_id)
         await create_session_with_string(user_id, session_string, event)
         user_state[user_id] = None
 
@@ -422,7 +1009,7 @@ async def handle_input(event):
         if user_id not in temp_user_data:
             temp_user_data[user_id] = {}
         temp_user_data[user_id]['temp_phone'] = event.raw_text.strip()
-        logging.debug(f"User {user_id} phone: {temp_user_data[user_id]['temp_phone']}")
+        log.debug("Phone provided", user_id=user_id, phone=temp_user_data[user_id]['temp_phone'])
         user_state[user_id] = 'awaiting_password'
         msg = await event.respond("Enter the password or 'none' if no password is set.")
         last_bot_message_id[user_id] = msg.id
@@ -432,7 +1019,7 @@ async def handle_input(event):
             temp_user_data[user_id] = {}
         password = event.raw_text.strip()
         temp_user_data[user_id]['temp_password'] = password if password.lower() != "none" else ''
-        logging.debug(f"User {user_id} provided password.")
+        log.debug("Password provided", user_id=user_id)
         user_state[user_id] = 'confirming_info'
         password_display = "none" if temp_user_data[user_id]['temp_password'] == '' else temp_user_data[user_id]['temp_password']
         msg = await event.respond(
@@ -470,12 +1057,12 @@ async def handle_input(event):
         await process_personality_samples(event, user_id, telegram_id, chat_group_id, samples_text)
 
     else:
-        logging.debug(f"No handler for state {state}")
+        log.debug("No handler for state", state=state)
 
 
 async def create_session_with_string(user_id, session_string, event):
     try:
-        logging.debug(f"Creating session with session string for user {user_id}")
+        log.debug("Creating session with session string", user_id=user_id)
         client = TelegramClient(StringSession(session_string), api_id, api_hash)
         await client.connect()
         if not await client.is_user_authorized():
@@ -489,11 +1076,11 @@ async def create_session_with_string(user_id, session_string, event):
             await client.disconnect()
             return
 
-        logging.debug(f"Authorized user {result.first_name} ({result.id}) with session string.")
+        log.debug("Authorized with session string", telegram_id=result.id)
         await save_user_data_info(user_id, result, session_string, client, event, is_session_string=True)
 
     except Exception as e:
-        logging.error(f"Failed to create session with string for user {user_id}: {str(e)}")
+        log.error("Failed to create session with string", user_id=user_id, error=e)
         await event.respond(f"Failed: {str(e)}")
         # If client was created successfully, ensure it's disconnected
         try:
@@ -517,7 +1104,7 @@ async def create_session(user_id, event):
             await event.respond("Already authorized.")
             await client.disconnect()
     except Exception as e:
-        logging.error(f"Failed to create session for user {user_id}: {str(e)}")
+        log.error("Failed to create session", user_id=user_id, error=e)
         await event.respond(f"Failed: {str(e)}")
 
 
@@ -547,7 +1134,7 @@ async def handle_code_input(event, user_id, code):
         user_state[user_id] = 'awaiting_password_for_sign_in'
         last_bot_message_id[user_id] = msg.id
     except Exception as e:
-        logging.error(f"Error during session creation for user {user_id}: {str(e)}")
+        log.error("Error during session creation", user_id=user_id, error=e)
         await event.respond(f"Error: {str(e)}")
         await client.disconnect()
 
@@ -570,13 +1157,13 @@ async def handle_password_for_sign_in(event, user_id, password):
         user_state[user_id] = None
         temp_user_data.pop(user_id, None)
     except Exception as e:
-        logging.error(f"Error during sign-in: {e}")
+        log.error("Error during sign-in", error=e)
         await event.respond(f"Error: {e}")
         await client.disconnect()
 
 
-async def save_user_data_info(user_id, result, session_string, client, event, is_session_string):
-    linked_account_info = {
+def linked_account_record(result, session_string):
+    return {
         'session_string': session_string,
         'first_name': result.first_name,
         'last_name': result.last_name,
@@ -584,32 +1171,33 @@ async def save_user_data_info(user_id, result, session_string, client, event, is
         'telegram_id': int(result.id),
     }
 
+
+async def save_user_data_info(user_id, result, session_string, client, event, is_session_string):
+    linked_account_info = linked_account_record(result, session_string)
+
     if not is_session_string:
         linked_account_info['phone'] = temp_user_data[user_id]['temp_phone']
 
-    user_data = load_user_data()
-    if str(user_id) not in user_data:
-        user_data[str(user_id)] = {'linked_accounts': []}
-
-    def update_linked_accounts(user_id):
-        existing_accounts = user_data[str(user_id)]['linked_accounts']
-        for i, account in enumerate(existing_accounts):
-            if int(account['telegram_id']) == int(result.id):
-                existing_accounts[i] = linked_account_info
-                return True
-        return False
+    async with user_store.transaction() as user_data:
+        if str(user_id) not in user_data:
+            user_data[str(user_id)] = {'linked_accounts': []}
 
-    if not update_linked_accounts(user_id):
-        user_data[str(user_id)]['linked_accounts'].append(linked_account_info)
+        def update_linked_accounts(user_id):
+            existing_accounts = user_data[str(user_id)]['linked_accounts']
+            for i, account in enumerate(existing_accounts):
+                if int(account['telegram_id']) == int(result.id):
+                    existing_accounts[i] = linked_account_info
+                    return True
+            return False
 
-    save_user_data(user_data)
+        if not update_linked_accounts(user_id):
+            user_data[str(user_id)]['linked_accounts'].append(linked_account_info)
 
-    chat_groups_data = load_chat_groups()
-    if str(user_id) in chat_groups_data:
-        for account in chat_groups_data[str(user_id)]['linked_accounts']:
-            if 'telegram_id' in account and int(account['telegram_id']) != int(result.id):
-                account['telegram_id'] = int(result.id)
-        save_chat_groups(chat_groups_data)
+    async with chat_groups_store.transaction() as chat_groups_data:
+        if str(user_id) in chat_groups_data:
+            for account in chat_groups_data[str(user_id)]['linked_accounts']:
+                if 'telegram_id' in account and int(account['telegram_id']) != int(result.id):
+                    account['telegram_id'] = int(result.id)
 
     await client.disconnect()
     await event.respond("Success. Your account is now linked.")
@@ -621,7 +1209,7 @@ async def save_user_data_info(user_id, result, session_string, client, event, is
 
 async def list_chat_groups(event, telegram_id):
     user_id = event.sender_id
-    chat_groups_data = load_chat_groups()
+    chat_groups_data = await read_chat_groups()
 
     current_groups = chat_groups_data.get(str(user_id), {}).get('linked_accounts', [])
     account_groups = next((account['chat_groups'] for account in current_groups if int(account['telegram_id']) == int(telegram_id)), [])
@@ -642,7 +1230,7 @@ async def list_chat_groups(event, telegram_id):
 async def view_group(event, telegram_id, chat_group_id):
     user_id = event.sender_id
     group = None
-    chat_groups_data = load_chat_groups()
+    chat_groups_data = await read_chat_groups()
     for account in chat_groups_data.get(str(user_id), {}).get('linked_accounts', []):
         if int(account['telegram_id']) == int(telegram_id):
             for grp in account.get('chat_groups', []):
@@ -671,17 +1259,19 @@ async def view_group(event, telegram_id, chat_group_id):
 
 async def delete_chat_group(event, telegram_id, chat_group_id):
     user_id = event.sender_id
-    chat_groups_data = load_chat_groups()
-    account = None
-    for acc in chat_groups_data.get(str(user_id), {}).get('linked_accounts', []):
-        if int(acc['telegram_id']) == int(telegram_id):
-            account = acc
-            break
+    async with chat_groups_store.transaction() as chat_groups_data:
+        account = None
+        for acc in chat_groups_data.get(str(user_id), {}).get('linked_accounts', []):
+            if int(acc['telegram_id']) == int(telegram_id):
+                account = acc
+                break
+
+        if account:
+            account['chat_groups'] = [group for group in account['chat_groups'] if int(group['chat_group_id']) != int(chat_group_id)]
 
     if account:
-        account['chat_groups'] = [group for group in account['chat_groups'] if int(group['chat_group_id']) != int(chat_group_id)]
-        save_chat_groups(chat_groups_data)
-        logging.debug(f"Deleted chat group {chat_group_id} for account {telegram_id}")
+        prompt_builder.invalidate(group_prompt_key(user_id, telegram_id, chat_group_id))
+        log.debug("Deleted chat group", chat_group_id=chat_group_id, telegram_id=telegram_id)
         return True
     return False
 
@@ -690,10 +1280,11 @@ async def handle_add_group(event, user_id, telegram_id, chat_group_link):
     try:
         telegram_id = int(telegram_id)
         client_key = (user_id, telegram_id)
-        client = linked_user_clients.get(client_key)
-        if not client:
-            await event.respond("Linked account client not found.")
+        agent = await connect_on_demand(user_id, telegram_id)
+        if not agent:
+            await event.respond("Linked account client not found, or the account is paused.")
             return
+        client = agent.client
 
         # Detect if user typed @groupname or numeric ID
         if chat_group_link.startswith('@'):
@@ -712,90 +1303,89 @@ async def handle_add_group(event, user_id, telegram_id, chat_group_link):
             await event.respond("Invalid input. Provide @username or a numeric ID.")
             return
 
-        logging.debug(f"Adding chat group {chat_group_id} '{chat_group_name}' for user {user_id}")
-
-        chat_groups_data = load_chat_groups()
-        if str(user_id) not in chat_groups_data:
-            chat_groups_data[str(user_id)] = {'linked_accounts': []}
-        account = next((a for a in chat_groups_data[str(user_id)]['linked_accounts']
-                        if int(a['telegram_id']) == int(telegram_id)), None)
-        if not account:
-            account = {'telegram_id': int(telegram_id), 'chat_groups': []}
-            chat_groups_data[str(user_id)]['linked_accounts'].append(account)
+        log.debug("Adding chat group", chat_group_id=chat_group_id, name=chat_group_name, user_id=user_id)
 
         is_member = await check_membership(user_id)
         max_chat_groups = 8 if is_member else 1
-        if len(account['chat_groups']) >= max_chat_groups:
+
+        async with chat_groups_store.transaction() as chat_groups_data:
+            if str(user_id) not in chat_groups_data:
+                chat_groups_data[str(user_id)] = {'linked_accounts': []}
+            account = next((a for a in chat_groups_data[str(user_id)]['linked_accounts']
+                            if int(a['telegram_id']) == int(telegram_id)), None)
+            if not account:
+                account = {'telegram_id': int(telegram_id), 'chat_groups': []}
+                chat_groups_data[str(user_id)]['linked_accounts'].append(account)
+
+            limit_reached = len(account['chat_groups']) >= max_chat_groups
+            if not limit_reached:
+                account['chat_groups'].append({
+                    'chat_group_id': chat_group_id,
+                    'chat_group_name': chat_group_name,
+                    'personality': ''
+                })
+
+        if limit_reached:
             await event.respond(f"You have reached the maximum of {max_chat_groups} chat groups for this linked account.")
             return
 
-        account['chat_groups'].append({
-            'chat_group_id': chat_group_id,
-            'chat_group_name': chat_group_name,
-            'personality': ''
-        })
-        save_chat_groups(chat_groups_data)
-
         msg = await event.respond("Saved Chat Group. Provide a personality description for this chat group.")
         user_state[user_id] = f'adding_personality_{telegram_id}_{chat_group_id}'
         last_bot_message_id[user_id] = msg.id
-        logging.debug(f"State: 'adding_personality_{telegram_id}_{chat_group_id}' for user {user_id}")
+        log.debug("Set state", state='adding_personality', telegram_id=telegram_id, chat_group_id=chat_group_id, user_id=user_id)
 
-        if client_key in linked_user_clients:
-            client = linked_user_clients[client_key]
-            if not hasattr(client, 'chat_group_ids'):
-                client.chat_group_ids = []
-            if chat_group_id not in client.chat_group_ids:
-                client.chat_group_ids.append(chat_group_id)
-            logging.debug(f"Updated chat groups for client {telegram_id}: {client.chat_group_ids}")
+        if client_key in agents:
+            agent = agents[client_key]
+            agent.add_chat_group(chat_group_id)
+            log.debug("Updated chat groups for client", telegram_id=telegram_id, chat_group_ids=agent.chat_group_ids)
 
     except Exception as e:
-        logging.error(f"Error adding group: {e}")
+        log.error("Error adding group", error=e)
         await event.respond("Failed to add chat group. Check group link or ID.")
 
 
 async def handle_add_personality(event, user_id, telegram_id, chat_group_id, personality_description):
-    chat_groups_data = load_chat_groups()
     telegram_id = int(telegram_id)
     chat_group_id = int(chat_group_id)
-    account = None
-    for acc in chat_groups_data[str(user_id)]['linked_accounts']:
-        if int(acc['telegram_id']) == telegram_id:
-            account = acc
-            break
-
-    if account:
-        for group in account['chat_groups']:
-            if int(group['chat_group_id']) == chat_group_id:
-                group['personality'] = personality_description
-                save_chat_groups(chat_groups_data)
+    async with chat_groups_store.transaction() as chat_groups_data:
+        account = None
+        for acc in chat_groups_data[str(user_id)]['linked_accounts']:
+            if int(acc['telegram_id']) == telegram_id:
+                account = acc
                 break
 
+        if account:
+            for group in account['chat_groups']:
+                if int(group['chat_group_id']) == chat_group_id:
+                    group['personality'] = personality_description
+                    break
+    prompt_builder.invalidate(group_prompt_key(user_id, telegram_id, chat_group_id))
+
     await event.respond("Personality description saved.")
     user_state[user_id] = None
-    logging.debug(f"Cleared state for user {user_id}")
+    log.debug("Cleared state", user_id=user_id)
 
 
 async def handle_edit_personality(event, user_id, telegram_id, chat_group_id, personality_description):
-    chat_groups_data = load_chat_groups()
     telegram_id = int(telegram_id)
     chat_group_id = int(chat_group_id)
-    account = None
-    for acc in chat_groups_data[str(user_id)]['linked_accounts']:
-        if int(acc['telegram_id']) == telegram_id:
-            account = acc
-            break
-
-    if account:
-        for group in account['chat_groups']:
-            if int(group['chat_group_id']) == chat_group_id:
-                group['personality'] = personality_description
-                save_chat_groups(chat_groups_data)
+    async with chat_groups_store.transaction() as chat_groups_data:
+        account = None
+        for acc in chat_groups_data[str(user_id)]['linked_accounts']:
+            if int(acc['telegram_id']) == telegram_id:
+                account = acc
                 break
 
+        if account:
+            for group in account['chat_groups']:
+                if int(group['chat_group_id']) == chat_group_id:
+                    group['personality'] = personality_description
+                    break
+    prompt_builder.invalidate(group_prompt_key(user_id, telegram_id, chat_group_id))
+
     await event.respond("Personality description updated.")
     user_state[user_id] = None
-    logging.debug(f"Cleared state for user {user_id}")
+    log.debug("Cleared state", user_id=user_id)
 
 
 async def handle_personality_helper(event, user_id, telegram_id, chat_group_id):
@@ -804,175 +1394,368 @@ async def handle_personality_helper(event, user_id, telegram_id, chat_group_id):
         "Personality Helper: Provide a post containing representative text. Max 1000 words. The bot will create a personality description from these samples."
     )
     last_bot_message_id[user_id] = msg.id
-    logging.debug(f"Set state to 'awaiting_personality_samples_{telegram_id}_{chat_group_id}'")
+    log.debug("Set state", state='awaiting_personality_samples', telegram_id=telegram_id, chat_group_id=chat_group_id)
 
 
 async def process_personality_samples(event, user_id, telegram_id, chat_group_id, samples_text):
     """
-    This function is now a placeholder that you can modify to call your custom LLM endpoint.
-    For example, if your LLM runs at http://your-vps-ip:8000/generate, you can call it here
-    with requests.post(...) or an async library. 
+    Submit a Personality Helper job for the samples and answer with a progress
+    message, which is edited in place when the description is ready. Identical
+    samples share one job.
     """
+    words = samples_text.split()
+    if len(words) > 1000:
+        samples_text = ' '.join(words[:1000])
+        log.debug("Samples truncated to 1000 words", user_id=user_id)
+
+    samples_hash = hashlib.sha256(samples_text.encode('utf-8')).hexdigest()
     try:
-        words = samples_text.split()
-        if len(words) > 1000:
-            samples_text = ' '.join(words[:1000])
-            logging.debug(f"Samples truncated to 1000 words for user {user_id}")
-
-        # Replace the entire OpenAI call with your custom LLM logic:
-        # For example, using requests (synchronous example, adapt if needed):
-        #
-        # response = requests.post("http://your-vps-ip:8000/generate", json={"prompt": samples_text})
-        # personality_description = response.json().get("generated_text", "")
-        #
-        # For now, let's just do a fake response:
-        personality_description = (
-            "You speak with a witty, sarcastic tone, often making dry observations and short quips."
+        job, is_new = personality_jobs.submit(user_id, samples_hash, lambda: generate_personality(user_id, samples_text))
+    except TooManyJobs:
+        await event.respond(
+            f"You already have {PERSONALITY_JOBS_PER_USER} Personality Helper requests in progress. "
+            "Wait for one to finish and try again."
         )
+        return
+    user_state[user_id] = None
 
-        personality_description = personality_description[:2000]
+    progress = await event.respond(
+        f"Personality Helper job {job.job_id}: generating a personality description. "
+        "This message will update when it's ready."
+    )
+    last_bot_message_id[user_id] = progress.id
+    log.debug("Personality job submitted", user_id=user_id, job_id=job.job_id, deduplicated=not is_new)
 
-        await event.respond(
-            f"Generated personality:\n\n{personality_description}"
-        )
+    async def deliver(job):
+        try:
+            personality_description = await job.wait()
+        except Exception as e:
+            log.error("Error generating personality", error=e, job_id=job.job_id)
+            await progress.edit(f"Personality Helper job {job.job_id} failed. Try again later.")
+            return
 
+        generated = temp_user_data.setdefault(user_id, {}).setdefault('generated_personalities', {})
+        generated[(int(telegram_id), int(chat_group_id))] = personality_description
         buttons = [
             [Button.inline("Set as Personality", data=f"set_personality_{telegram_id}_{chat_group_id}")],
             [Button.inline("Back", data=f"view_group_{telegram_id}_{chat_group_id}")]
         ]
-        msg = await event.respond("Set this as the personality?", buttons=buttons)
-        last_bot_message_id[user_id] = msg.id
+        await progress.edit(
+            f"Generated personality:\n\n{personality_description}\n\nSet this as the personality?", buttons=buttons
+        )
+        log.debug("Generated personality", user_id=user_id, job_id=job.job_id)
 
-        temp_user_data[user_id] = temp_user_data.get(user_id, {})
-        temp_user_data[user_id]['generated_personality'] = personality_description
-        temp_user_data[user_id]['telegram_id'] = telegram_id
-        temp_user_data[user_id]['chat_group_id'] = chat_group_id
+    personality_jobs.watch(job, deliver)
 
-        user_state[user_id] = None
-        logging.debug(f"Generated personality for user {user_id}")
 
-    except Exception as e:
-        logging.error(f"Error generating personality: {e}")
-        await event.respond("Failed to generate personality. Try again later.")
-        user_state[user_id] = None
+async def generate_personality(user_id, samples_text):
+    """
+    Generate a personality description from the samples with the LLM at LLM_ENDPOINTS,
+    or a placeholder description when none is configured.
+    """
+    if LLM_ENDPOINTS:
+        # Someone is waiting on this screen, so it goes ahead of replies and autoposts.
+        personality_description = await llm_scheduler.run(
+            INTERACTIVE, user_id, llm_dispatcher.generate, PERSONALITY_HELPER_INSTRUCTIONS, samples_text
+        )
+    else:
+        # No LLM configured; use a fake response:
+        personality_description = (
+            "You speak with a witty, sarcastic tone, often making dry observations and short quips."
+        )
+    return personality_description[:2000]
+
 
+# Per-chat reply limit window: 4 replies (members) or 1 (others) per 7 hours
+REPLY_LIMIT_WINDOW = 25200
 
-async def handle_linked_user_message(event, user_id):
+
+async def handle_linked_user_message(event, agent):
+    user_id, telegram_id = agent.key
+    trace = tracer.start('reply', owner_id=user_id, chat_id=event.chat_id, message_id=event.message.id)
     try:
-        telegram_id = event.client.me.id
         message = event.message
         chat_id = event.chat_id
         current_time = time.time()
+        trace.set(telegram_id=telegram_id)
 
-        logging.debug(f"Message in chat {chat_id} by user {message.sender_id}")
+        log.debug("Message received", chat_id=chat_id, sender_id=message.sender_id, trace_id=trace.trace_id)
 
-        sender = await message.get_sender()
-        if sender:
-            logging.debug(f"Message sender: {sender.first_name} {sender.last_name} (ID: {sender.id})")
+        # Other linked clients in this group get the same message; they share these results.
+        work = chat_coordinator.message(message)
+        with trace.span('sender'):
+            facts = await work.once('facts', lambda: message_facts(message))
+        log.debug("Message sender", sender_id=facts['sender_id'], trace_id=trace.trace_id)
 
-        if sender and sender.id == telegram_id:
-            logging.debug("Ignoring linked account's own message.")
+        if facts['sender_id'] == telegram_id:
+            log.debug("Ignoring linked account's own message.")
+            trace.drop('own_message')
             return
 
-        if message.date < event.client.user_start_time:
-            logging.debug("Message before client start; skipping.")
+        if isinstance(event, MissedMessage):
+            trace.set(catch_up=True)
+        elif message.date < agent.started_at:
+            # Messages from before the client (re)connected are left to catch-up.
+            log.debug("Message before client start; skipping.")
+            trace.drop('before_start')
             return
+        agent.read_cursor.advance(chat_id, message.id)
 
-        if contains_link(message.text):
-            logging.debug("Message contains a link; skipping.")
+        if facts['contains_link']:
+            log.debug("Message contains a link; skipping.")
+            trace.drop('contains_link')
             return
 
-        if not message.text:
-            logging.debug("No text; skipping.")
+        if not facts['has_text']:
+            log.debug("No text; skipping.")
+            trace.drop('no_text')
             return
 
-        client_key = (user_id, telegram_id)
-        chat_groups_data = load_chat_groups()
+        with trace.span('config'):
+            chat_groups_data = await read_chat_groups()
         user_chat_groups = chat_groups_data.get(str(user_id), {}).get('linked_accounts', [])
         linked_account = next((acc for acc in user_chat_groups if int(acc['telegram_id']) == telegram_id), None)
         if not linked_account:
-            logging.debug("No linked account found.")
+            log.debug("No linked account found.")
+            trace.drop('no_linked_account')
             return
 
         chat_group_ids = [int(cg['chat_group_id']) for cg in linked_account.get('chat_groups', [])]
         if chat_id not in chat_group_ids:
-            logging.debug("Chat ID not assigned to this account.")
+            log.debug("Chat ID not assigned to this account.")
+            trace.drop('chat_not_assigned')
             return
 
         chat_group = next((cg for cg in linked_account.get('chat_groups', []) if int(cg['chat_group_id']) == chat_id), None)
         if not chat_group:
-            logging.debug("No chat group data found.")
+            log.debug("No chat group data found.")
+            trace.drop('no_chat_group')
             return
 
-        if client_key not in message_tracker:
-            message_tracker[client_key] = {}
-        if chat_id not in message_tracker[client_key]:
-            message_tracker[client_key][chat_id] = []
+        if not isinstance(event, MissedMessage):
+            # A replayed message is older than what the client has seen live; starting coverage
+            # there would turn our messages sent while offline into "not mine".
+            agent.sent_index.observe(chat_id, message.id)
+        chat_state = agent.chat(chat_id)
 
-        if client_key not in reply_tracker:
-            reply_tracker[client_key] = {}
-        if chat_id not in reply_tracker[client_key]:
-            reply_tracker[client_key][chat_id] = set()
-
-        # Clean out timestamps older than 7 hours
-        message_tracker[client_key][chat_id] = [
-            ts for ts in message_tracker[client_key][chat_id]
-            if current_time - ts < 25200
-        ]
-
-        is_member = await check_membership(user_id)
+        with trace.span('membership'):
+            is_member = await work.once(('membership', user_id), lambda: check_membership(user_id))
         message_limit = 4 if is_member else 1
-        if len(message_tracker[client_key][chat_id]) >= message_limit:
-            logging.debug("Message limit reached; cooling off.")
+        trace.set(tier='member' if is_member else 'basic')
+        # Replies in the last 7 hours, including the ones still waiting to be sent
+        if chat_state.reply_slots_used(current_time, REPLY_LIMIT_WINDOW) >= message_limit:
+            log.debug("Message limit reached; cooling off.")
+            trace.drop('message_limit')
             return
 
         if message.is_reply and message.reply_to_msg_id:
-            original_message = await message.get_reply_message()
-            if original_message and original_message.sender_id:
-                if int(original_message.sender_id) != telegram_id:
-                    logging.debug("Original message not from linked account.")
+            is_reply_to_me = agent.sent_index.lookup(chat_id, message.reply_to_msg_id)
+            if is_reply_to_me is None:
+                # Older than the index; fall back to fetching the original message.
+                with trace.span('reply_check'):
+                    original_sender_id = await work.once('reply_to_sender', lambda: reply_to_sender_id(message))
+                if not original_sender_id:
+                    log.debug("No original message or sender_id.")
+                    trace.drop('no_original_message')
                     return
-            else:
-                logging.debug("No original message or sender_id.")
+                is_reply_to_me = int(original_sender_id) == telegram_id
+                if is_reply_to_me:
+                    agent.sent_index.remember(chat_id, message.reply_to_msg_id)
+            if not is_reply_to_me:
+                log.debug("Original message not from linked account.")
+                trace.drop('not_reply_to_account')
                 return
 
-            if sender and sender.bot:
-                logging.debug("Replier is a bot; skipping.")
+            if facts['sender_is_bot']:
+                log.debug("Replier is a bot; skipping.")
+                trace.drop('sender_is_bot')
                 return
 
-            if message.id in reply_tracker[client_key][chat_id]:
-                logging.debug("Already replied to this message.")
+            if chat_state.has_replied(message.id):
+                log.debug("Already replied to this message.")
+                trace.drop('already_replied')
                 return
 
-            personality_description = chat_group['personality']
-            delay = random.uniform(32, 2600)
-            logging.debug(f"Waiting {delay} seconds before responding.")
+            # Checked again: other events for this chat may have reserved a reply during the awaits above.
+            if chat_state.reply_slots_used(time.time(), REPLY_LIMIT_WINDOW) >= message_limit:
+                log.debug("Message limit reached; cooling off.")
+                trace.drop('message_limit')
+                return
+
+            if not work.claim('reply'):
+                # The same account is linked more than once and another client is already replying.
+                log.debug("Another client is replying to this message.")
+                trace.drop('claimed_by_other_client')
+                return
+
+            # The delay, LLM call and send run in their own task so this client's event workers stay free.
+            # The reply holds one of the chat's slots until it is sent or dropped.
+            chat_state.reserve_reply()
+            reply = asyncio.create_task(
+                send_delayed_reply(agent, chat_group, message, current_time, message_limit, trace)
+            )
+            reply.add_done_callback(lambda _, chat_state=chat_state: chat_state.release_reply())
+            agent.add_pending_reply(reply)
+            trace = None  # ended by the reply task
+        else:
+            log.debug("Not a reply to linked account's message; skipping.")
+            trace.drop('not_a_reply')
+
+    except asyncio.CancelledError:
+        if trace:
+            trace.drop('cancelled')
+        raise
+    except Exception as e:
+        log.error("Error handling linked user message", error=e)
+        if trace:
+            trace.fail(e)
+    finally:
+        if trace:
+            trace.end()
+
+
+async def draft_reply(personality_description, user_input, prompt_key, owner_id):
+    """Generate a reply ahead of its send time on spare LLM capacity. Returns (personality, text or None)."""
+    try:
+        response_text = await generate_llm_response(
+            personality_description, user_input, prompt_key, priority=DRAFT, owner_id=owner_id
+        )
+    except Exception:
+        response_text = None  # regenerated at send time
+    return personality_description, response_text
+
+
+def take_draft(draft, personality_description):
+    """Return (text or None, state) for a draft at send time; a pending draft is cancelled."""
+    if not draft.done():
+        draft.cancel()
+        return None, 'pending'
+    if draft.cancelled() or draft.exception() is not None:
+        return None, 'missing'
+    drafted_for, response_text = draft.result()
+    if response_text is None:
+        return None, 'missing'
+    if drafted_for != personality_description:
+        return None, 'stale'
+    return response_text, 'used'
+
+
+async def current_chat_group(user_id, telegram_id, chat_id):
+    """The chat group's config as it is now, or None if the group is no longer assigned."""
+    chat_groups_data = await read_chat_groups()
+    for account in chat_groups_data.get(str(user_id), {}).get('linked_accounts', []):
+        if int(account['telegram_id']) == telegram_id:
+            for chat_group in account.get('chat_groups', []):
+                if int(chat_group['chat_group_id']) == chat_id:
+                    return chat_group
+    return None
+
+
+async def send_delayed_reply(agent, chat_group, message, received_at, message_limit, trace):
+    """
+    Wait the random reply delay and send the reply. The reply is drafted during
+    the delay, whenever the LLM has spare capacity, so the send doesn't wait on
+    inference; it is regenerated at send time if the draft didn't finish or the
+    personality was edited since. The chat's reply limit is checked again
+    before sending.
+    """
+    user_id, telegram_id = agent.key
+    client = agent.client
+    chat_id = int(chat_group['chat_group_id'])
+    prompt_key = group_prompt_key(user_id, telegram_id, chat_id)
+    draft = asyncio.create_task(draft_reply(chat_group['personality'], message.text, prompt_key, user_id))
+    try:
+        delay = random.uniform(32, 2600)
+        log.debug("Waiting before responding", delay=round(delay), trace_id=trace.trace_id)
+        with trace.span('delay'):
             await asyncio.sleep(delay)
 
-            response_text = await generate_llm_response(personality_description, message.text)
+        chat_group = await current_chat_group(user_id, telegram_id, chat_id)
+        if chat_group is None:
+            log.debug("Chat group removed during the reply delay", chat_id=chat_id, trace_id=trace.trace_id)
+            trace.drop('chat_removed')
+            return
+        personality_description = chat_group['personality']
 
+        response_text, draft_state = take_draft(draft, personality_description)
+        trace.set(draft=draft_state)
+        if response_text is None:
             try:
-                if not event.client.is_connected():
-                    await event.client.connect()
-
-                await event.client.send_message(chat_id, response_text, reply_to=message.id)
-                logging.info(f"Replied in chat {chat_id}")
-            except errors.FloodWaitError as e:
-                logging.warning(f"FloodWaitError: Waiting {e.seconds}s")
-                await asyncio.sleep(e.seconds)
-                await event.client.send_message(chat_id, response_text, reply_to=message.id)
+                with trace.span('llm'):
+                    response_text = await generate_llm_response(
+                        personality_description, message.text, prompt_key, priority=REPLY, owner_id=user_id
+                    )
             except Exception as e:
-                logging.error(f"Error sending message: {e}")
+                log.info("Reply dropped: LLM error", chat_id=chat_id, error=e, trace_id=trace.trace_id)
+                trace.drop('llm_error')
                 return
+        if response_text is None:
+            log.info("Reply dropped: LLM overloaded", chat_id=chat_id, trace_id=trace.trace_id)
+            trace.drop('llm_overloaded')
+            return
 
-            message_tracker[client_key][chat_id].append(current_time)
-            reply_tracker[client_key][chat_id].add(message.id)
-        else:
-            logging.debug("Not a reply to linked account's message; skipping.")
+        if agent.chat(chat_id).recent_replies(time.time(), REPLY_LIMIT_WINDOW) >= message_limit:
+            log.debug("Message limit reached during the reply delay", chat_id=chat_id, trace_id=trace.trace_id)
+            trace.drop('message_limit')
+            return
+
+        if is_shadow(chat_group):
+            log.info("Shadow reply (not sent)", chat_id=chat_id, reply_to=message.id, text=response_text,
+                     trace_id=trace.trace_id)
+            shadow_stats.record('replies', chat_id, personality_description + (message.text or ''), response_text)
+            trace.shadow()
+            agent.chat(chat_id).replied_to(message.id, received_at)
+            return
+
+        try:
+            with trace.span('send'):
+                if not client.is_connected():
+                    await client.connect()
+                sent = await client.send_message(chat_id, response_text, reply_to=message.id)
+            agent.sent_index.add(chat_id, sent.id)
+            log.info("Replied", chat_id=chat_id, trace_id=trace.trace_id)
+        except errors.FloodWaitError as e:
+            log.warning("FloodWaitError; waiting", seconds=e.seconds, chat_id=chat_id, trace_id=trace.trace_id)
+            with trace.span('flood_wait', seconds=e.seconds):
+                await asyncio.sleep(e.seconds)
+            with trace.span('send', retry=True):
+                sent = await client.send_message(chat_id, response_text, reply_to=message.id)
+            agent.sent_index.add(chat_id, sent.id)
+        except Exception as e:
+            log.error("Error sending message", error=e, chat_id=chat_id, trace_id=trace.trace_id)
+            trace.fail(f"send failed: {e}")
+            return
+        trace.sent()
 
+        agent.chat(chat_id).replied_to(message.id, received_at)
+    except asyncio.CancelledError:
+        trace.drop('cancelled')
+        raise
     except Exception as e:
-        logging.error(f"Error handling linked user message: {e}")
-        await asyncio.sleep(5)
+        log.error("Error sending delayed reply", error=e, trace_id=trace.trace_id)
+        trace.fail(e)
+    finally:
+        draft.cancel()
+        trace.end()
+
+
+async def message_facts(message):
+    """The account-independent checks for an incoming message, shared by every client that received it."""
+    sender = await message.get_sender()
+    return {
+        'sender_id': sender.id if sender else None,
+        'sender_is_bot': bool(sender and sender.bot),
+        'has_text': bool(message.text),
+        'contains_link': contains_link(message.text),
+    }
+
+
+async def reply_to_sender_id(message):
+    """Fetch the message being replied to and return its sender_id (None if it's gone)."""
+    original_message = await message.get_reply_message()
+    if not original_message:
+        return None
+    return original_message.sender_id
 
 
 def contains_link(text):
@@ -983,26 +1766,20 @@ def contains_link(text):
     return bool(url_pattern.search(text or ''))
 
 
-async def generate_llm_response(personality_description, user_input):
+async def generate_llm_response(personality_description, user_input, prompt_key=None, priority=REPLY, owner_id=None):
     """
-    Replace this placeholder with an actual request to your custom LLM running on another VPS.
+    Generate a reply through the LLM dispatcher, which batches concurrent requests
+    from all linked clients into one call to the backend (see LLM_ENDPOINTS).
+    prompt_key identifies the chat group so its personality prompt can be cached by the server.
+    The request waits in the scheduler under `priority`, shared fairly between owners (owner_id);
+    returns None if it was shed because the LLM is overloaded. Backend errors (HTTP errors, timeouts,
+    no healthy endpoint) are raised, so callers drop the reply instead of posting an error message.
     """
     try:
-        # For example, if your LLM endpoint is an HTTP API:
-        # response = requests.post("http://your-vps-ip:8000/generate", json={
-        #     "personality": personality_description,
-        #     "input_text": user_input
-        # })
-        # response_text = response.json()["response"]
-
-        # For now, we'll just return a made-up, short response:
-        fake_response = [
-            "Sure, I'll keep that in mind.",
-            "Absolutely, no problem!",
-            "Alright, consider it done.",
-            "Got it."
-        ]
-        response_text = random.choice(fake_response)
+        prompt = prompt_builder.template(prompt_key, personality_description) if prompt_key else None
+        response_text = await llm_scheduler.run(
+            priority, owner_id, llm_dispatcher.generate, personality_description, user_input, prompt=prompt
+        )
 
         # Optionally remove emojis, hashtags, or do further processing:
         response_text = remove_emojis_and_hashtags(response_text)
@@ -1011,9 +1788,12 @@ async def generate_llm_response(personality_description, user_input):
         # because you requested that function be removed.
 
         return response_text
+    except Overloaded as e:
+        log.info("LLM request shed", reason=e, priority=priority)
+        return None
     except Exception as e:
-        logging.error(f"Error generating response: {e}")
-        return "Sorry, I couldn't generate a response."
+        log.error("Error generating response", error=e)
+        raise
 
 
 def remove_emojis_and_hashtags(text):
@@ -1036,172 +1816,382 @@ def remove_emojis_and_hashtags(text):
     return text
 
 
-async def autopost_task(client):
-    client_key = (client.user_id, client.telegram_id)
+async def autopost_to_chat_group(agent, chat_group, trace):
+    """Reply to the latest suitable message in one chat group."""
+    client = agent.client
+    chat_id = int(chat_group['chat_group_id'])
+    personality_description = chat_group['personality']
+    chat_state = agent.chat(chat_id)
+
+    now = datetime.datetime.now(datetime.timezone.utc)
+    found_message = None
+    with trace.span('history'):
+        async for message in client.iter_messages(chat_id, limit=100):
+            if (now - message.date).total_seconds() > 25200:
+                break
+            if message.sender_id == agent.telegram_id:
+                continue
+            sender = await message.get_sender()
+            if sender and sender.bot:
+                continue
+            if contains_link(message.text):
+                continue
+            if not message.text:
+                continue
+            if chat_state.has_autoreplied(message.id):
+                continue
+            found_message = message
+            break
+
+    if not found_message:
+        log.debug("No suitable message for autopost", chat_id=chat_id, trace_id=trace.trace_id)
+        trace.drop('no_suitable_message')
+        return
+
+    last_message = found_message
+    trace.set(message_id=last_message.id)
+    try:
+        with trace.span('llm'):
+            response_text = await generate_llm_response(
+                personality_description, last_message.text or "",
+                group_prompt_key(agent.user_id, agent.telegram_id, chat_id),
+                priority=AUTOPOST, owner_id=agent.user_id
+            )
+    except Exception as e:
+        log.info("Autopost skipped: LLM error", chat_id=chat_id, error=e, trace_id=trace.trace_id)
+        trace.drop('llm_error')
+        return
+    if response_text is None:
+        log.info("Autopost skipped: LLM overloaded", chat_id=chat_id, trace_id=trace.trace_id)
+        trace.drop('llm_overloaded')
+        return
+
+    if is_shadow(chat_group):
+        log.info("Shadow autopost (not sent)", chat_id=chat_id, reply_to=last_message.id, text=response_text,
+                 trace_id=trace.trace_id)
+        shadow_stats.record('autoposts', chat_id, personality_description + (last_message.text or ''), response_text)
+        trace.shadow()
+        chat_state.autoreplied_to(last_message.id)
+        return
+
+    try:
+        with trace.span('send'):
+            if not client.is_connected():
+                await client.connect()
+            sent = await client.send_message(chat_id, response_text, reply_to=last_message.id)
+        agent.sent_index.add(chat_id, sent.id)
+        log.info("Autoposted reply", chat_id=chat_id, trace_id=trace.trace_id)
+        chat_state.autoreplied_to(last_message.id)
+
+    except errors.FloodWaitError as e:
+        log.warning("FloodWaitError; waiting", seconds=e.seconds, chat_id=chat_id, trace_id=trace.trace_id)
+        with trace.span('flood_wait', seconds=e.seconds):
+            await asyncio.sleep(e.seconds)
+        with trace.span('send', retry=True):
+            sent = await client.send_message(chat_id, response_text, reply_to=last_message.id)
+        agent.sent_index.add(chat_id, sent.id)
+        log.info("Autoposted reply after wait", chat_id=chat_id, trace_id=trace.trace_id)
+        chat_state.autoreplied_to(last_message.id)
+    except Exception as e:
+        log.error("Error autoposting message", error=e, chat_id=chat_id, trace_id=trace.trace_id)
+        trace.fail(f"send failed: {e}")
+        return
+    trace.sent()
+
+
+async def autopost_task(agent):
+    client = agent.client
     while True:
         try:
             if not client.is_connected():
                 await client.connect()
 
-            is_member = await check_membership(client.user_id)
+            is_member = await check_membership(agent.user_id)
             if is_member:
                 delay = random.uniform(21600, 61200)  # 6 to 17 hours
             else:
                 delay = random.uniform(43200, 86400)  # 12 to 24 hours
 
-            logging.debug(f"Waiting {delay} seconds before autoposting")
+            log.debug("Waiting before autoposting", delay=round(delay), telegram_id=agent.telegram_id)
             await asyncio.sleep(delay)
 
-            chat_groups_data = load_chat_groups()
-            user_chat_groups = chat_groups_data.get(str(client.user_id), {}).get('linked_accounts', [])
-            linked_account = next((acc for acc in user_chat_groups if int(acc['telegram_id']) == client.telegram_id), None)
+            chat_groups_data = await read_chat_groups()
+            user_chat_groups = chat_groups_data.get(str(agent.user_id), {}).get('linked_accounts', [])
+            linked_account = next((acc for acc in user_chat_groups if int(acc['telegram_id']) == agent.telegram_id), None)
 
             if not linked_account:
-                logging.debug("No linked account found for autopost.")
+                log.debug("No linked account found for autopost.")
                 continue
 
             for chat_group in linked_account.get('chat_groups', []):
-                chat_id = int(chat_group['chat_group_id'])
-                personality_description = chat_group['personality']
-
-                if client_key not in autoreply_tracker:
-                    autoreply_tracker[client_key] = {}
-                if chat_id not in autoreply_tracker[client_key]:
-                    autoreply_tracker[client_key][chat_id] = set()
-
-                now = datetime.datetime.now(datetime.timezone.utc)
-                found_message = None
-                async for message in client.iter_messages(chat_id, limit=100):
-                    if (now - message.date).total_seconds() > 25200:
-                        break
-                    if message.sender_id == client.me.id:
-                        continue
-                    sender = await message.get_sender()
-                    if sender and sender.bot:
-                        continue
-                    if contains_link(message.text):
-                        continue
-                    if not message.text:
-                        continue
-                    if message.id in autoreply_tracker[client_key][chat_id]:
-                        continue
-                    found_message = message
-                    break
-
-                if not found_message:
-                    logging.debug(f"No suitable message in chat {chat_id} for autopost.")
-                    continue
-
-                last_message = found_message
-                response_text = await generate_llm_response(personality_description, last_message.text or "")
-
+                trace = tracer.start(
+                    'autopost', owner_id=agent.user_id, telegram_id=agent.telegram_id,
+                    chat_id=int(chat_group['chat_group_id']), tier='member' if is_member else 'basic',
+                    interval_s=round(delay)
+                )
                 try:
-                    if not client.is_connected():
-                        await client.connect()
-                    await client.send_message(chat_id, response_text, reply_to=last_message.id)
-                    logging.info(f"Autoposted reply in chat {chat_id}")
-                    autoreply_tracker[client_key][chat_id].add(last_message.id)
-
-                except errors.FloodWaitError as e:
-                    logging.warning(f"FloodWaitError: Waiting {e.seconds}s")
-                    await asyncio.sleep(e.seconds)
-                    await client.send_message(chat_id, response_text, reply_to=last_message.id)
-                    logging.info(f"Autoposted reply after wait in chat {chat_id}")
-                    autoreply_tracker[client_key][chat_id].add(last_message.id)
+                    await autopost_to_chat_group(agent, chat_group, trace)
                 except Exception as e:
-                    logging.error(f"Error autoposting message: {e}")
-                    continue
+                    trace.fail(e)
+                    raise
+                finally:
+                    trace.end()
 
         except Exception as e:
-            logging.error(f"Error in autopost_task: {e}")
+            log.error("Error in autopost_task", error=e)
             await asyncio.sleep(3600)
 
 
 async def check_for_updates():
-    global user_data, chat_groups, linked_user_clients
+    global user_data, chat_groups
     while True:
         try:
-            new_user_data = load_user_data()
+            await user_store.areload_if_changed()
+            await chat_groups_store.areload_if_changed()
+
+            new_user_data = await user_store.aload()
             if new_user_data != user_data:
-                logging.info("Change in user_data.json detected.")
+                log.info("Change in user_data.json detected.")
                 user_data = new_user_data
                 await initialize_linked_user_clients()
 
-            new_chat_groups = load_chat_groups()
+            new_chat_groups = await chat_groups_store.aload()
             if new_chat_groups != chat_groups:
-                logging.info("Change in chat_groups.json detected.")
+                log.info("Change in chat_groups.json detected.")
                 chat_groups = new_chat_groups
-                for client_key, client in linked_user_clients.items():
+                for client_key, agent in agents.items():
                     user_id, telegram_id = client_key
                     user_chat_groups = chat_groups.get(str(user_id), {}).get('linked_accounts', [])
                     linked_account = next((acc for acc in user_chat_groups if int(acc['telegram_id']) == telegram_id), None)
-                    if linked_account:
-                        client.chat_group_ids = [int(group['chat_group_id']) for group in linked_account.get('chat_groups', [])]
-                    else:
-                        client.chat_group_ids = []
-                    logging.debug(f"Updated chat groups for client {telegram_id}: {client.chat_group_ids}")
+                    agent.set_chat_groups(linked_account)
+                    log.debug("Updated chat groups for client", telegram_id=telegram_id, chat_group_ids=agent.chat_group_ids)
+                # Accounts that gained their first group connect; ones that lost their last go dormant.
+                await initialize_linked_user_clients()
+            elif any(agent.on_demand_at is not None for agent in agents.values()):
+                await initialize_linked_user_clients()
 
         except Exception as e:
-            logging.error(f"Error checking updates: {e}")
+            log.error("Error checking updates", error=e)
 
         await asyncio.sleep(60)
 
 
+async def start_linked_client(user_id, account):
+    """
+    Connect one linked account and start its handlers, autopost and update loop.
+    Updates account['telegram_id'] in place if it was wrong. Returns its AgentState, or None if unauthorized.
+    Callers hold clients_lock.
+    """
+    session_string = account['session_string']
+    if account.get('telegram_id'):
+        session = EncryptedSession(session_db, session_key(user_id, account['telegram_id']), session_string)
+    else:
+        session = StringSession(session_string)
+    client = TelegramClient(session, api_id, api_hash, catch_up=True)
+    agent = AgentState(client, user_id, session_string)
+    await client.connect()
+    if not await client.is_user_authorized():
+        log.warning("Client not authorized", telegram_id=account.get('telegram_id'))
+        await client.disconnect()
+        return None
+    agent.started_at = datetime.datetime.now(datetime.timezone.utc)
+    agent.me = session.get_cached_me() if isinstance(session, EncryptedSession) else None
+    if agent.me is None:
+        agent.me = await client.get_me()
+        if isinstance(session, EncryptedSession):
+            session.cache_me(agent.me)
+    agent.telegram_id = agent.me.id
+
+    if int(account.get('telegram_id', 0)) != agent.telegram_id:
+        account['telegram_id'] = agent.telegram_id
+        log.info("Updated telegram_id", user_id=user_id)
+
+    client_key = agent.key
+    # Rate limits and dedupe carry over from the account's previous client (pause/resume, relink, restart).
+    agent.chats = chat_states.setdefault(client_key, {})
+    agent.sent_index = SentMessageIndex(sent_messages_store, session_key(*client_key))
+    agent.read_cursor = read_cursors.open(session_key(*client_key))
+    # Where each chat's gap starts, taken before the handlers below can move the cursor.
+    catch_up_floors = agent.read_cursor.snapshot()
+    agents[client_key] = agent
+
+    chat_groups_data = await read_chat_groups()
+    user_chat_groups = chat_groups_data.get(str(agent.user_id), {}).get('linked_accounts', [])
+    agent.set_chat_groups(next((acc for acc in user_chat_groups if int(acc['telegram_id']) == agent.telegram_id), None))
+
+    agent.events = EventQueue(
+        lambda evt, agent=agent: handle_linked_user_message(evt, agent),
+        workers=EVENT_WORKERS, maxsize=EVENT_QUEUE_SIZE, policy=EVENT_DROP_POLICY,
+        is_priority=lambda evt, agent=agent: is_reply_to_account(agent, evt),
+        on_drop=lambda evt, reason, priority, agent=agent: record_dropped_event(agent, evt, reason, priority),
+        name=f"{agent.user_id}:{agent.telegram_id}",
+    )
+    agent.events.start()
+
+    @client.on(events.NewMessage(incoming=True, outgoing=False))
+    async def client_event_handler(evt, agent=agent):
+        if evt.chat_id in agent.chat_group_ids:
+            agent.events.put(evt)
+
+    @client.on(events.NewMessage(outgoing=True))
+    async def client_outgoing_handler(evt, agent=agent):
+        if evt.chat_id in agent.chat_group_ids:
+            agent.sent_index.add(evt.chat_id, evt.id)
+
+    agent.autopost = asyncio.create_task(autopost_task(agent))
+    agent.task = asyncio.create_task(client.run_until_disconnected())
+    client_supervisor.track(client_key)
+    catch_up.start(agent, catch_up_floors)
+    return agent
+
+
+async def stop_linked_client(client_key):
+    """Disconnect a linked client and cancel its tasks. Callers hold clients_lock."""
+    agent = agents.pop(client_key, None)
+    catch_up.cancel(client_key)
+    if agent:
+        agent.cancel_tasks()
+        await read_cursors.close(session_key(*client_key))
+        await agent.client.disconnect()
+
+
+def is_reply_to_account(agent, event):
+    """Cheap check, from the sent-message index only, for whether an event replies to this account."""
+    message = event.message
+    return bool(message.reply_to_msg_id) and agent.sent_index.lookup(event.chat_id, message.reply_to_msg_id) is True
+
+
+def record_dropped_event(agent, event, reason, priority):
+    """
+    Record an event the client's queue dropped as a trace, so overload shows
+    up in /traces. Drops of messages not known to reply to the account get
+    their own `_chatter` reason and stay out of the action log.
+    """
+    if not priority:
+        reason = f"{reason}_chatter"
+    trace = tracer.start(
+        'reply', owner_id=agent.user_id, telegram_id=agent.telegram_id, chat_id=event.chat_id, message_id=event.message.id
+    )
+    trace.drop(reason)
+    trace.end()
+
+
+def is_client_running(client_key, session_string):
+    agent = agents.get(client_key)
+    return agent is not None and agent.session_string == session_string and agent.is_running()
+
+
+def dormant_reason(client_key, account, active_keys):
+    """Why a linked account should stay disconnected, or None if it should be connected."""
+    if not DORMANT_ACCOUNTS:
+        return None
+    if account.get('paused'):
+        return 'paused'
+    # An account whose telegram_id isn't known yet is connected once to learn it.
+    if client_key[1] and client_key not in active_keys:
+        return 'no_chat_groups'
+    return None
+
+
+def accounts_with_chat_groups(chat_groups_data):
+    return {
+        (int(user_id), int(account['telegram_id']))
+        for user_id, data in chat_groups_data.items()
+        for account in data.get('linked_accounts', [])
+        if account.get('chat_groups')
+    }
+
+
+async def connect_on_demand(user_id, telegram_id):
+    """
+    The agent for an owner action that needs the account's client, connecting
+    a dormant account if necessary. Returns None for paused or unknown accounts.
+    """
+    client_key = (int(user_id), int(telegram_id))
+    agent = agents.get(client_key)
+    if agent is not None:
+        return agent
+    async with clients_lock:
+        # Another caller may have connected it while we waited for the lock.
+        agent = agents.get(client_key)
+        if agent is not None:
+            return agent
+        account = await find_linked_account(user_id, telegram_id)
+        if not account or not account.get('session_string') or account.get('paused'):
+            return None
+        agent = await start_linked_client(user_id, dict(account))
+        if agent is not None:
+            agent.on_demand_at = time.monotonic()
+            dormant_accounts.pop(client_key, None)
+            log.info("Connected dormant account on demand", user_id=user_id, telegram_id=telegram_id)
+        return agent
+
+
 async def initialize_linked_user_clients():
-    global linked_user_clients, client_tasks
-    existing_client_keys = set(linked_user_clients.keys())
+    """
+    Start clients for linked accounts that should be connected and aren't yet,
+    and stop clients for removed, paused or group-less (dormant) accounts.
+    """
+    async with clients_lock:
+        await _reconcile_linked_user_clients()
+
+
+async def _reconcile_linked_user_clients():
+    existing_client_keys = set(agents.keys())
     new_client_keys = set()
-    current_user_data = load_user_data()
+    current_user_data = await read_user_data()
+    active_keys = accounts_with_chat_groups(await read_chat_groups())
+    now = time.monotonic()
+    telegram_id_updates = {}
+    dormant_accounts.clear()
     for user_id, data in current_user_data.items():
         for account in data.get('linked_accounts', []):
             session_string = account.get('session_string')
             if not session_string:
                 continue
-            client = TelegramClient(StringSession(session_string), api_id, api_hash)
-            client.user_id = int(user_id)
-            client.session_string = session_string
-            await client.connect()
-            if not await client.is_user_authorized():
-                logging.warning(f"Client for {account.get('telegram_id')} not authorized.")
+            known_key = (int(user_id), int(account.get('telegram_id', 0)))
+            reason = dormant_reason(known_key, account, active_keys)
+            if reason is not None:
+                agent = agents.get(known_key)
+                if (reason == 'no_chat_groups' and agent is not None and agent.on_demand_at is not None
+                        and now - agent.on_demand_at < DORMANT_GRACE and is_client_running(known_key, session_string)):
+                    # Connected for an owner action (e.g. adding its first group); give it time.
+                    new_client_keys.add(known_key)
+                else:
+                    dormant_accounts[known_key] = reason
                 continue
-            client.user_start_time = datetime.datetime.now(datetime.timezone.utc)
-            client.me = await client.get_me()
-            client.telegram_id = client.me.id
-
-            if int(account.get('telegram_id', 0)) != client.telegram_id:
-                account['telegram_id'] = client.telegram_id
-                save_user_data(current_user_data)
-                logging.info(f"Updated telegram_id for user {user_id}")
-
-            client_key = (client.user_id, client.telegram_id)
-            new_client_keys.add(client_key)
-            linked_user_clients[client_key] = client
-
-            chat_groups_data = load_chat_groups()
-            user_chat_groups = chat_groups_data.get(str(client.user_id), {}).get('linked_accounts', [])
-            linked_account = next((acc for acc in user_chat_groups if int(acc['telegram_id']) == client.telegram_id), None)
-            if linked_account:
-                client.chat_group_ids = [int(group['chat_group_id']) for group in linked_account.get('chat_groups', [])]
-            else:
-                client.chat_group_ids = []
-
-            @client.on(events.NewMessage(incoming=True, outgoing=False))
-            async def client_event_handler(evt, client=client):
-                if evt.chat_id in client.chat_group_ids:
-                    await handle_linked_user_message(evt, client.user_id)
-
-            asyncio.create_task(autopost_task(client))
-            client_task = asyncio.create_task(client.run_until_disconnected())
-            client_tasks[client_key] = client_task
+            if is_client_running(known_key, session_string):
+                if known_key in active_keys:
+                    agents[known_key].on_demand_at = None
+                new_client_keys.add(known_key)
+                continue
+            if known_key in agents:
+                # Relinked with a different session string, or its update loop has ended.
+                await stop_linked_client(known_key)
+
+            # start_linked_client fills in the real telegram_id, so hand it a copy of the shared snapshot.
+            account = dict(account)
+            agent = await start_linked_client(user_id, account)
+            if agent is None:
+                continue
+            if known_key[1] != account['telegram_id']:
+                telegram_id_updates[(user_id, session_string)] = account['telegram_id']
+            new_client_keys.add(agent.key)
+
+    if telegram_id_updates:
+        # Applied against the latest document, since other handlers may have saved while clients were starting.
+        async with user_store.transaction() as latest_user_data:
+            for user_id, data in latest_user_data.items():
+                for account in data.get('linked_accounts', []):
+                    telegram_id = telegram_id_updates.get((user_id, account.get('session_string')))
+                    if telegram_id is not None:
+                        account['telegram_id'] = telegram_id
 
     for client_key in existing_client_keys - new_client_keys:
-        client = linked_user_clients[client_key]
-        await client.disconnect()
-        del linked_user_clients[client_key]
-        if client_key in client_tasks:
-            client_tasks[client_key].cancel()
-            del client_tasks[client_key]
-        logging.debug(f"Removed client {client_key}")
+        await stop_linked_client(client_key)
+        log.debug("Removed client", client_key=client_key, dormant=dormant_accounts.get(client_key))
+    if dormant_accounts:
+        log.info("Linked accounts", connected=len(agents), dormant=len(dormant_accounts))
 
 
 async def initialize_bot_tasks():
@@ -1210,9 +2200,16 @@ async def initialize_bot_tasks():
 
 
 async def main():
+    if hasattr(signal, 'SIGUSR1'):
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, log_memory_report)
+        except NotImplementedError:
+            pass
     await initialize_bot_tasks()
     tasks = [
         asyncio.create_task(check_for_updates()),
+        asyncio.create_task(client_supervisor.run()),
+        asyncio.create_task(read_cursors.run()),
     ]
     tasks.append(asyncio.create_task(bot.run_until_disconnected()))
     await asyncio.gather(*tasks)
@@ -1220,11 +2217,18 @@ async def main():
 
 if __name__ == "__main__":
     try:
-        logging.info("Starting the bot...")
+        log.info("Starting the bot...")
         asyncio.run(main())
     except KeyboardInterrupt:
-        logging.info("Bot stopped manually.")
+        log.info("Bot stopped manually.")
     except Exception as e:
-        logging.error(f"Error occurred: {e}")
+        log.error("Error occurred", error=e)
     finally:
-        logging.info("Bot is shutting down.")
+        # Let session and store writes still queued in the thread pool finish first.
+        store_executor.shutdown(wait=True)
+        flush_stores()
+        tracer.flush()
+        action_log.flush()
+        session_db.close()
+        log.info("Bot is shutting down.")
+        stop_logging()
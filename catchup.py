@@ -0,0 +1,217 @@
+import asyncio
+import datetime
+from collections import Counter
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+class MissedMessage:
+    """A message fetched by catch-up, shaped like the NewMessage events the event queues carry."""
+
+    __slots__ = ('message', 'chat_id')
+
+    def __init__(self, message):
+        self.message = message
+        self.chat_id = message.chat_id
+
+
+class ReadCursor:
+    """
+    Last processed message ID per chat for one linked account, persisted (by
+    ReadCursors) so that after a restart or disconnect the account knows where
+    each chat's gap starts.
+    """
+
+    def __init__(self, store, key):
+        self.key = key
+        self.dirty = False
+        self._ids = {int(chat_id): message_id for chat_id, message_id in (store.get(key) or {}).items()}
+
+    def get(self, chat_id):
+        return self._ids.get(chat_id)
+
+    def snapshot(self):
+        return dict(self._ids)
+
+    def advance(self, chat_id, message_id):
+        if message_id > self._ids.get(chat_id, 0):
+            self._ids[chat_id] = message_id
+            self.dirty = True
+
+    def export(self):
+        return {str(chat_id): message_id for chat_id, message_id in self._ids.items()}
+
+
+class ReadCursors:
+    """
+    The read cursors of all running clients, written together: every
+    `interval` seconds the cursors that moved go to the store in one batched
+    write, rather than one timer and write per client. A cursor lost in a
+    crash only makes catch-up refetch messages the handler already saw.
+    """
+
+    def __init__(self, store, interval=10.0):
+        self.store = store
+        self.interval = interval
+        self._cursors = {}  # {key: ReadCursor}
+        self.stats = Counter()
+
+    def open(self, key):
+        cursor = ReadCursor(self.store, key)
+        self._cursors[key] = cursor
+        return cursor
+
+    async def close(self, key):
+        """Stop tracking a stopped client's cursor, writing it if it moved."""
+        cursor = self._cursors.pop(key, None)
+        if cursor is not None and cursor.dirty:
+            cursor.dirty = False
+            await self.store.aput(key, cursor.export())
+
+    def _take_moved(self):
+        moved = {}
+        for key, cursor in self._cursors.items():
+            if cursor.dirty:
+                cursor.dirty = False
+                moved[key] = cursor.export()
+        return moved
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            moved = self._take_moved()
+            if not moved:
+                continue
+            try:
+                await self.store.aput_many(moved)
+                self.stats['writes'] += 1
+                self.stats['cursors_written'] += len(moved)
+            except Exception as e:
+                for key in moved:
+                    if key in self._cursors:
+                        self._cursors[key].dirty = True  # retried next round
+                log.error("Failed to persist read cursors", cursors=len(moved), error=e)
+
+    def flush(self):
+        """Write the cursors that moved now (on shutdown)."""
+        moved = self._take_moved()
+        if moved:
+            self.store.put_many(moved)
+
+    def report(self):
+        return dict(self.stats, tracked=len(self._cursors))
+
+
+class CatchUp:
+    """
+    Replays replies that reached a linked account while it was offline.
+
+    Each client gets one pass when it connects or reconnects: for each of its
+    chats with a read cursor, it fetches only the messages after the cursor,
+    newest first, at most `max_messages` per chat and none older than
+    `max_age` seconds. It keeps the replies from other users that arrived
+    before the client came online (later ones reach the live handler) and
+    feeds them, oldest first, into the client's event queue at `rate` per
+    second, so they go through the normal reply pipeline without a burst.
+    Replies whose target isn't in the sent-message index are resolved with
+    one batched fetch per chat. Only the newest `await reply_budget(agent,
+    chat_id)` replies to the account are kept per chat (what the chat's reply
+    limit still allows). At most `max_concurrent` passes fetch history at once.
+    """
+
+    def __init__(self, max_messages=200, max_age=21600.0, rate=1.0, max_concurrent=4, reply_budget=None):
+        self.reply_budget = reply_budget
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.rate = rate
+        self.slots = asyncio.Semaphore(max_concurrent)
+        self._passes = {}  # {client_key: task}
+        self.stats = Counter()
+
+    def start(self, agent, floors):
+        """Start (or restart) the pass for `agent` from `floors` ({chat_id: last processed message ID})."""
+        if not self.max_messages:
+            return
+        self.cancel(agent.key)
+        if not any(chat_id in floors for chat_id in agent.chat_group_ids):
+            return
+        task = asyncio.create_task(self._run(agent, floors, agent.started_at))
+        self._passes[agent.key] = task
+        task.add_done_callback(lambda t, key=agent.key: self._passes.pop(key, None) if self._passes.get(key) is t else None)
+
+    def reconnected(self, agent):
+        """After a reconnect, hand the live handler everything from now on and catch up on the gap."""
+        agent.started_at = datetime.datetime.now(datetime.timezone.utc)
+        self.start(agent, agent.read_cursor.snapshot())
+
+    def cancel(self, client_key):
+        task = self._passes.pop(client_key, None)
+        if task is not None:
+            task.cancel()
+
+    async def _run(self, agent, floors, until):
+        missed = []
+        async with self.slots:
+            for chat_id in agent.chat_group_ids:
+                floor = floors.get(chat_id)
+                if floor is None:
+                    continue
+                try:
+                    replies = await self._fetch(agent, chat_id, floor, until)
+                    if replies and self.reply_budget is not None:
+                        budget = await self.reply_budget(agent, chat_id)
+                        self.stats['over_limit'] += len(replies) - min(budget, len(replies))
+                        replies = replies[:budget]  # newest first
+                    missed.extend(replies)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    log.warning("Catch-up fetch failed", client_key=agent.key, chat_id=chat_id, error=e)
+        self.stats['passes'] += 1
+        if missed:
+            log.info("Catching up on missed replies", client_key=agent.key, messages=len(missed))
+        missed.sort(key=lambda message: message.date)
+        for message in missed:
+            agent.events.put(MissedMessage(message))
+            self.stats['queued'] += 1
+            await asyncio.sleep(1 / self.rate)
+
+    async def _fetch(self, agent, chat_id, floor, until):
+        """The chat's missed replies to the account, newest first."""
+        oldest = until - datetime.timedelta(seconds=self.max_age)
+        replies = []
+        unknown = set()
+        # iter_messages fetches in batches of up to 100 and stops at the cursor or the limit.
+        async for message in agent.client.iter_messages(chat_id, min_id=floor, limit=self.max_messages):
+            if message.date < oldest:
+                break
+            self.stats['fetched'] += 1
+            if message.date >= until or not message.reply_to_msg_id or message.sender_id == agent.telegram_id:
+                continue
+            mine = agent.sent_index.lookup(chat_id, message.reply_to_msg_id)
+            if mine is False:
+                continue  # known to reply to someone else
+            if mine is None:
+                unknown.add(message.reply_to_msg_id)
+            replies.append(message)
+        if unknown:
+            mine = await self._resolve(agent, chat_id, sorted(unknown))
+            replies = [message for message in replies
+                       if message.reply_to_msg_id not in unknown or message.reply_to_msg_id in mine]
+        return replies
+
+    async def _resolve(self, agent, chat_id, message_ids):
+        """Which of the replied-to messages the account sent, fetched in batches of 100."""
+        mine = set()
+        for start in range(0, len(message_ids), 100):
+            originals = await agent.client.get_messages(chat_id, ids=message_ids[start:start + 100])
+            self.stats['resolved'] += len(originals)
+            for original in originals:
+                if original is not None and original.sender_id == agent.telegram_id:
+                    mine.add(original.id)
+                    agent.sent_index.remember(chat_id, original.id)
+        return mine
+
+    def report(self):
+        return dict(self.stats, running=len(self._passes))
@@ -0,0 +1,95 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+from telethon.tl import types
+
+
+class MessageWork:
+    """Work shared by every local client that received the same message."""
+
+    __slots__ = ('created', 'results', 'claims', 'coordinator')
+
+    def __init__(self, coordinator):
+        self.coordinator = coordinator
+        self.created = time.monotonic()
+        self.results = {}  # {name: task}
+        self.claims = set()
+
+    async def once(self, name, factory):
+        """
+        Run `factory()` for the first client that asks and hand every client the
+        same result. A failure is not cached, so the next client tries again.
+        """
+        task = self.results.get(name)
+        if task is None:
+            task = self.results[name] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda t: self._forget_failure(name, t))
+            self.coordinator.stats['computed'] += 1
+        else:
+            self.coordinator.stats['shared'] += 1
+        # Shielded so one client's handler being cancelled doesn't cancel the work for the others.
+        return await asyncio.shield(task)
+
+    def _forget_failure(self, name, task):
+        if task.cancelled() or task.exception() is not None:
+            if self.results.get(name) is task:
+                del self.results[name]
+
+    def claim(self, name):
+        """Return True for the first client to claim `name` (e.g. the reply) and False afterwards."""
+        if name in self.claims:
+            self.coordinator.stats['claims_denied'] += 1
+            return False
+        self.claims.add(name)
+        return True
+
+
+class ChatCoordinator:
+    """
+    Lets linked clients that sit in the same chat share the work for each
+    incoming message: the first client to handle (chat_id, message_id)
+    computes the sender lookup, message checks, membership check and
+    replied-to message fetch, and the rest reuse the results; only one
+    client may claim the LLM reply.
+
+    Only channel and supergroup messages are shared. Message IDs in basic
+    groups are numbered per account, so each client gets private work there.
+    Entries are dropped `ttl` seconds after the message first arrived.
+    """
+
+    def __init__(self, ttl=300.0):
+        self.ttl = ttl
+        self._work = OrderedDict()  # {(chat_id, message_id): MessageWork}, oldest first
+        self.stats = {'messages': 0, 'computed': 0, 'shared': 0, 'claims_denied': 0, 'private': 0}
+
+    def message(self, message):
+        if not isinstance(message.peer_id, types.PeerChannel):
+            self.stats['private'] += 1
+            return MessageWork(self)
+
+        self._expire()
+        key = (message.chat_id, message.id)
+        work = self._work.get(key)
+        if work is None:
+            work = self._work[key] = MessageWork(self)
+            self.stats['messages'] += 1
+        return work
+
+    def _expire(self):
+        cutoff = time.monotonic() - self.ttl
+        while self._work:
+            key, work = next(iter(self._work.items()))
+            if work.created > cutoff:
+                break
+            del self._work[key]
+
+    def size(self):
+        return len(self._work)
+
+    def snapshot(self):
+        """The tracked message work ({(chat_id, message_id): MessageWork}); read-only."""
+        return self._work
+
+    def report(self):
+        return dict(self.stats, tracked=self.size())
@@ -0,0 +1,107 @@
+import asyncio
+from collections import deque
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+DROP_OLDEST = 'oldest'
+KEEP_PRIORITY = 'keep_replies'
+DROP_POLICIES = (DROP_OLDEST, KEEP_PRIORITY)
+
+
+class EventQueue:
+    """
+    Bounded queue of incoming events for one linked client, drained by a
+    small pool of worker tasks instead of one coroutine per event.
+
+    When `maxsize` events are waiting, one is dropped according to `policy`:
+    'oldest' drops the oldest waiting event; 'keep_replies' drops the oldest
+    event that `is_priority` doesn't flag (replies to this account), and the
+    incoming one if every waiting event is a priority event and it isn't.
+    `on_drop(event, reason, priority)` is called for every dropped event.
+    """
+
+    def __init__(self, handler, workers=2, maxsize=100, policy=KEEP_PRIORITY, is_priority=None, on_drop=None, name=''):
+        if policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy: {policy}")
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.policy = policy
+        self.is_priority = is_priority or (lambda event: False)
+        self.on_drop = on_drop
+        self.name = name
+        self._items = deque()  # [(event, is_priority)]
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+        self.stats = {'received': 0, 'processed': 0, 'dropped': 0, 'dropped_priority': 0, 'errors': 0, 'max_depth': 0}
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        self._tasks = []
+        self._items.clear()
+
+    def put(self, event):
+        """Queue an event; never blocks. Returns False if the event itself was dropped."""
+        self.stats['received'] += 1
+        priority = bool(self.is_priority(event))
+        if len(self._items) >= self.maxsize and not self._make_room(priority):
+            self._dropped(event, priority, 'queue_full')
+            return False
+        self._items.append((event, priority))
+        self.stats['max_depth'] = max(self.stats['max_depth'], len(self._items))
+        self._wakeup.set()
+        return True
+
+    def _make_room(self, incoming_priority):
+        if self.policy == DROP_OLDEST:
+            event, priority = self._items.popleft()
+            self._dropped(event, priority, 'queue_full_oldest')
+            return True
+        for index, (event, priority) in enumerate(self._items):
+            if not priority:
+                del self._items[index]
+                self._dropped(event, priority, 'queue_full_oldest')
+                return True
+        if incoming_priority:
+            # Only priority events are waiting; the oldest of them gives way to the newest.
+            event, priority = self._items.popleft()
+            self._dropped(event, priority, 'queue_full_oldest')
+            return True
+        return False
+
+    def _dropped(self, event, priority, reason):
+        self.stats['dropped'] += 1
+        if priority:
+            self.stats['dropped_priority'] += 1
+        log.info("Dropped incoming event", queue=self.name, reason=reason, priority=priority, _every=10)
+        if self.on_drop is not None:
+            self.on_drop(event, reason, priority)
+
+    async def _worker(self):
+        while True:
+            while not self._items:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            event, _ = self._items.popleft()
+            try:
+                await self.handler(event)
+            except Exception as e:
+                self.stats['errors'] += 1
+                log.error("Error handling queued event", queue=self.name, error=e)
+            self.stats['processed'] += 1
+
+    def size(self):
+        return len(self._items)
+
+    def snapshot(self):
+        """The queued events, oldest first."""
+        return [event for event, _ in self._items]
+
+    def report(self):
+        return dict(self.stats, depth=self.size(), workers=len(self._tasks))
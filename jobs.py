@@ -0,0 +1,121 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+class TooManyJobs(Exception):
+    """Raised when an owner already has the maximum number of jobs in flight."""
+
+
+class Job:
+    """One background job. `wait()` returns its result or raises its error."""
+
+    __slots__ = ('job_id', 'owner', 'key', 'status', 'created', 'finished', 'task')
+
+    def __init__(self, owner, key):
+        self.job_id = uuid.uuid4().hex[:8]
+        self.owner = owner
+        self.key = key
+        self.status = 'queued'
+        self.created = time.monotonic()
+        self.finished = None
+        self.task = None
+
+    async def wait(self):
+        return await asyncio.shield(self.task)
+
+    @property
+    def done(self):
+        return self.status in ('done', 'failed')
+
+
+class JobQueue:
+    """
+    Runs slow per-user work (Personality Helper generations) as background
+    jobs so the handler that submitted it returns right away.
+
+    Jobs are deduplicated by `key` (e.g. a hash of the input): submitting a
+    key that is already running, or finished less than `result_ttl` seconds
+    ago, returns the existing job instead of starting another. Each owner may
+    have at most `max_per_owner` jobs in flight, and at most `max_running`
+    jobs run at once across all owners.
+    """
+
+    def __init__(self, max_per_owner=2, max_running=4, result_ttl=3600.0, max_results=256):
+        self.max_per_owner = max_per_owner
+        self.result_ttl = result_ttl
+        self.max_results = max_results
+        self._slots = asyncio.Semaphore(max_running)
+        self._jobs = OrderedDict()  # {key: Job}, oldest first
+        self._watchers = set()
+        self.stats = {'submitted': 0, 'deduplicated': 0, 'rejected': 0, 'done': 0, 'failed': 0}
+
+    def in_flight(self, owner):
+        return sum(1 for job in self._jobs.values() if job.owner == owner and not job.done)
+
+    def submit(self, owner, key, factory):
+        """
+        Start `factory()` as a job, or return the existing job for `key`.
+        Returns (job, is_new). Raises TooManyJobs if the owner is at its limit.
+        """
+        self._expire()
+        job = self._jobs.get(key)
+        if job is not None and job.status != 'failed':
+            self.stats['deduplicated'] += 1
+            return job, False
+        if self.in_flight(owner) >= self.max_per_owner:
+            self.stats['rejected'] += 1
+            raise TooManyJobs(f"{self.in_flight(owner)} jobs already running")
+
+        job = Job(owner, key)
+        job.task = asyncio.create_task(self._run(job, factory))
+        self._jobs[key] = job
+        self._jobs.move_to_end(key)
+        self.stats['submitted'] += 1
+        return job, True
+
+    async def _run(self, job, factory):
+        async with self._slots:
+            job.status = 'running'
+            try:
+                result = await factory()
+            except Exception as e:
+                job.status = 'failed'
+                self.stats['failed'] += 1
+                log.warning("Background job failed", job_id=job.job_id, owner=job.owner, error=e)
+                raise
+            finally:
+                job.finished = time.monotonic()
+        job.status = 'done'
+        self.stats['done'] += 1
+        return result
+
+    def watch(self, job, callback):
+        """Run `await callback(job)` once the job finishes, however many watchers it has."""
+        async def notify():
+            try:
+                await asyncio.wait([job.task])
+                await callback(job)
+            except Exception as e:
+                log.error("Error delivering job result", job_id=job.job_id, error=e)
+
+        watcher = asyncio.create_task(notify())
+        self._watchers.add(watcher)
+        watcher.add_done_callback(self._watchers.discard)
+
+    def _expire(self):
+        now = time.monotonic()
+        for key, job in list(self._jobs.items()):
+            if job.done and (now - job.finished > self.result_ttl or len(self._jobs) > self.max_results):
+                del self._jobs[key]
+
+    def report(self):
+        statuses = {}
+        for job in self._jobs.values():
+            statuses[job.status] = statuses.get(job.status, 0) + 1
+        return dict(self.stats, jobs=statuses)
@@ -0,0 +1,468 @@
+import asyncio
+import json
+import random
+import time
+import urllib.error
+import urllib.request
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+class BatchingNotSupported(Exception):
+    """Raised by a backend whose server rejected a batched request."""
+
+
+class PlaceholderBackend:
+    """
+    Stand-in for your custom LLM. Used when no LLM_ENDPOINT is configured;
+    returns a made-up, short response.
+    """
+
+    supports_batching = True
+
+    fake_responses = [
+        "Sure, I'll keep that in mind.",
+        "Absolutely, no problem!",
+        "Alright, consider it done.",
+        "Got it."
+    ]
+
+    async def generate(self, request):
+        return random.choice(self.fake_responses)
+
+    async def generate_batch(self, requests):
+        return [random.choice(self.fake_responses) for _ in requests]
+
+
+class HTTPBackend:
+    """
+    Calls a self-hosted model server over HTTP.
+
+    Single requests are POSTed as {"personality": ..., "input_text": ...} and
+    must return {"response": ...}. Batched requests are POSTed to the same URL
+    as {"batch": [<single request>, ...]} and must return {"responses": [...]}
+    in the same order. If the server rejects the batch format, batching is
+    switched off for this backend and requests are sent one by one.
+
+    Requests built from a chat group template also carry "system_prompt".
+    With `prompt_cache` enabled they add a "cache" object (prefix_id,
+    prefix_hash, cache_prompt and optionally id_slot) so servers with prompt
+    caching can reuse the prefilled personality prefix.
+    """
+
+    def __init__(self, url, timeout=60, prompt_cache=False):
+        self.url = url
+        self.timeout = timeout
+        self.prompt_cache = prompt_cache
+        self.supports_batching = True
+
+    def _post(self, payload):
+        req = urllib.request.Request(
+            self.url,
+            data=json.dumps(payload).encode('utf-8'),
+            headers={'Content-Type': 'application/json'},
+        )
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            return json.loads(resp.read().decode('utf-8'))
+
+    async def generate(self, request):
+        result = await asyncio.to_thread(self._post, request.payload(self.prompt_cache))
+        return result["response"]
+
+    async def generate_batch(self, requests):
+        try:
+            result = await asyncio.to_thread(self._post, {"batch": [r.payload(self.prompt_cache) for r in requests]})
+        except urllib.error.HTTPError as e:
+            if e.code in (400, 404, 405, 422, 501):
+                raise BatchingNotSupported(f"{self.url} returned HTTP {e.code} for a batch")
+            raise
+        responses = result.get("responses") if isinstance(result, dict) else None
+        if not isinstance(responses, list) or len(responses) != len(requests):
+            raise BatchingNotSupported(f"{self.url} returned no usable 'responses' list")
+        return responses
+
+
+class NoHealthyEndpoint(Exception):
+    """Raised when every configured LLM endpoint has an open circuit breaker."""
+
+
+class CircuitBreaker:
+    """
+    Per-endpoint circuit breaker.
+
+    After `failure_threshold` consecutive failures the breaker opens and the
+    endpoint gets no traffic for `reset_timeout` seconds. It then goes
+    half-open and lets a single probe request through: success closes it,
+    failure opens it again with the timeout doubled (up to `max_reset_timeout`).
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0, max_reset_timeout=600.0):
+        self.failure_threshold = failure_threshold
+        self.base_reset_timeout = reset_timeout
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+        self.times_opened = 0
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+        if self.state == self.HALF_OPEN and not self.probe_in_flight:
+            return True
+        return False
+
+    def on_start(self):
+        if self.state == self.HALF_OPEN:
+            self.probe_in_flight = True
+
+    def on_success(self):
+        if self.state != self.CLOSED:
+            log.info("LLM endpoint recovered; closing circuit breaker")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+        self.reset_timeout = self.base_reset_timeout
+
+    def on_failure(self):
+        self.consecutive_failures += 1
+        if self.state == self.HALF_OPEN:
+            self.reset_timeout = min(self.reset_timeout * 2, self.max_reset_timeout)
+            self._open()
+        elif self.state == self.CLOSED and self.consecutive_failures >= self.failure_threshold:
+            self._open()
+        self.probe_in_flight = False
+
+    def on_abandoned(self):
+        # A hedged attempt that lost the race says nothing about the endpoint's health.
+        self.probe_in_flight = False
+
+    def _open(self):
+        self.state = self.OPEN
+        self.opened_at = time.monotonic()
+        self.times_opened += 1
+
+
+class LatencyTracker:
+    """EWMA plus a window of recent samples for percentile estimates."""
+
+    def __init__(self, window=200, alpha=0.2):
+        self.samples = []
+        self.window = window
+        self.alpha = alpha
+        self.ewma = None
+
+    def record(self, seconds):
+        self.ewma = seconds if self.ewma is None else self.alpha * seconds + (1 - self.alpha) * self.ewma
+        self.samples.append(seconds)
+        if len(self.samples) > self.window:
+            del self.samples[0]
+
+    def percentile(self, pct):
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+class Endpoint:
+    """A backend together with its breaker, latency stats and in-flight count."""
+
+    def __init__(self, name, backend, breaker):
+        self.name = name
+        self.backend = backend
+        self.breaker = breaker
+        self.latency = LatencyTracker()
+        self.in_flight = 0
+        self.stats = {'requests': 0, 'failures': 0, 'timeouts': 0, 'hedges_sent': 0, 'hedges_won': 0}
+
+    def score(self):
+        # Unmeasured endpoints score 0 so they get explored; busy endpoints are penalised.
+        return (self.latency.ewma or 0.0) * (1 + self.in_flight)
+
+
+class EndpointPool:
+    """
+    Spreads LLM calls over several endpoints.
+
+    Each call goes to the healthy endpoint with the lowest latency score. If
+    it hasn't answered after that endpoint's `hedge_percentile` latency, a
+    duplicate is sent to the next best endpoint and whichever answers first
+    wins; the other is cancelled. Failing endpoints are taken out of rotation
+    by their circuit breaker. The pool itself looks like a backend, so it
+    plugs straight into LLMDispatcher.
+    """
+
+    def __init__(self, endpoints, timeout=60.0, hedge_percentile=95, hedge_min_delay=0.5, min_samples=10):
+        self.endpoints = endpoints
+        self.timeout = timeout
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_delay = hedge_min_delay
+        self.min_samples = min_samples
+        self.stats = {'calls': 0, 'hedged_calls': 0, 'hedge_wins': 0, 'no_healthy_endpoint': 0}
+
+    @property
+    def supports_batching(self):
+        return any(getattr(ep.backend, 'supports_batching', False) for ep in self.endpoints)
+
+    @supports_batching.setter
+    def supports_batching(self, value):
+        # Batching support is tracked per endpoint in _attempt; nothing to switch off pool-wide.
+        pass
+
+    def _select(self, exclude=(), batch=False):
+        candidates = [
+            ep for ep in self.endpoints
+            if ep not in exclude
+            and (not batch or getattr(ep.backend, 'supports_batching', False))
+            and ep.breaker.allow()
+        ]
+        if not candidates:
+            return None
+        return min(candidates, key=lambda ep: ep.score())
+
+    def _hedge_delay(self, endpoint):
+        if len(endpoint.latency.samples) < self.min_samples:
+            return max(self.hedge_min_delay, self.timeout / 4)
+        return max(self.hedge_min_delay, endpoint.latency.percentile(self.hedge_percentile))
+
+    async def _attempt(self, endpoint, method, arg):
+        endpoint.breaker.on_start()
+        endpoint.in_flight += 1
+        endpoint.stats['requests'] += 1
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(getattr(endpoint.backend, method)(arg), self.timeout)
+        except asyncio.CancelledError:
+            endpoint.breaker.on_abandoned()
+            raise
+        except BatchingNotSupported:
+            endpoint.backend.supports_batching = False
+            endpoint.breaker.on_abandoned()
+            raise
+        except asyncio.TimeoutError:
+            endpoint.stats['timeouts'] += 1
+            endpoint.stats['failures'] += 1
+            endpoint.breaker.on_failure()
+            raise
+        except Exception:
+            endpoint.stats['failures'] += 1
+            endpoint.breaker.on_failure()
+            raise
+        finally:
+            endpoint.in_flight -= 1
+        endpoint.latency.record(time.monotonic() - started)
+        endpoint.breaker.on_success()
+        return result
+
+    async def _call(self, method, arg, batch=False):
+        self.stats['calls'] += 1
+        tried = set()
+        hedges = set()
+        tasks = {}
+        hedge_deadline = None
+        last_error = None
+        try:
+            while True:
+                if not tasks:
+                    # First attempt, or everything in flight failed: fail over to the next best endpoint.
+                    endpoint = self._select(exclude=tried, batch=batch)
+                    if endpoint is None:
+                        break
+                    tried.add(endpoint)
+                    tasks[asyncio.create_task(self._attempt(endpoint, method, arg))] = endpoint
+                    if not hedges:
+                        hedge_deadline = time.monotonic() + self._hedge_delay(endpoint)
+
+                timeout = None
+                if hedge_deadline is not None:
+                    timeout = max(0.0, hedge_deadline - time.monotonic())
+                done, _ = await asyncio.wait(tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                if not done:
+                    # Slower than this endpoint's usual tail latency: send one hedged duplicate.
+                    hedge_deadline = None
+                    secondary = self._select(exclude=tried, batch=batch)
+                    if secondary is not None:
+                        tried.add(secondary)
+                        hedges.add(secondary)
+                        self.stats['hedged_calls'] += 1
+                        secondary.stats['hedges_sent'] += 1
+                        tasks[asyncio.create_task(self._attempt(secondary, method, arg))] = secondary
+                    continue
+
+                for task in done:
+                    endpoint = tasks.pop(task)
+                    if task.exception() is None:
+                        if endpoint in hedges:
+                            self.stats['hedge_wins'] += 1
+                            endpoint.stats['hedges_won'] += 1
+                        return task.result()
+                    last_error = task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        if last_error is None:
+            self.stats['no_healthy_endpoint'] += 1
+            if batch:
+                raise BatchingNotSupported("no healthy endpoint accepts batches")
+            raise NoHealthyEndpoint("all LLM endpoints are unavailable")
+        raise last_error
+
+    async def generate(self, request):
+        return await self._call('generate', request)
+
+    async def generate_batch(self, requests):
+        return await self._call('generate_batch', requests, batch=True)
+
+    def report(self):
+        calls = self.stats['calls']
+        endpoints = {}
+        for ep in self.endpoints:
+            p50 = ep.latency.percentile(50)
+            p95 = ep.latency.percentile(95)
+            endpoints[ep.name] = dict(
+                ep.stats,
+                breaker=ep.breaker.state,
+                times_opened=ep.breaker.times_opened,
+                in_flight=ep.in_flight,
+                ewma_ms=round(ep.latency.ewma * 1000) if ep.latency.ewma is not None else None,
+                p50_ms=round(p50 * 1000) if p50 is not None else None,
+                p95_ms=round(p95 * 1000) if p95 is not None else None,
+                hedge_delay_ms=round(self._hedge_delay(ep) * 1000),
+            )
+        return dict(
+            self.stats,
+            hedge_rate=round(self.stats['hedged_calls'] / calls, 3) if calls else 0.0,
+            endpoints=endpoints,
+        )
+
+
+class LLMRequest:
+    """One pending generation and the future its caller is waiting on."""
+
+    def __init__(self, personality, user_input, future, prompt=None):
+        self.personality = personality
+        self.user_input = user_input
+        self.future = future
+        self.prompt = prompt
+        self.enqueued_at = time.monotonic()
+
+    def payload(self, prompt_cache=False):
+        payload = {"personality": self.personality, "input_text": self.user_input}
+        if self.prompt is not None:
+            payload["system_prompt"] = self.prompt.system_prompt
+            if prompt_cache:
+                payload["cache"] = {
+                    "cache_prompt": True,
+                    "prefix_id": self.prompt.prefix_id,
+                    "prefix_hash": self.prompt.content_hash,
+                }
+                if self.prompt.slot_id is not None:
+                    payload["cache"]["id_slot"] = self.prompt.slot_id
+        return payload
+
+    def prefix_id(self):
+        return self.prompt.prefix_id if self.prompt is not None else ''
+
+
+class LLMDispatcher:
+    """
+    Collects generation requests from every linked client for up to
+    `batch_window` seconds (or until `max_batch_size` are pending), submits
+    them to the backend as one batched call and hands each caller its own
+    result. Falls back to concurrent single requests when the backend does
+    not support batching.
+    """
+
+    def __init__(self, backend, batch_window=0.05, max_batch_size=16):
+        self.backend = backend
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self._pending = []
+        self._batches = set()  # running batch tasks; the loop only keeps weak references
+        self._flush_handle = None
+        self.stats = {
+            'requests': 0,
+            'batches': 0,
+            'batched_requests': 0,
+            'single_requests': 0,
+            'batch_fallbacks': 0,
+        }
+
+    async def generate(self, personality, user_input, prompt=None):
+        loop = asyncio.get_running_loop()
+        request = LLMRequest(personality, user_input, loop.create_future(), prompt=prompt)
+        self._pending.append(request)
+        self.stats['requests'] += 1
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.batch_window, self._flush)
+
+        return await request.future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        while self._pending:
+            batch = self._pending[:self.max_batch_size]
+            del self._pending[:self.max_batch_size]
+            task = asyncio.create_task(self._run_batch(batch))
+            self._batches.add(task)
+            task.add_done_callback(self._batches.discard)
+
+    async def _run_batch(self, batch):
+        # Keep requests sharing a cached prefix next to each other in the batch.
+        batch.sort(key=LLMRequest.prefix_id)
+        if len(batch) > 1 and getattr(self.backend, 'supports_batching', False):
+            try:
+                results = await self.backend.generate_batch(batch)
+            except BatchingNotSupported as e:
+                log.warning("LLM backend does not support batching; falling back to single requests", error=e)
+                self.backend.supports_batching = False
+                self.stats['batch_fallbacks'] += 1
+            except Exception as e:
+                for request in batch:
+                    if not request.future.done():
+                        request.future.set_exception(e)
+                return
+            else:
+                self.stats['batches'] += 1
+                self.stats['batched_requests'] += len(batch)
+                for request, result in zip(batch, results):
+                    if not request.future.done():
+                        request.future.set_result(result)
+                return
+
+        await asyncio.gather(*(self._run_single(request) for request in batch))
+
+    async def _run_single(self, request):
+        self.stats['single_requests'] += 1
+        try:
+            result = await self.backend.generate(request)
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+            return
+        if not request.future.done():
+            request.future.set_result(result)
+
+    def report(self):
+        batches = self.stats['batches']
+        avg = self.stats['batched_requests'] / batches if batches else 0.0
+        return dict(self.stats, avg_batch_size=round(avg, 2), pending=len(self._pending))
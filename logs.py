@@ -0,0 +1,181 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import time
+
+# Field names whose values are never formatted into log output.
+SENSITIVE_FIELDS = frozenset({
+    'session_string', 'auth_key', 'api_hash', 'bot_token', 'token', 'phone', 'password', 'encryption_key',
+})
+REDACTED = '[redacted]'
+
+_listener = None
+dropped_records = 0
+
+
+class StructLogger:
+    """
+    Thin wrapper over a stdlib logger that takes an event name plus keyword
+    fields instead of a pre-formatted string:
+
+        log.debug("Replied", chat_id=chat_id, delay=delay)
+
+    Nothing is formatted on the calling thread: if the level is disabled the
+    call returns right away, and otherwise the fields ride along on the log
+    record and are rendered by the background listener (see
+    `configure_logging`), with SENSITIVE_FIELDS redacted. High-volume events
+    can pass `_sample=0.01` to keep a fraction of them, or `_every=60` to log
+    at most once per interval (the next record carries a `suppressed` count).
+    """
+
+    __slots__ = ('logger', '_last', '_suppressed')
+
+    def __init__(self, name):
+        self.logger = logging.getLogger(name)
+        self._last = {}
+        self._suppressed = {}
+
+    def isEnabledFor(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def _log(self, level, event, fields, sample, every, exc_info):
+        if not self.logger.isEnabledFor(level):
+            return
+        if sample is not None and random.random() >= sample:
+            return
+        if every is not None:
+            key = (level, event)
+            now = time.monotonic()
+            if now - self._last.get(key, float('-inf')) < every:
+                self._suppressed[key] = self._suppressed.get(key, 0) + 1
+                return
+            self._last[key] = now
+            suppressed = self._suppressed.pop(key, 0)
+            if suppressed:
+                fields['suppressed'] = suppressed
+        self.logger.log(level, event, exc_info=exc_info, extra={'fields': fields}, stacklevel=3)
+
+    def debug(self, event, _sample=None, _every=None, exc_info=False, **fields):
+        self._log(logging.DEBUG, event, fields, _sample, _every, exc_info)
+
+    def info(self, event, _sample=None, _every=None, exc_info=False, **fields):
+        self._log(logging.INFO, event, fields, _sample, _every, exc_info)
+
+    def warning(self, event, _sample=None, _every=None, exc_info=False, **fields):
+        self._log(logging.WARNING, event, fields, _sample, _every, exc_info)
+
+    def error(self, event, _sample=None, _every=None, exc_info=False, **fields):
+        self._log(logging.ERROR, event, fields, _sample, _every, exc_info)
+
+
+def get_logger(name):
+    return StructLogger(name)
+
+
+def _render(value):
+    text = str(value)
+    if not text or any(c.isspace() or c in '"=' for c in text):
+        return json.dumps(text)
+    return text
+
+
+class StructuredFormatter(logging.Formatter):
+    """Renders "time LEVEL name: event key=value ..." (or one JSON object per line), redacting sensitive fields."""
+
+    def __init__(self, json_lines=False):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        self.json_lines = json_lines
+
+    @staticmethod
+    def _fields(record):
+        fields = getattr(record, 'fields', None) or {}
+        return {key: REDACTED if key in SENSITIVE_FIELDS else value for key, value in fields.items()}
+
+    def format(self, record):
+        if self.json_lines:
+            fields = self._fields(record)
+            entry = {
+                'ts': round(record.created, 3),
+                'level': record.levelname,
+                'logger': record.name,
+                'event': record.getMessage(),
+            }
+            entry.update({key: value if isinstance(value, (int, float, bool, type(None))) else str(value)
+                          for key, value in fields.items()})
+            if record.exc_info:
+                entry['exc'] = self.formatException(record.exc_info)
+            return json.dumps(entry, ensure_ascii=False)
+        return super().format(record)
+
+    def formatMessage(self, record):
+        # Fields go on the first line, ahead of any traceback.
+        line = super().formatMessage(record)
+        fields = self._fields(record)
+        if fields:
+            line += ' ' + ' '.join(f"{key}={_render(value)}" for key, value in fields.items())
+        return line
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Hands records to the listener thread unformatted and drops them if the queue is full."""
+
+    def prepare(self, record):
+        # The stock handler formats here, on the caller's thread; the listener does it instead.
+        return record
+
+    def enqueue(self, record):
+        global dropped_records
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped_records += 1
+
+
+def parse_module_levels(spec):
+    """Parse "telethon=WARNING,llm=DEBUG" into {'telethon': 'WARNING', 'llm': 'DEBUG'}."""
+    levels = {}
+    for item in (spec or '').split(','):
+        if '=' in item:
+            name, level = item.split('=', 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+def configure_logging(level='INFO', module_levels=None, log_file=None, json_lines=False,
+                      max_bytes=10 * 1024 * 1024, backups=3, queue_size=10000):
+    """
+    Route all logging through a bounded queue to a background listener
+    thread that formats and writes records (to stderr, plus a rotating
+    `log_file` if given). `module_levels` maps logger names to levels.
+    """
+    global _listener
+    formatter = StructuredFormatter(json_lines=json_lines)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(log_file, maxBytes=max_bytes, backupCount=backups))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_DeferredQueueHandler(queue.Queue(maxsize=queue_size)))
+    root.setLevel(level.upper())
+    for name, module_level in (module_levels or {}).items():
+        logging.getLogger(name).setLevel(module_level)
+
+    stop_logging()
+    _listener = logging.handlers.QueueListener(root.handlers[0].queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """Write out everything still queued and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,210 @@
+import asyncio
+import gc
+import os
+import sys
+import time
+import tracemalloc
+from collections import Counter
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+# Walking a structure stops after this many objects so a report never stalls the loop for long.
+MAX_WALK_OBJECTS = 200000
+
+
+def deep_size(obj, limit=MAX_WALK_OBJECTS):
+    """
+    Approximate retained size of a container: getsizeof of it and everything
+    reachable through dicts, lists, sets, tuples and the attributes of
+    __slots__ objects (objects shared between containers are counted once).
+    Returns (bytes, objects, truncated).
+    """
+    seen = set()
+    stack = [obj]
+    total = 0
+    while stack:
+        if len(seen) >= limit:
+            return total, len(seen), True
+        current = stack.pop()
+        if id(current) in seen:
+            continue
+        seen.add(id(current))
+        total += sys.getsizeof(current)
+        if isinstance(current, dict):
+            stack.extend(current.keys())
+            stack.extend(current.values())
+        elif isinstance(current, (list, tuple, set, frozenset)):
+            stack.extend(current)
+        elif hasattr(type(current), '__slots__') and not hasattr(current, '__dict__'):
+            stack.extend(getattr(current, name) for name in type(current).__slots__ if hasattr(current, name))
+    return total, len(seen), False
+
+
+def _leaf_count(obj):
+    """Entries at the bottom of nested dicts ({a: {b: [x, y]}} -> 2)."""
+    if isinstance(obj, dict):
+        return sum(_leaf_count(value) for value in obj.values())
+    if isinstance(obj, (list, set, tuple, frozenset)):
+        return len(obj)
+    return 1
+
+
+def _task_kind(task):
+    coro = task.get_coro()
+    name = getattr(coro, '__qualname__', None) or type(coro).__name__
+    # Group coroutines by what they are doing too, e.g. parked in asyncio.sleep.
+    waiting = getattr(coro, 'cr_await', None)
+    if waiting is not None:
+        awaited = getattr(waiting, '__qualname__', None) or type(waiting).__name__
+        return f"{name} -> {awaited}"
+    return name
+
+
+def rss_mb():
+    """Current resident set size from /proc when available, else the peak from getrusage."""
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+class MemoryMonitor:
+    """
+    On-demand memory accounting for the running bot.
+
+    `track(name, obj)` registers a long-lived structure (the module-level
+    tracker dicts, the client registry, ...); `report()` gives each one's
+    entry count and approximate deep size, live Telegram clients (registered
+    vs. still alive in the heap, which exposes leaked clients), asyncio tasks
+    grouped by coroutine and what they are awaiting, and RSS. With
+    tracemalloc started, `snapshot()` records a heap snapshot and `diff()`
+    compares the latest one with the previous one (or the first) to show
+    which source lines grew.
+    """
+
+    def __init__(self, client_type=None, max_snapshots=10):
+        self.client_type = client_type
+        self.max_snapshots = max_snapshots
+        self._tracked = {}
+        self._snapshots = []  # [(monotonic time, tracemalloc.Snapshot)]
+        self._baseline = None
+
+    def track(self, name, obj):
+        """Register a structure, or a zero-argument callable returning it (for names that get rebound)."""
+        self._tracked[name] = obj
+
+    def structures(self):
+        sizes = {}
+        for name, obj in self._tracked.items():
+            if callable(obj):
+                obj = obj()
+            size, objects, truncated = deep_size(obj)
+            sizes[name] = {
+                'keys': len(obj) if hasattr(obj, '__len__') else None,
+                'entries': _leaf_count(obj),
+                'kb': round(size / 1024, 1),
+                'objects': objects,
+            }
+            if truncated:
+                sizes[name]['truncated'] = True
+        return sizes
+
+    def clients(self, registered):
+        alive = None
+        if self.client_type is not None:
+            alive = sum(1 for obj in gc.get_objects() if isinstance(obj, self.client_type))
+        return {'registered': len(registered), 'alive': alive}
+
+    @staticmethod
+    def tasks():
+        try:
+            all_tasks = asyncio.all_tasks()
+        except RuntimeError:
+            return {}
+        return dict(Counter(_task_kind(task) for task in all_tasks).most_common())
+
+    def report(self, registered_clients=()):
+        started = time.perf_counter()
+        report = {
+            'rss_mb': rss_mb(),
+            'structures': self.structures(),
+            'clients': self.clients(registered_clients),
+            'tasks': self.tasks(),
+            'gc_objects': len(gc.get_objects()),
+            'tracemalloc': self.tracemalloc_status(),
+        }
+        report['report_ms'] = round((time.perf_counter() - started) * 1000, 1)
+        return report
+
+    # tracemalloc
+
+    def tracemalloc_status(self):
+        if not tracemalloc.is_tracing():
+            return {'tracing': False, 'snapshots': len(self._snapshots)}
+        current, peak = tracemalloc.get_traced_memory()
+        return {
+            'tracing': True,
+            'traced_mb': round(current / (1024 * 1024), 1),
+            'peak_mb': round(peak / (1024 * 1024), 1),
+            'snapshots': len(self._snapshots),
+        }
+
+    def start(self, frames=1):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            log.info("tracemalloc started", frames=frames)
+
+    def stop(self):
+        if tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._snapshots.clear()
+        self._baseline = None
+
+    def snapshot(self):
+        """Take a heap snapshot (starting tracemalloc first if needed)."""
+        self.start()
+        snapshot = tracemalloc.take_snapshot().filter_traces((
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<unknown>"),
+        ))
+        entry = (time.monotonic(), snapshot)
+        if self._baseline is None:
+            self._baseline = entry
+        self._snapshots.append(entry)
+        if len(self._snapshots) > self.max_snapshots:
+            del self._snapshots[0]
+        return len(self._snapshots)
+
+    def diff(self, limit=10, from_baseline=False):
+        """Top allocation growth by source line between two snapshots."""
+        if len(self._snapshots) < 2 and not (from_baseline and self._baseline and self._snapshots):
+            return None
+        old_time, old = self._baseline if from_baseline else self._snapshots[-2]
+        new_time, new = self._snapshots[-1]
+        stats = new.compare_to(old, 'lineno')
+        return {
+            'interval_s': round(new_time - old_time),
+            'total_growth_kb': round(sum(stat.size_diff for stat in stats) / 1024, 1),
+            'top': [
+                {
+                    'where': f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+                    'growth_kb': round(stat.size_diff / 1024, 1),
+                    'size_kb': round(stat.size / 1024, 1),
+                    'count_diff': stat.count_diff,
+                }
+                for stat in stats[:limit]
+            ],
+        }
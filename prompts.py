@@ -0,0 +1,92 @@
+import hashlib
+from collections import OrderedDict
+
+# Bump when the wording below changes so cached prefixes built from the old text are not reused.
+TEMPLATE_VERSION = 1
+
+SYSTEM_PROMPT_TEMPLATE = (
+    "You are a member of a Telegram group chat. Stay in character at all times.\n"
+    "Personality:\n"
+    "{personality}\n"
+    "Reply to the next message with a short, natural chat message. "
+    "Do not use emojis or hashtags."
+)
+
+
+class PromptTemplate:
+    """The system prompt for one chat group, with a content hash and a per-group version."""
+
+    def __init__(self, group_key, personality, version):
+        self.group_key = group_key
+        self.personality = personality
+        self.system_prompt = SYSTEM_PROMPT_TEMPLATE.format(personality=personality)
+        self.content_hash = hashlib.sha256(
+            f"{TEMPLATE_VERSION}\n{self.system_prompt}".encode('utf-8')
+        ).hexdigest()
+        self.version = version
+        self.slot_id = None
+
+    @property
+    def prefix_id(self):
+        return f"{self.group_key}:v{self.version}:{self.content_hash[:16]}"
+
+
+class PromptBuilder:
+    """
+    Turns each chat group's personality into a stable system prompt so the
+    model server can reuse the prefilled prefix across calls.
+
+    Templates are keyed by group ("user_id:telegram_id:chat_group_id"). When
+    the personality changes (or `invalidate` is called from the edit
+    handlers) the group gets a new version and prefix ID, so any cache entry
+    built from the old text is never hit again. With `cache_slots` > 0,
+    groups are also pinned to server slots (llama.cpp `id_slot` style),
+    least recently used first out.
+    """
+
+    def __init__(self, cache_slots=0):
+        self.cache_slots = cache_slots
+        self._templates = {}
+        self._versions = {}
+        self._slots = OrderedDict()  # {group_key: slot_id}, most recently used last
+        self.stats = {'builds': 0, 'template_hits': 0, 'template_rebuilds': 0, 'invalidations': 0, 'slot_evictions': 0}
+
+    def template(self, group_key, personality):
+        self.stats['builds'] += 1
+        current = self._templates.get(group_key)
+        if current is not None and current.personality == personality:
+            self.stats['template_hits'] += 1
+        else:
+            version = self._versions.get(group_key, 0) + 1
+            self._versions[group_key] = version
+            current = PromptTemplate(group_key, personality, version)
+            self._templates[group_key] = current
+            self.stats['template_rebuilds'] += 1
+        current.slot_id = self._assign_slot(group_key)
+        return current
+
+    def _assign_slot(self, group_key):
+        if not self.cache_slots:
+            return None
+        if group_key in self._slots:
+            self._slots.move_to_end(group_key)
+            return self._slots[group_key]
+        if len(self._slots) < self.cache_slots:
+            slot_id = len(self._slots)
+        else:
+            _, slot_id = self._slots.popitem(last=False)
+            self.stats['slot_evictions'] += 1
+        self._slots[group_key] = slot_id
+        return slot_id
+
+    def invalidate(self, group_key):
+        """Drop a group's template, e.g. after its personality was edited or the group deleted."""
+        if self._templates.pop(group_key, None) is not None:
+            self.stats['invalidations'] += 1
+
+    def report(self):
+        return dict(self.stats, templates=len(self._templates), slots_in_use=len(self._slots))
+
+
+def group_prompt_key(user_id, telegram_id, chat_group_id):
+    return f"{int(user_id)}:{int(telegram_id)}:{int(chat_group_id)}"
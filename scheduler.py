@@ -0,0 +1,242 @@
+import asyncio
+import heapq
+import itertools
+import time
+
+from llm import LatencyTracker
+from logs import get_logger
+
+log = get_logger(__name__)
+
+# Priority classes, most important first.
+INTERACTIVE = 'interactive'
+REPLY = 'reply'
+AUTOPOST = 'autopost'
+DRAFT = 'draft'  # replies generated ahead of their send time, on spare capacity only
+PRIORITY_CLASSES = (INTERACTIVE, REPLY, AUTOPOST, DRAFT)
+
+
+class Overloaded(Exception):
+    """Raised when a request is shed instead of being queued for the LLM."""
+
+
+class _Waiter:
+    __slots__ = ('priority', 'owner', 'future', 'enqueued', 'shed')
+
+    def __init__(self, priority, owner, future):
+        self.priority = priority
+        self.owner = owner
+        self.future = future
+        self.enqueued = time.monotonic()
+        self.shed = False
+
+
+class _ClassQueue:
+    """Weighted fair queue over owners for one priority class (start-time fair queuing)."""
+
+    def __init__(self):
+        self.heap = []         # [(finish_tag, seq, waiter)]
+        self.finish_tags = {}  # {owner: finish tag of that owner's last queued request}
+        self.virtual_time = 0.0
+        self.queued = 0
+        self.per_owner = {}    # {owner: live queued requests}
+
+    def push(self, waiter, weight, seq):
+        start = max(self.virtual_time, self.finish_tags.get(waiter.owner, 0.0))
+        finish = start + 1.0 / weight
+        self.finish_tags[waiter.owner] = finish
+        heapq.heappush(self.heap, (finish, seq, waiter))
+        self._count(waiter.owner, 1)
+
+    def pop(self):
+        while self.heap:
+            finish, _, waiter = heapq.heappop(self.heap)
+            if waiter.shed or waiter.future.done():
+                continue
+            self._count(waiter.owner, -1)
+            self.virtual_time = finish
+            if not self.queued:
+                # Idle class: owners start from scratch next time instead of carrying old credit.
+                self.finish_tags.clear()
+            return waiter
+        return None
+
+    def _count(self, owner, delta):
+        self.queued += delta
+        remaining = self.per_owner.get(owner, 0) + delta
+        if remaining:
+            self.per_owner[owner] = remaining
+        else:
+            self.per_owner.pop(owner, None)
+
+    def newest(self, owner=None):
+        """The live request with the latest finish tag (the one fair queuing would serve last)."""
+        live = [entry for entry in self.heap
+                if not entry[2].shed and not entry[2].future.done() and (owner is None or entry[2].owner == owner)]
+        if not live:
+            return None
+        return max(live)[2]
+
+    def busiest_owner(self):
+        if not self.per_owner:
+            return None, 0
+        return max(self.per_owner.items(), key=lambda item: item[1])
+
+    def discard(self, waiter):
+        waiter.shed = True
+        self._count(waiter.owner, -1)
+
+
+class LLMScheduler:
+    """
+    Admission control in front of the LLM dispatcher.
+
+    At most `max_in_flight` generations run at once; the rest wait in one
+    queue per priority class (interactive > reply > autopost > draft, strictly).
+    Within a class, owners (the bot user_id that linked the accounts) are
+    served by weighted fair queuing, so one owner with many busy groups
+    gets its share and no more. When `max_queue` requests are already
+    waiting, a lower-priority queued request is shed to make room
+    (autoposts first), or failing that the newest request of an owner
+    holding more than its share of the class; otherwise the incoming
+    request itself is shed. Autoposts are also shed once they have waited `max_autopost_wait`
+    seconds, since a late autopost is worth nothing. Drafts only start while
+    fewer than `max_in_flight - draft_headroom` generations are running, so
+    they use spare capacity and leave room for work that is due now.
+    """
+
+    def __init__(self, max_in_flight=32, max_queue=256, max_autopost_wait=120.0, owner_weights=None, draft_headroom=0):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_autopost_wait = max_autopost_wait
+        self.draft_limit = max(1, max_in_flight - draft_headroom)
+        self.owner_weights = owner_weights or {}
+        self.in_flight = 0
+        self._queues = {priority: _ClassQueue() for priority in PRIORITY_CLASSES}
+        self._seq = itertools.count()
+        self._waits = {priority: LatencyTracker(window=500) for priority in PRIORITY_CLASSES}
+        self.stats = {
+            priority: {'submitted': 0, 'admitted': 0, 'shed': 0, 'max_wait_ms': 0}
+            for priority in PRIORITY_CLASSES
+        }
+
+    def _queued(self, through=DRAFT):
+        """Requests waiting in `through`'s class and the classes above it (all of them by default)."""
+        classes = PRIORITY_CLASSES[:PRIORITY_CLASSES.index(through) + 1]
+        return sum(self._queues[priority].queued for priority in classes)
+
+    async def run(self, priority, owner, func, *args, **kwargs):
+        """Wait for a slot, then await func(*args, **kwargs). Raises Overloaded if shed."""
+        if priority not in self._queues:
+            raise ValueError(f"Unknown priority class: {priority}")
+        self.stats[priority]['submitted'] += 1
+
+        limit = self.draft_limit if priority == DRAFT else self.max_in_flight
+        # Only work queued at this priority or above goes first; queued drafts don't hold back due work.
+        if self.in_flight < limit and not self._queued(through=priority):
+            self._admitted(priority, 0.0)
+        else:
+            await self._wait_for_slot(priority, owner)
+
+        self.in_flight += 1
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            self.in_flight -= 1
+            self._dispatch()
+
+    async def _wait_for_slot(self, priority, owner):
+        if self._queued() >= self.max_queue and not self._shed_below(priority, owner):
+            self._shed(priority, "queue full")
+            raise Overloaded(f"LLM queue full; {priority} request shed")
+
+        waiter = _Waiter(priority, owner, asyncio.get_running_loop().create_future())
+        self._queues[priority].push(waiter, self.owner_weights.get(owner, 1.0), next(self._seq))
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            future = waiter.future
+            if future.done() and not future.cancelled() and future.exception() is None:
+                # The slot was granted as we were cancelled; pass it on.
+                self.in_flight -= 1
+                self._dispatch()
+            elif not waiter.shed and (not future.done() or future.cancelled()):
+                # Never got the slot: just leave the queue.
+                self._queues[priority].discard(waiter)
+            raise
+        # The slot was reserved by _dispatch (in_flight already counts it); run() adds it again.
+        self.in_flight -= 1
+
+    def _shed_below(self, priority, owner):
+        """
+        Make room for a request by shedding one queued request of lower priority,
+        or else the newest one of an owner holding more than its share of this class.
+        """
+        for lower in reversed(PRIORITY_CLASSES[PRIORITY_CLASSES.index(priority) + 1:]):
+            victim = self._queues[lower].newest()
+            if victim is not None:
+                self._displace(victim, "displaced by higher priority work")
+                return True
+
+        queue = self._queues[priority]
+        busiest, count = queue.busiest_owner()
+        if busiest is not None and busiest != owner and count > queue.per_owner.get(owner, 0) + 1:
+            self._displace(queue.newest(busiest), f"owner {busiest} has {count} queued")
+            return True
+        return False
+
+    def _displace(self, victim, reason):
+        self._queues[victim.priority].discard(victim)
+        self._shed(victim.priority, reason)
+        victim.future.set_exception(Overloaded(f"LLM queue full; {victim.priority} request shed"))
+
+    def _shed(self, priority, reason):
+        self.stats[priority]['shed'] += 1
+        log.info("Shed LLM request", priority=priority, reason=reason, _every=10)
+
+    def _admitted(self, priority, waited):
+        stats = self.stats[priority]
+        stats['admitted'] += 1
+        stats['max_wait_ms'] = max(stats['max_wait_ms'], round(waited * 1000))
+        self._waits[priority].record(waited)
+
+    def _dispatch(self):
+        now = time.monotonic()
+        while self.in_flight < self.max_in_flight:
+            waiter = self._next(now)
+            if waiter is None:
+                return
+            # Reserve the slot now so a request arriving before the waiter wakes can't take it.
+            self.in_flight += 1
+            self._admitted(waiter.priority, now - waiter.enqueued)
+            waiter.future.set_result(None)
+
+    def _next(self, now):
+        for priority in PRIORITY_CLASSES:
+            if priority == DRAFT and self.in_flight >= self.draft_limit:
+                return None
+            queue = self._queues[priority]
+            while True:
+                waiter = queue.pop()
+                if waiter is None:
+                    break
+                if priority == AUTOPOST and now - waiter.enqueued > self.max_autopost_wait:
+                    self._shed(priority, f"waited more than {self.max_autopost_wait:g}s")
+                    waiter.future.set_exception(Overloaded("autopost waited too long for the LLM"))
+                    continue
+                return waiter
+        return None
+
+    def report(self):
+        classes = {}
+        for priority in PRIORITY_CLASSES:
+            waits = self._waits[priority]
+            p50 = waits.percentile(50)
+            p95 = waits.percentile(95)
+            classes[priority] = dict(
+                self.stats[priority],
+                queued=self._queues[priority].queued,
+                wait_p50_ms=round(p50 * 1000) if p50 is not None else None,
+                wait_p95_ms=round(p95 * 1000) if p95 is not None else None,
+            )
+        return {'in_flight': self.in_flight, 'max_in_flight': self.max_in_flight, 'classes': classes}
@@ -0,0 +1,106 @@
+import asyncio
+import bisect
+
+from storage import store_executor
+
+
+class SentMessageIndex:
+    """
+    Bounded per-chat index of the message IDs a linked account sent recently.
+
+    Answers "is message X mine?" without fetching X. Coverage for a chat starts
+    at the first message seen after the client started: any of our messages
+    newer than that point is recorded by the outgoing handler, so a miss in
+    the covered range means "not mine". IDs below the covered range (older
+    than the index, or sent while the client was offline) are unknown and the
+    caller has to fetch the message. IDs loaded from disk still count as hits.
+    """
+
+    def __init__(self, store, key, max_per_chat=200, persist_delay=1.0):
+        self.store = store
+        self.key = key
+        self.max_per_chat = max_per_chat
+        self.persist_delay = persist_delay
+        self._persist_handle = None
+        self._ids = {}           # {chat_id: sorted list of message ids}
+        self._covered_from = {}  # {chat_id: lowest message id from which the index is complete}
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+        for chat_id, ids in (store.get(key) or {}).items():
+            self._ids[int(chat_id)] = sorted(ids)[-max_per_chat:]
+
+    def observe(self, chat_id, message_id):
+        """Mark the point from which this chat is fully covered, if not yet known."""
+        if chat_id not in self._covered_from:
+            self._covered_from[chat_id] = message_id
+
+    def add(self, chat_id, message_id):
+        """Record a message sent by this account."""
+        self.observe(chat_id, message_id)
+        self.remember(chat_id, message_id)
+
+    def remember(self, chat_id, message_id):
+        """
+        Record an older message found to be this account's (e.g. a fetched
+        reply target). Unlike add(), it doesn't start the chat's coverage, so
+        messages sent while the client was offline stay unknown, not "not mine".
+        """
+        ids = self._ids.setdefault(chat_id, [])
+        pos = bisect.bisect_left(ids, message_id)
+        if pos < len(ids) and ids[pos] == message_id:
+            return
+        ids.insert(pos, message_id)
+        while len(ids) > self.max_per_chat:
+            evicted = ids.pop(0)
+            # Anything at or below an evicted id can no longer be answered from the index.
+            if chat_id in self._covered_from:
+                self._covered_from[chat_id] = max(self._covered_from[chat_id], evicted + 1)
+        self._schedule_persist()
+
+    def _export(self):
+        return {str(cid): list(cid_ids) for cid, cid_ids in self._ids.items()}
+
+    def _schedule_persist(self):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.store.put(self.key, self._export())
+            return
+        if self._persist_handle is None:
+            self._persist_handle = loop.call_later(self.persist_delay, self._persist, loop)
+
+    def _persist(self, loop):
+        # Export on the loop thread, write in the store's thread pool.
+        self._persist_handle = None
+        loop.run_in_executor(store_executor, self.store.put, self.key, self._export())
+
+    def size(self):
+        return sum(len(ids) for ids in self._ids.values())
+
+    def snapshot(self):
+        """The indexed message IDs ({chat_id: sorted list}); read-only."""
+        return self._ids
+
+    def lookup(self, chat_id, message_id):
+        """Return True if the message is ours, False if it is not, None if the index can't tell."""
+        ids = self._ids.get(chat_id, [])
+        pos = bisect.bisect_left(ids, message_id)
+        if pos < len(ids) and ids[pos] == message_id:
+            self.hits += 1
+            return True
+        covered_from = self._covered_from.get(chat_id)
+        if covered_from is not None and message_id >= covered_from:
+            self.misses += 1
+            return False
+        self.fallbacks += 1
+        return None
+
+    async def forget(self):
+        """Drop the index and its persisted entry (the account was unlinked), cancelling a pending write."""
+        if self._persist_handle is not None:
+            self._persist_handle.cancel()
+            self._persist_handle = None
+        self._ids.clear()
+        self._covered_from.clear()
+        await self.store.adelete(self.key)
@@ -0,0 +1,231 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from base64 import b64decode, b64encode
+
+from telethon.crypto import AuthKey
+from telethon.sessions import StringSession
+from telethon.tl import types
+
+from logs import get_logger
+from storage import store_executor
+
+log = get_logger(__name__)
+
+
+class SessionDatabase:
+    """
+    Single SQLite database holding the session state of every linked account.
+
+    Each row is one account's state serialized as JSON and encrypted with
+    Fernet, so auth keys and cached entities never touch disk in clear text.
+    Writes may come from `store_executor` threads, so the connection is
+    shared behind a lock.
+    """
+
+    def __init__(self, path, fernet):
+        self.path = path
+        self.fernet = fernet
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            "create table if not exists sessions ("
+            "key text primary key, data text not null, updated real not null)"
+        )
+        self.conn.commit()
+
+    def get(self, key):
+        with self._lock:
+            row = self.conn.execute("select data from sessions where key = ?", (key,)).fetchone()
+        if not row:
+            return None
+        try:
+            return json.loads(self.fernet.decrypt(row[0].encode('utf-8')))
+        except Exception as e:
+            log.warning("Discarding unreadable session record", key=key, error=e)
+            return None
+
+    def put(self, key, record):
+        data = self.fernet.encrypt(json.dumps(record, separators=(',', ':')).encode('utf-8')).decode('utf-8')
+        with self._lock:
+            self.conn.execute(
+                "insert or replace into sessions (key, data, updated) values (?, ?, ?)",
+                (key, data, time.time())
+            )
+            self.conn.commit()
+
+    def delete(self, key):
+        with self._lock:
+            self.conn.execute("delete from sessions where key = ?", (key,))
+            self.conn.commit()
+
+    async def adelete(self, key):
+        """delete() in `store_executor`, off the event loop."""
+        await asyncio.get_running_loop().run_in_executor(store_executor, self.delete, key)
+
+    def close(self):
+        with self._lock:
+            self.conn.close()
+
+
+def session_key(user_id, telegram_id):
+    return f"{int(user_id)}:{int(telegram_id)}"
+
+
+class EncryptedSession(StringSession):
+    """
+    StringSession that also persists its entity cache, update state and the
+    cached `get_me` profile in a SessionDatabase.
+
+    It is seeded from the account's session string, so existing strings keep
+    working. Once a record exists for the same string, the stored auth key,
+    DC, entities and update state are restored instead, which lets warm
+    restarts skip entity resolution and catch up from the saved state.
+    `save()` still returns the session string. Telethon calls it on the event
+    loop, so the record is built there and encrypted and written in
+    `store_executor`, one write at a time per session.
+    """
+
+    def __init__(self, database, key, session_string):
+        super().__init__(session_string)
+        self._database = database
+        self._key = key
+        self._origin = hashlib.sha256(session_string.encode('utf-8')).hexdigest()
+        self._me = None
+        self._dirty = False
+        self._deleted = False
+        self._writing = None  # future of the write in progress
+        self._next_record = None  # newest record saved while that write was running
+
+        record = database.get(key)
+        if record and record.get('origin') == self._origin:
+            self._restore(record)
+        else:
+            if record:
+                log.info("Session string changed; reseeding session record", key=key)
+            self._dirty = True
+
+    def _restore(self, record):
+        self._dc_id = record['dc_id']
+        self._server_address = record['server_address']
+        self._port = record['port']
+        if record.get('auth_key'):
+            self._auth_key = AuthKey(b64decode(record['auth_key']))
+        self._entities = set(tuple(row) for row in record.get('entities', []))
+        for entity_id, (pts, qts, date, seq) in record.get('update_states', {}).items():
+            self._update_states[int(entity_id)] = types.updates.State(
+                pts, qts, datetime.datetime.fromtimestamp(date, tz=datetime.timezone.utc), seq, unread_count=0
+            )
+        self._me = record.get('me')
+
+    def _record(self):
+        return {
+            'origin': self._origin,
+            'dc_id': self._dc_id,
+            'server_address': self._server_address,
+            'port': self._port,
+            'auth_key': b64encode(self._auth_key.key).decode('ascii') if self._auth_key else None,
+            'entities': [list(row) for row in self._entities],
+            'update_states': {
+                str(entity_id): [state.pts, state.qts, int(state.date.timestamp()), state.seq]
+                for entity_id, state in self._update_states.items()
+            },
+            'me': self._me,
+        }
+
+    def set_dc(self, dc_id, server_address, port):
+        super().set_dc(dc_id, server_address, port)
+        self._dirty = True
+
+    @property
+    def auth_key(self):
+        return self._auth_key
+
+    @auth_key.setter
+    def auth_key(self, value):
+        self._auth_key = value
+        self._dirty = True
+
+    def set_update_state(self, entity_id, state):
+        super().set_update_state(entity_id, state)
+        self._dirty = True
+
+    def process_entities(self, tlo):
+        before = len(self._entities)
+        super().process_entities(tlo)
+        if len(self._entities) != before:
+            self._dirty = True
+
+    def cache_me(self, me):
+        """Remember the account's own profile so restarts can skip `get_me()`."""
+        self._me = {
+            'id': me.id,
+            'access_hash': me.access_hash,
+            'first_name': me.first_name,
+            'last_name': me.last_name,
+            'username': me.username,
+            'bot': bool(me.bot),
+        }
+        self._dirty = True
+        self.save()
+
+    def get_cached_me(self):
+        """Return the cached profile as a :tl:`User`, or None if it was never cached."""
+        if not self._me:
+            return None
+        return types.User(
+            id=self._me['id'],
+            is_self=True,
+            access_hash=self._me.get('access_hash'),
+            first_name=self._me.get('first_name'),
+            last_name=self._me.get('last_name'),
+            username=self._me.get('username'),
+            bot=self._me.get('bot'),
+        )
+
+    def save(self):
+        if self._dirty and not self._deleted:
+            self._dirty = False
+            record = self._record()
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self._write(record)
+            else:
+                if self._writing is None:
+                    self._write_later(loop, record)
+                else:
+                    self._next_record = record
+        return super().save()
+
+    def _write(self, record):
+        try:
+            self._database.put(self._key, record)
+        except Exception as e:
+            log.error("Failed to persist session", key=self._key, error=e)
+            return False
+        return True
+
+    def _write_later(self, loop, record):
+        self._writing = loop.run_in_executor(store_executor, self._write, record)
+        self._writing.add_done_callback(lambda future: self._written(loop, future))
+
+    def _written(self, loop, future):
+        self._writing = None
+        if not future.cancelled() and not future.result():
+            self._dirty = True  # retried on the next save
+        if self._next_record is not None and not self._deleted:
+            record, self._next_record = self._next_record, None
+            self._write_later(loop, record)
+
+    async def delete(self):
+        """Delete the stored record (the account was unlinked); later saves no longer write it back."""
+        self._deleted = True
+        self._next_record = None
+        if self._writing is not None:
+            await asyncio.wait([self._writing])
+        await self._database.adelete(self._key)
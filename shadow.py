@@ -0,0 +1,58 @@
+import time
+from collections import Counter, deque
+
+# Backends don't report token usage, so tokens are estimated from text length (~4 characters per token).
+CHARS_PER_TOKEN = 4
+
+
+def estimate_tokens(text):
+    return (len(text or '') + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+
+class ShadowStats:
+    """
+    Counts what shadow mode would have sent: replies and autoposts that went
+    through the whole pipeline (rate limits, dedupe, LLM generation) but were
+    logged instead of posted, with estimated prompt and completion tokens.
+    Reports totals since start, the rate over the last hour, and the busiest
+    chats, to size LLM capacity before a group goes live.
+    """
+
+    def __init__(self, window=3600.0):
+        self.window = window
+        self.started = time.monotonic()
+        self.totals = Counter()
+        self.per_chat = Counter()
+        self._recent = deque()  # [(monotonic time, kind, prompt_tokens, completion_tokens)]
+
+    def record(self, kind, chat_id, prompt, completion):
+        prompt_tokens = estimate_tokens(prompt)
+        completion_tokens = estimate_tokens(completion)
+        self.totals[kind] += 1
+        self.totals['prompt_tokens'] += prompt_tokens
+        self.totals['completion_tokens'] += completion_tokens
+        self.per_chat[chat_id] += 1
+        now = time.monotonic()
+        self._recent.append((now, kind, prompt_tokens, completion_tokens))
+        self._expire(now)
+
+    def _expire(self, now):
+        while self._recent and now - self._recent[0][0] > self.window:
+            self._recent.popleft()
+
+    def report(self, top=5):
+        now = time.monotonic()
+        self._expire(now)
+        hours = max(now - self.started, 1.0) / 3600
+        last_hour = Counter()
+        for _, kind, prompt_tokens, completion_tokens in self._recent:
+            last_hour[kind] += 1
+            last_hour['prompt_tokens'] += prompt_tokens
+            last_hour['completion_tokens'] += completion_tokens
+        return {
+            'running_h': round(hours, 2),
+            'totals': dict(self.totals),
+            'per_hour_avg': {key: round(value / hours, 1) for key, value in self.totals.items()},
+            'last_hour': dict(last_hour),
+            'busiest_chats': dict(self.per_chat.most_common(top)),
+        }
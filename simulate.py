@@ -0,0 +1,594 @@
+"""
+Load simulator for capacity planning.
+
+Runs the real bot.py pipeline (initialize_linked_user_clients,
+handle_linked_user_message, autopost_task and the bot's menu callbacks)
+against in-process fake Telegram clients that emit synthetic group traffic,
+simulate latency and FloodWait, and record every send. Nothing talks to
+Telegram and all data files are written to a temporary directory.
+
+Example:
+    python simulate.py --accounts 500 --chats 200 --msgs-per-min 3000 --duration 120
+"""
+import argparse
+import asyncio
+import datetime
+import gc
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from telethon import errors, utils
+from telethon.crypto import AuthKey
+from telethon.sessions import StringSession
+
+# Fake Telegram user IDs: owners, linked agents and human chat members live in separate ranges.
+OWNER_ID_BASE = 1_000_000
+AGENT_ID_BASE = 2_000_000
+HUMAN_ID_BASE = 3_000_000
+BOT_SENDER_ID_BASE = 4_000_000
+FAKE_GROUP_ID = -100999
+
+
+def percentiles(values, points=(50, 95, 99)):
+    if not values:
+        return {f"p{p}": None for p in points}
+    ordered = sorted(values)
+    return {
+        f"p{p}": round(ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))], 4)
+        for p in points
+    }
+
+
+class FakeUser:
+    def __init__(self, id, first_name, bot=False, username=None):
+        self.id = id
+        self.first_name = first_name
+        self.last_name = None
+        self.username = username
+        self.access_hash = id * 7919
+        self.bot = bot
+        self.phone = None
+
+
+class FakeMessage:
+    def __init__(self, network, chat_id, id, sender, text, reply_to_msg_id=None):
+        self._network = network
+        self.chat_id = chat_id
+        peer_id, peer_type = utils.resolve_id(chat_id)
+        self.peer_id = peer_type(peer_id)
+        self.id = id
+        self.sender_id = sender.id
+        self._sender = sender
+        self.text = text
+        self.raw_text = text
+        self.message = text
+        self.reply_to_msg_id = reply_to_msg_id
+        self.is_reply = reply_to_msg_id is not None
+        self.date = datetime.datetime.now(datetime.timezone.utc)
+        self.media = None
+        self.file = None
+
+    async def get_sender(self):
+        await self._network.rpc()
+        return self._sender
+
+    async def get_reply_message(self):
+        if self.reply_to_msg_id is None:
+            return None
+        await self._network.rpc()
+        self._network.stats['reply_fetches'] += 1
+        return self._network.find_message(self.chat_id, self.reply_to_msg_id)
+
+
+class FakeEvent:
+    """Enough of a NewMessage/CallbackQuery event for bot.py's handlers."""
+
+    def __init__(self, client, message=None, sender_id=None, data=None):
+        self.client = client
+        self.message = message
+        self.chat_id = message.chat_id if message else sender_id
+        self.id = message.id if message else 0
+        self.sender_id = message.sender_id if message else sender_id
+        self.raw_text = message.text if message else ''
+        self.data = data
+
+    async def respond(self, text, buttons=None, file=None, **kwargs):
+        return await self.client.send_message(self.sender_id, text)
+
+    async def edit(self, text, **kwargs):
+        return None
+
+
+class FakeNetwork:
+    """Shared state for all fake clients: chats, message history, latency and FloodWait injection."""
+
+    def __init__(self, rpc_latency, send_latency, flood_rate, flood_seconds, history_limit=200):
+        self.rpc_latency = rpc_latency
+        self.send_latency = send_latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.history_limit = history_limit
+        self.chats = {}             # {chat_id: [FakeMessage]}, oldest first
+        self.chat_members = {}      # {chat_id: [FakeTelegramClient]}
+        self.accounts = {}          # {session_string: FakeUser}
+        self.ids = {}               # {chat_id: itertools.count}
+        self.group_members = []
+        self.receipts = {}          # {(chat_id, message_id): delivery time}
+        self.reply_latencies = []
+        self.sends = []
+        self.stats = {
+            'delivered': 0, 'handler_calls': 0, 'sends': 0, 'bot_responses': 0,
+            'flood_waits': 0, 'rpcs': 0, 'reply_fetches': 0, 'history_fetches': 0,
+        }
+
+    async def rpc(self):
+        self.stats['rpcs'] += 1
+        if self.rpc_latency:
+            await asyncio.sleep(random.expovariate(1 / self.rpc_latency))
+
+    def next_id(self, chat_id):
+        return next(self.ids.setdefault(chat_id, itertools.count(1)))
+
+    def post(self, chat_id, sender, text, reply_to_msg_id=None):
+        message = FakeMessage(self, chat_id, self.next_id(chat_id), sender, text, reply_to_msg_id)
+        history = self.chats.setdefault(chat_id, [])
+        history.append(message)
+        if len(history) > self.history_limit:
+            del history[0]
+        return message
+
+    def find_message(self, chat_id, message_id):
+        for message in reversed(self.chats.get(chat_id, [])):
+            if message.id == message_id:
+                return message
+        return None
+
+    def deliver(self, message):
+        """Dispatch a new message to every connected member client, the way Telethon would."""
+        self.stats['delivered'] += 1
+        self.receipts[(message.chat_id, message.id)] = time.monotonic()
+        for client in self.chat_members.get(message.chat_id, []):
+            if not client.connected:
+                continue
+            me = client.account()
+            outgoing = me is not None and message.sender_id == me.id
+            for builder, handler in client.handlers:
+                if builder.incoming and outgoing or builder.outgoing and not outgoing:
+                    continue
+                self.stats['handler_calls'] += 1
+                asyncio.create_task(handler(FakeEvent(client, message)))
+
+
+class FakeTelegramClient:
+    """In-process stand-in for telethon.TelegramClient."""
+
+    network = None
+
+    def __init__(self, session, api_id=None, api_hash=None, **kwargs):
+        self.session = session
+        self.connected = False
+        self.handlers = []
+        self.me_user = None
+        self._stopped = None
+
+    def account(self):
+        # bot.py may fill `me` from its session cache without calling get_me().
+        return getattr(self, 'me', None) or self.me_user
+
+    def on(self, builder):
+        def decorator(handler):
+            self.handlers.append((builder, handler))
+            return handler
+        return decorator
+
+    async def connect(self):
+        await self.network.rpc()
+        self.connected = True
+        self._stopped = asyncio.Event()
+
+    async def disconnect(self):
+        self.connected = False
+        if self._stopped:
+            self._stopped.set()
+
+    def is_connected(self):
+        return self.connected
+
+    async def is_user_authorized(self):
+        await self.network.rpc()
+        return True
+
+    async def get_me(self, input_peer=False):
+        await self.network.rpc()
+        self.me_user = self.network.accounts.get(self.session.save())
+        return self.me_user
+
+    async def run_until_disconnected(self):
+        await self._stopped.wait()
+
+    async def __call__(self, request):
+        await self.network.rpc()
+        return None
+
+    async def get_participants(self, chat):
+        await self.network.rpc()
+        return self.network.group_members
+
+    async def get_entity(self, entity):
+        await self.network.rpc()
+        return FakeUser(entity if isinstance(entity, int) else 0, str(entity))
+
+    async def send_message(self, chat_id, text, reply_to=None, **kwargs):
+        network = self.network
+        if network.send_latency:
+            await asyncio.sleep(random.expovariate(1 / network.send_latency))
+        if network.flood_rate and random.random() < network.flood_rate:
+            network.stats['flood_waits'] += 1
+            raise errors.FloodWaitError(request=None, capture=network.flood_seconds)
+
+        sender = self.account() or FakeUser(0, "bot")
+        if chat_id not in network.chat_members:
+            # A private message from the bot to an owner.
+            network.stats['bot_responses'] += 1
+            return FakeMessage(network, chat_id, network.next_id(chat_id), sender, text)
+
+        network.stats['sends'] += 1
+        message = network.post(chat_id, sender, text, reply_to)
+        received = network.receipts.get((chat_id, reply_to))
+        if received is not None:
+            network.reply_latencies.append(time.monotonic() - received)
+        network.sends.append((chat_id, sender.id, reply_to))
+        network.deliver(message)
+        return message
+
+    async def send_file(self, entity, file, **kwargs):
+        return await self.send_message(entity, kwargs.get('caption', ''))
+
+    async def get_messages(self, chat_id, ids):
+        await self.network.rpc()
+        self.network.stats['history_fetches'] += 1
+        return [self.network.find_message(chat_id, message_id) for message_id in ids]
+
+    async def iter_messages(self, chat_id, limit=100, min_id=0, **kwargs):
+        await self.network.rpc()
+        self.network.stats['history_fetches'] += 1
+        history = [message for message in reversed(self.network.chats.get(chat_id, [])) if message.id > min_id]
+        for message in history[:limit]:
+            yield message
+
+
+class SimulatedLLMBackend:
+    """Model server stand-in with fixed per-call latency and batching support."""
+
+    supports_batching = True
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.calls = 0
+        self.generated = 0
+
+    async def generate(self, request):
+        self.calls += 1
+        self.generated += 1
+        await asyncio.sleep(self.latency)
+        return "Simulated reply."
+
+    async def generate_batch(self, requests):
+        self.calls += 1
+        self.generated += len(requests)
+        await asyncio.sleep(self.latency)
+        return ["Simulated reply."] * len(requests)
+
+
+class ScaledAsyncio:
+    """asyncio proxy whose sleep() is compressed by `scale`, so hour-long bot delays pass in seconds."""
+
+    def __init__(self, scale):
+        self.scale = scale
+        self._sleep = asyncio.sleep
+
+    def __getattr__(self, name):
+        return getattr(asyncio, name)
+
+    def sleep(self, delay, result=None):
+        return self._sleep(delay * self.scale, result)
+
+
+def fake_session_string():
+    session = StringSession()
+    session.set_dc(2, '149.154.167.51', 443)
+    session.auth_key = AuthKey(os.urandom(256))
+    return session.save()
+
+
+def prepare_environment(workdir):
+    """bot.py reads its configuration from the environment at import time."""
+    from cryptography.fernet import Fernet
+    os.environ.setdefault('API_ID', '1')
+    os.environ.setdefault('API_HASH', 'simulation')
+    os.environ.setdefault('BOT_TOKEN', 'simulation')
+    os.environ.setdefault('GROUP_ID', str(FAKE_GROUP_ID))
+    os.environ['ENCRYPTION_KEY'] = Fernet.generate_key().decode('ascii')
+    os.environ.setdefault('STORE_FLUSH_DELAY', '1')
+    os.environ.setdefault('CATCHUP_RATE', '20')
+    os.chdir(workdir)
+
+
+def build_population(bot_module, network, args):
+    """Create owners, linked agent accounts and chat groups, and save them through bot.py."""
+    user_data = {}
+    chat_groups_data = {}
+    chat_ids = [-1001000000000 - i for i in range(args.chats)]
+    agents = []
+    for i in range(args.accounts):
+        owner_id = OWNER_ID_BASE + i // args.accounts_per_owner
+        agent = FakeUser(AGENT_ID_BASE + i, f"Agent{i}")
+        session_string = fake_session_string()
+        network.accounts[session_string] = agent
+        owner = user_data.setdefault(str(owner_id), {'linked_accounts': []})
+        owner['linked_accounts'].append({
+            'session_string': session_string,
+            'first_name': agent.first_name,
+            'last_name': None,
+            'username': None,
+            'telegram_id': agent.id,
+        })
+        groups = random.sample(chat_ids, min(args.groups_per_account, len(chat_ids)))
+        chat_groups_data.setdefault(str(owner_id), {'linked_accounts': []})['linked_accounts'].append({
+            'telegram_id': agent.id,
+            'chat_groups': [
+                {'chat_group_id': chat_id, 'chat_group_name': f"Chat {chat_id}",
+                 'personality': "You are terse and dry." * args.personality_repeat}
+                for chat_id in groups
+            ],
+        })
+        agents.append((owner_id, agent, groups))
+
+    owners = sorted({owner_id for owner_id, _, _ in agents})
+    network.group_members = [FakeUser(owner_id, "Owner") for owner_id in owners
+                             if random.random() < args.member_fraction]
+    bot_module.save_user_data(user_data)
+    bot_module.save_chat_groups(chat_groups_data)
+    return chat_ids, agents, owners
+
+
+def simulate_offline_period(bot_module, network, agents, humans, args):
+    """
+    Give every account a read cursor at its first message, then post what it
+    missed while offline: its own messages and human replies to the first
+    `args.offline_replies` of them. Catch-up replays the replies; the rest of
+    its messages are only replied to live, once traffic starts.
+    """
+    for owner_id, agent, groups in agents:
+        cursors = {}
+        for chat_id in groups:
+            cursors[str(chat_id)] = max(m.id for m in network.chats[chat_id] if m.sender_id == agent.id)
+            for i in range(args.offline_replies + 1):
+                mine = network.post(chat_id, agent, "Anyone still around?")
+                if i < args.offline_replies:
+                    network.post(chat_id, random.choice(humans), "Still here.", mine.id)
+        bot_module.read_cursors_store.put(bot_module.session_key(owner_id, agent.id), cursors)
+
+
+def misread_own_messages(bot_module, network):
+    """Messages an account sent that its sent-message index claims are someone else's."""
+    misread = 0
+    for agent in bot_module.agents.values():
+        for chat_id in agent.chat_group_ids:
+            for message in network.chats.get(chat_id, []):
+                if message.sender_id == agent.telegram_id and agent.sent_index.lookup(chat_id, message.id) is False:
+                    misread += 1
+    return misread
+
+
+async def measure_loop_lag(samples, interval=0.05):
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.monotonic() - started - interval))
+
+
+async def generate_traffic(network, chat_ids, args, humans, stop_at):
+    """Emit synthetic group messages: plain chatter, replies to agents, links, bots and bursts."""
+    rate = args.msgs_per_min / 60.0
+    kinds = ['plain', 'reply', 'link', 'bot', 'burst']
+    weights = [args.plain_weight, args.reply_weight, args.link_weight, args.bot_weight, args.burst_weight]
+    while time.monotonic() < stop_at:
+        await asyncio.sleep(random.expovariate(rate))
+        chat_id = random.choice(chat_ids)
+        kind = random.choices(kinds, weights)[0]
+        count = random.randint(5, 20) if kind == 'burst' else 1
+        for _ in range(count):
+            human = random.choice(humans)
+            if kind == 'reply':
+                agent_messages = [m for m in network.chats.get(chat_id, []) if m.sender_id >= AGENT_ID_BASE
+                                  and m.sender_id < HUMAN_ID_BASE]
+                reply_to = random.choice(agent_messages).id if agent_messages else None
+                message = network.post(chat_id, human, "What do you mean by that?", reply_to)
+            elif kind == 'link':
+                message = network.post(chat_id, human, "Check this out https://example.com/x")
+            elif kind == 'bot':
+                bot_user = FakeUser(BOT_SENDER_ID_BASE + random.randint(0, 9), "Bot", bot=True)
+                agent_messages = [m for m in network.chats.get(chat_id, []) if AGENT_ID_BASE <= m.sender_id < HUMAN_ID_BASE]
+                reply_to = random.choice(agent_messages).id if agent_messages else None
+                message = network.post(chat_id, bot_user, "Automated notice.", reply_to)
+            else:
+                message = network.post(chat_id, human, random.choice(["gm", "anyone here?", "lol", "nice"]))
+            network.deliver(message)
+
+
+async def click_menus(bot_module, owners, args, stop_at, latencies):
+    """Drive the bot's menu callback paths the way owners would."""
+    if not args.callbacks_per_min or not owners:
+        return
+    rate = args.callbacks_per_min / 60.0
+    bot_client = bot_module.bot
+    while time.monotonic() < stop_at:
+        await asyncio.sleep(random.expovariate(rate))
+        owner_id = random.choice(owners)
+        data = random.choice([b"start_edit_npc", b"start_create_npc", b"back"])
+        started = time.monotonic()
+        try:
+            await bot_module.start_menu_handler(FakeEvent(bot_client, sender_id=owner_id, data=data))
+        except Exception as e:
+            print(f"callback {data!r} failed: {e}", file=sys.stderr)
+        latencies.append(time.monotonic() - started)
+
+
+async def run_simulation(bot_module, args):
+    network = FakeNetwork(
+        rpc_latency=args.rpc_latency_ms / 1000,
+        send_latency=args.send_latency_ms / 1000,
+        flood_rate=args.flood_rate,
+        flood_seconds=args.flood_seconds,
+    )
+    FakeTelegramClient.network = network
+    bot_module.TelegramClient = FakeTelegramClient
+    bot_module.bot = FakeTelegramClient(StringSession())
+    await bot_module.bot.connect()
+    bot_module.asyncio = ScaledAsyncio(args.time_scale)
+    llm = SimulatedLLMBackend(args.llm_latency_ms / 1000)
+    bot_module.llm_dispatcher.backend = llm
+
+    chat_ids, agents, owners = build_population(bot_module, network, args)
+    for _, agent, groups in agents:
+        for chat_id in groups:
+            network.post(chat_id, agent, "Hello everyone.")
+    humans = [FakeUser(HUMAN_ID_BASE + i, f"Human{i}") for i in range(args.humans)]
+    if args.offline_replies:
+        simulate_offline_period(bot_module, network, agents, humans, args)
+
+    tracemalloc.start()
+    started = time.monotonic()
+    await bot_module.initialize_linked_user_clients()
+    startup_seconds = time.monotonic() - started
+    for agent in bot_module.agents.values():
+        for chat_id in agent.chat_group_ids:
+            network.chat_members.setdefault(chat_id, []).append(agent.client)
+
+    lag_samples = []
+    callback_latencies = []
+    lag_task = asyncio.create_task(measure_loop_lag(lag_samples))
+    stop_at = time.monotonic() + args.duration
+    run_started = time.monotonic()
+    await asyncio.gather(
+        generate_traffic(network, chat_ids, args, humans, stop_at),
+        click_menus(bot_module, owners, args, stop_at, callback_latencies),
+    )
+    # Let replies whose (scaled) delay is still running finish.
+    await asyncio.sleep(args.drain)
+    elapsed = time.monotonic() - run_started
+    lag_task.cancel()
+
+    gc.collect()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    minutes = elapsed / 60
+    return {
+        'accounts': len(bot_module.agents),
+        'chats': len(chat_ids),
+        'startup_seconds': round(startup_seconds, 3),
+        'elapsed_seconds': round(elapsed, 1),
+        'time_scale': args.time_scale,
+        'throughput_per_min': {
+            'delivered': round(network.stats['delivered'] / minutes, 1),
+            'handler_calls': round(network.stats['handler_calls'] / minutes, 1),
+            'sends': round(network.stats['sends'] / minutes, 1),
+            'llm_generations': round(llm.generated / minutes, 1),
+        },
+        'totals': dict(network.stats, llm_calls=llm.calls, llm_generations=llm.generated),
+        'reply_latency_s': percentiles(network.reply_latencies),
+        'callback_latency_s': percentiles(callback_latencies),
+        'loop_lag_s': dict(percentiles(lag_samples), max=round(max(lag_samples), 4) if lag_samples else None),
+        'memory': {
+            'traced_current_mb': round(current / 2**20, 1),
+            'traced_peak_mb': round(peak / 2**20, 1),
+            'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+            'live_tasks': len(asyncio.all_tasks()),
+        },
+        'event_queues': {
+            'dropped': sum(agent.events.stats['dropped'] for agent in bot_module.agents.values()),
+            'max_depth': max((agent.events.stats['max_depth'] for agent in bot_module.agents.values()), default=0),
+        },
+        'catch_up': dict(bot_module.catch_up.report(), misread_own_messages=misread_own_messages(bot_module, network)),
+        'shadow': bot_module.shadow_stats.report() if bot_module.SHADOW_MODE else None,
+        'llm_scheduler': bot_module.llm_scheduler.report(),
+        'llm_dispatcher': bot_module.llm_dispatcher.report(),
+    }
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run bot.py against fake Telegram clients and report capacity metrics.")
+    parser.add_argument('--accounts', type=int, default=50, help="linked accounts to simulate")
+    parser.add_argument('--accounts-per-owner', type=int, default=2)
+    parser.add_argument('--groups-per-account', type=int, default=2)
+    parser.add_argument('--chats', type=int, default=20, help="distinct chat groups")
+    parser.add_argument('--humans', type=int, default=500, help="synthetic human chat members")
+    parser.add_argument('--member-fraction', type=float, default=0.5, help="share of owners in GROUP_ID (higher limits)")
+    parser.add_argument('--msgs-per-min', type=float, default=600)
+    parser.add_argument('--duration', type=float, default=30, help="seconds of traffic")
+    parser.add_argument('--drain', type=float, default=5, help="seconds to wait for pending replies after traffic stops")
+    parser.add_argument('--time-scale', type=float, default=0.001, help="multiplier applied to the bot's sleeps")
+    parser.add_argument('--rpc-latency-ms', type=float, default=20)
+    parser.add_argument('--send-latency-ms', type=float, default=50)
+    parser.add_argument('--llm-latency-ms', type=float, default=300)
+    parser.add_argument('--flood-rate', type=float, default=0.01, help="probability a send raises FloodWait")
+    parser.add_argument('--flood-seconds', type=int, default=30)
+    parser.add_argument('--callbacks-per-min', type=float, default=30)
+    parser.add_argument('--personality-repeat', type=int, default=20, help="personality length multiplier")
+    parser.add_argument('--plain-weight', type=float, default=0.6)
+    parser.add_argument('--reply-weight', type=float, default=0.25)
+    parser.add_argument('--link-weight', type=float, default=0.05)
+    parser.add_argument('--bot-weight', type=float, default=0.05)
+    parser.add_argument('--burst-weight', type=float, default=0.05)
+    parser.add_argument('--offline-replies', type=int, default=1,
+                        help="replies per chat each account missed before startup, for catch-up (0 skips)")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--log-level', default='WARNING', help="log level for the bot while simulating")
+    parser.add_argument('--keep', action='store_true',
+                        help="keep the temporary working directory (stores, traces, action log) and report its path")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.seed is not None:
+        random.seed(args.seed)
+    repo_dir = os.path.dirname(os.path.abspath(__file__))
+    sys.path.insert(0, repo_dir)
+    cwd = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="bot-sim-")
+    try:
+        prepare_environment(workdir)
+
+        import bot as bot_module
+        from storage import store_executor
+        logging.getLogger().setLevel(args.log_level.upper())
+
+        report = asyncio.run(run_simulation(bot_module, args))
+        # Let queued store writes finish, then write what is still buffered, before leaving the directory.
+        store_executor.shutdown(wait=True)
+        bot_module.flush_stores()
+        bot_module.tracer.flush()
+        bot_module.action_log.flush()
+        bot_module.session_db.close()
+    finally:
+        os.chdir(cwd)
+        if not args.keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if args.keep:
+        report['workdir'] = workdir
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
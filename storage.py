@@ -0,0 +1,363 @@
+import asyncio
+import contextlib
+import copy
+import json
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+# Disk I/O, JSON encoding, deep copies and Fernet work for every store run here, off the event loop.
+store_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="store")
+
+
+class JsonStore:
+    """
+    Write-behind store for a JSON document keyed by top-level record (e.g. owner user_id).
+
+    Changes are applied to the in-memory state immediately and appended to a
+    journal file (<path>.journal). Snapshots of the whole document are written
+    on a debounce interval via temp file + fsync + atomic rename, after which
+    the journal is compacted (truncated), since the snapshot already holds
+    everything it recorded.
+
+    The synchronous methods are safe to call from any thread. Coroutines
+    should use the async ones, which run the work in `store_executor`:
+    `aread()` returns a shared read-only snapshot (concurrent readers share
+    one in-flight copy), `aload()` a private copy to modify, and
+    `transaction()` serializes read-modify-write cycles per file.
+    """
+
+    def __init__(self, path, encode_record=None, decode_record=None, flush_delay=2.0, indent=4):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.encode_record = encode_record or (lambda key, value: value)
+        self.decode_record = decode_record or (lambda key, value: value)
+        self.flush_delay = flush_delay
+        self.indent = indent
+        self._lock = threading.RLock()
+        self._data = {}
+        self._version = 0
+        self._flushed_version = 0
+        self._loop = None
+        self._flush_handle = None
+        self._write_lock = None
+        self._snapshot = None        # (version, read-only copy) shared by aread() callers
+        self._snapshot_future = None  # (version, future) of a copy being built
+        self._snapshot_signature = None
+        self.stats = {
+            'saves': 0,
+            'records_written': 0,
+            'logical_bytes': 0,
+            'journal_bytes': 0,
+            'snapshot_bytes': 0,
+            'snapshots': 0,
+            'compactions': 0,
+            'shared_reads': 0,
+        }
+        self._load()
+
+    def _file_signature(self):
+        try:
+            st = os.stat(self.path)
+            return (st.st_mtime_ns, st.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _load(self):
+        data = {}
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                raw = json.load(f)
+            data = {key: self.decode_record(key, value) for key, value in raw.items()}
+        signature = self._file_signature()
+
+        replayed = 0
+        if os.path.exists(self.journal_path):
+            good_offset = 0
+            torn = False
+            with open(self.journal_path, "rb") as f:
+                for line in f:
+                    try:
+                        if not line.endswith(b'\n'):
+                            raise ValueError("unterminated entry")
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A torn final line from a crash mid-append; everything before it is intact.
+                        log.warning("Ignoring truncated journal entry", path=self.journal_path)
+                        torn = True
+                        break
+                    if entry.get('op') == 'set':
+                        data[entry['key']] = self.decode_record(entry['key'], entry['value'])
+                    elif entry.get('op') == 'del':
+                        data.pop(entry['key'], None)
+                    replayed += 1
+                    good_offset += len(line)
+            if torn:
+                # Cut the torn tail so later appends start on a clean line.
+                with open(self.journal_path, "r+b") as f:
+                    f.truncate(good_offset)
+
+        with self._lock:
+            self._data = data
+            self._snapshot_signature = signature
+            self._version += 1
+            if replayed:
+                log.info("Replayed journal entries", path=self.path, entries=replayed)
+            else:
+                self._flushed_version = self._version
+
+    # Synchronous API
+
+    def load(self):
+        """Return a deep copy of the current document."""
+        with self._lock:
+            return copy.deepcopy(self._data)
+
+    def get(self, key, default=None):
+        """Return a deep copy of a single record."""
+        with self._lock:
+            if key not in self._data:
+                return default
+            return copy.deepcopy(self._data[key])
+
+    def save(self, data):
+        """Apply a new version of the document: journal changed records and schedule a snapshot."""
+        with self._lock:
+            self.stats['saves'] += 1
+            entries = []
+            for key, value in data.items():
+                if key not in self._data or self._data[key] != value:
+                    entries.append({'op': 'set', 'key': key, 'value': self.encode_record(key, copy.deepcopy(value))})
+            for key in self._data.keys() - data.keys():
+                entries.append({'op': 'del', 'key': key})
+            if not entries:
+                return
+            self._data = copy.deepcopy(data)
+            self._changed(entries)
+
+    def put(self, key, value):
+        """Set a single record without diffing the whole document."""
+        with self._lock:
+            self.stats['saves'] += 1
+            if key in self._data and self._data[key] == value:
+                return
+            self._data[key] = copy.deepcopy(value)
+            self._changed([{'op': 'set', 'key': key, 'value': self.encode_record(key, copy.deepcopy(value))}])
+
+    def put_many(self, records):
+        """Set several records ({key: value}) with one journal write."""
+        with self._lock:
+            self.stats['saves'] += 1
+            entries = []
+            for key, value in records.items():
+                if key in self._data and self._data[key] == value:
+                    continue
+                self._data[key] = copy.deepcopy(value)
+                entries.append({'op': 'set', 'key': key, 'value': self.encode_record(key, copy.deepcopy(value))})
+            if entries:
+                self._changed(entries)
+
+    def delete(self, key):
+        """Remove a single record."""
+        with self._lock:
+            self.stats['saves'] += 1
+            if key not in self._data:
+                return
+            del self._data[key]
+            self._changed([{'op': 'del', 'key': key}])
+
+    def _changed(self, entries):
+        self._append_journal(entries)
+        self._version += 1
+        self._schedule_flush()
+
+    def _append_journal(self, entries):
+        payload = ''.join(json.dumps(entry, separators=(',', ':')) + '\n' for entry in entries)
+        encoded = payload.encode('utf-8')
+        with open(self.journal_path, "ab") as f:
+            f.write(encoded)
+            f.flush()
+            os.fsync(f.fileno())
+        self.stats['records_written'] += len(entries)
+        self.stats['logical_bytes'] += len(encoded)
+        self.stats['journal_bytes'] += len(encoded)
+
+    def _schedule_flush(self):
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            try:
+                loop = asyncio.get_running_loop()
+            except RuntimeError:
+                self.flush()
+                return
+            self._loop = loop
+        loop.call_soon_threadsafe(self._arm_flush)
+
+    def _arm_flush(self):
+        if self._flush_handle is not None:
+            # A snapshot is already pending; this change will be coalesced into it.
+            return
+        self._flush_handle = self._loop.call_later(self.flush_delay, self._flush_in_executor)
+
+    def _flush_in_executor(self):
+        self._flush_handle = None
+        self._loop.run_in_executor(store_executor, self.flush)
+
+    def flush(self):
+        """Write a snapshot atomically and compact the journal."""
+        with self._lock:
+            version = self._version
+            if version == self._flushed_version:
+                return
+            raw = {key: self.encode_record(key, copy.deepcopy(value)) for key, value in self._data.items()}
+
+        encoded = json.dumps(raw, indent=self.indent).encode('utf-8')
+        tmp_path = self.path + ".tmp"
+        with self._lock:
+            if self._flushed_version >= version:
+                return
+            try:
+                with open(tmp_path, "wb") as f:
+                    f.write(encoded)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+                self._fsync_dir()
+            except Exception as e:
+                log.error("Failed to write snapshot", path=self.path, error=e)
+                return
+
+            self._snapshot_signature = self._file_signature()
+            self._flushed_version = version
+            self.stats['snapshots'] += 1
+            self.stats['snapshot_bytes'] += len(encoded)
+            if self._version == version:
+                self._compact()
+            else:
+                # Changes landed while encoding; keep their journal entries and snapshot again later.
+                self._schedule_flush()
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Snapshot written", path=self.path, **self.report())
+
+    def _compact(self):
+        # The snapshot is durable at this point, so every journaled change is already in it.
+        if os.path.exists(self.journal_path) and os.path.getsize(self.journal_path) > 0:
+            with open(self.journal_path, "wb") as f:
+                f.flush()
+                os.fsync(f.fileno())
+            self.stats['compactions'] += 1
+
+    def _fsync_dir(self):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def reload_if_changed(self):
+        """Reload the document if the snapshot file was edited outside this process."""
+        with self._lock:
+            if self._version != self._flushed_version or self._file_signature() == self._snapshot_signature:
+                return False
+            log.info("File changed on disk; reloading", path=self.path)
+            self._load()
+            return True
+
+    # Async API
+
+    def _bind_loop(self):
+        if self._loop is None or self._loop.is_closed():
+            self._loop = asyncio.get_running_loop()
+        if self._write_lock is None:
+            self._write_lock = asyncio.Lock()
+
+    async def _run(self, func, *args):
+        self._bind_loop()
+        return await self._loop.run_in_executor(store_executor, func, *args)
+
+    def _versioned_copy(self):
+        with self._lock:
+            return self._version, copy.deepcopy(self._data)
+
+    async def aread(self):
+        """
+        Return a read-only snapshot of the document. Callers must not modify it.
+        Concurrent readers share one in-flight copy, and the copy is reused until the next write.
+        """
+        self._bind_loop()
+        version = self._version
+        if self._snapshot is not None and self._snapshot[0] == version:
+            self.stats['shared_reads'] += 1
+            return self._snapshot[1]
+        if self._snapshot_future is not None and self._snapshot_future[0] == version:
+            self.stats['shared_reads'] += 1
+            return await asyncio.shield(self._snapshot_future[1])
+
+        future = self._loop.create_future()
+        self._snapshot_future = (version, future)
+        try:
+            snapshot_version, data = await self._run(self._versioned_copy)
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # mark retrieved in case no other reader is waiting
+            raise
+        finally:
+            if self._snapshot_future is not None and self._snapshot_future[1] is future:
+                self._snapshot_future = None
+        self._snapshot = (snapshot_version, data)
+        future.set_result(data)
+        return data
+
+    async def aload(self):
+        """Return a private deep copy of the document, built off the event loop."""
+        return await self._run(self.load)
+
+    async def aput(self, key, value):
+        self._bind_loop()
+        async with self._write_lock:
+            await self._run(self.put, key, value)
+
+    async def aput_many(self, records):
+        self._bind_loop()
+        async with self._write_lock:
+            await self._run(self.put_many, records)
+
+    async def adelete(self, key):
+        self._bind_loop()
+        async with self._write_lock:
+            await self._run(self.delete, key)
+
+    @contextlib.asynccontextmanager
+    async def transaction(self):
+        """
+        Serialized read-modify-write: yields a private copy and saves it on exit
+        (not if the block raises). Keep network calls out of the block.
+        """
+        self._bind_loop()
+        async with self._write_lock:
+            data = await self._run(self.load)
+            yield data
+            await self._run(self.save, data)
+
+    async def areload_if_changed(self):
+        return await self._run(self.reload_if_changed)
+
+    def write_amplification(self):
+        """Bytes physically written (journal + snapshots) per byte of logical change."""
+        if not self.stats['logical_bytes']:
+            return 0.0
+        return (self.stats['journal_bytes'] + self.stats['snapshot_bytes']) / self.stats['logical_bytes']
+
+    def report(self):
+        return dict(self.stats, write_amplification=round(self.write_amplification(), 2))
@@ -0,0 +1,170 @@
+import asyncio
+import random
+import time
+
+from telethon import functions
+
+from logs import get_logger
+
+log = get_logger(__name__)
+
+
+class ClientHealth:
+    """Connection bookkeeping for one supervised client."""
+
+    def __init__(self):
+        now = time.monotonic()
+        self.state = 'connected'
+        self.connected_since = now
+        self.last_ping = now
+        self.last_ping_ms = None
+        self.reconnects = 0
+        self.failed_attempts = 0
+        self.ping_failures = 0
+        self.reconnecting = None  # task while a reconnect is in progress
+
+
+class ClientSupervisor:
+    """
+    Watches linked clients and brings dead ones back.
+
+    `agents` is the registry of running linked accounts ({client_key: AgentState}).
+    Every `check_interval` seconds each client is checked: if its
+    `run_until_disconnected` task has ended or it reports disconnected, or a
+    lightweight ping (sent every `ping_interval` seconds) fails, it is
+    reconnected. Reconnects back off exponentially with jitter per client and
+    at most `max_concurrent_reconnects` run at once, so a network blip doesn't
+    turn into a thundering herd of simultaneous reconnects. `on_reconnect(agent)`
+    is called after each successful reconnect.
+    """
+
+    def __init__(self, agents, check_interval=15, ping_interval=120, ping_timeout=10,
+                 base_backoff=2.0, max_backoff=300.0, max_concurrent_reconnects=4, on_reconnect=None):
+        self.agents = agents
+        self.on_reconnect = on_reconnect
+        self.check_interval = check_interval
+        self.ping_interval = ping_interval
+        self.ping_timeout = ping_timeout
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.reconnect_slots = asyncio.Semaphore(max_concurrent_reconnects)
+        self.health = {}
+
+    def track(self, client_key):
+        """Start (or restart) uptime accounting for a client that just connected."""
+        previous = self.health.get(client_key)
+        if previous is not None and previous.reconnecting:
+            # A reconnect still running for the account's old client must not touch the new one.
+            previous.reconnecting.cancel()
+        self.health[client_key] = ClientHealth()
+
+    async def run(self):
+        while True:
+            try:
+                await self.check_all()
+            except Exception as e:
+                log.error("Error in client supervisor", error=e)
+            await asyncio.sleep(self.check_interval)
+
+    async def check_all(self):
+        for client_key in list(self.health):
+            if client_key not in self.agents:
+                reconnecting = self.health.pop(client_key).reconnecting
+                if reconnecting:
+                    reconnecting.cancel()
+
+        pings = []
+        now = time.monotonic()
+        for client_key, agent in list(self.agents.items()):
+            client = agent.client
+            health = self.health.get(client_key)
+            if health is None:
+                health = self.health[client_key] = ClientHealth()
+            if health.reconnecting or health.state == 'unauthorized':
+                continue
+
+            task = agent.task
+            if task is None or task.done() or not client.is_connected():
+                if task is not None and task.done() and not task.cancelled() and task.exception():
+                    log.warning("Client stopped with error", client_key=client_key, error=task.exception())
+                self._schedule_reconnect(client_key, "update loop ended or disconnected")
+            elif now - health.last_ping >= self.ping_interval:
+                pings.append(self._ping(client_key, client, health))
+
+        if pings:
+            await asyncio.gather(*pings)
+
+    async def _ping(self, client_key, client, health):
+        started = time.monotonic()
+        try:
+            await asyncio.wait_for(client(functions.PingRequest(ping_id=random.getrandbits(63))), self.ping_timeout)
+        except Exception as e:
+            health.ping_failures += 1
+            self._schedule_reconnect(client_key, f"ping failed: {e!r}")
+            return
+        health.last_ping = time.monotonic()
+        health.last_ping_ms = round((health.last_ping - started) * 1000)
+
+    def _schedule_reconnect(self, client_key, reason):
+        health = self.health[client_key]
+        if health.reconnecting:
+            return
+        log.warning("Reconnecting client", client_key=client_key, reason=reason)
+        health.state = 'reconnecting'
+        health.reconnecting = asyncio.create_task(self._reconnect(client_key, health))
+
+    def _backoff(self, attempt):
+        ceiling = min(self.max_backoff, self.base_backoff * (2 ** attempt))
+        return random.uniform(ceiling / 2, ceiling)
+
+    async def _reconnect(self, client_key, health):
+        attempt = 0
+        agent = self.agents.get(client_key)
+        try:
+            while agent is not None and self.agents.get(client_key) is agent:
+                client = agent.client
+                async with self.reconnect_slots:
+                    try:
+                        if client.is_connected():
+                            await client.disconnect()
+                        await client.connect()
+                        if not await client.is_user_authorized():
+                            log.error("Client is no longer authorized; not reconnecting", client_key=client_key)
+                            health.state = 'unauthorized'
+                            return
+                    except Exception as e:
+                        health.failed_attempts += 1
+                        log.warning("Reconnect attempt failed", client_key=client_key, attempt=attempt + 1, error=e)
+                    else:
+                        if self.agents.get(client_key) is not agent:
+                            # Stopped or replaced while connecting.
+                            await client.disconnect()
+                            return
+                        if agent.task is not None and not agent.task.done():
+                            agent.task.cancel()
+                        agent.task = asyncio.create_task(client.run_until_disconnected())
+                        health.state = 'connected'
+                        health.connected_since = health.last_ping = time.monotonic()
+                        health.reconnects += 1
+                        log.info("Client reconnected", client_key=client_key, attempts=attempt + 1)
+                        if self.on_reconnect is not None:
+                            self.on_reconnect(agent)
+                        return
+                await asyncio.sleep(self._backoff(attempt))
+                attempt += 1
+        finally:
+            health.reconnecting = None
+
+    def report(self):
+        now = time.monotonic()
+        return {
+            f"{user_id}:{telegram_id}": {
+                'state': health.state,
+                'uptime_s': round(now - health.connected_since) if health.state == 'connected' else 0,
+                'reconnects': health.reconnects,
+                'failed_attempts': health.failed_attempts,
+                'ping_failures': health.ping_failures,
+                'last_ping_ms': health.last_ping_ms,
+            }
+            for (user_id, telegram_id), health in self.health.items()
+        }
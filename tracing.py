@@ -0,0 +1,295 @@
+import argparse
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+
+from logs import get_logger
+from storage import store_executor
+
+log = get_logger(__name__)
+
+# Spans that are waits on purpose; they don't count towards a trace being slow.
+INTENTIONAL_SPANS = {'delay'}
+
+
+class Span:
+    """Times one stage of a trace. Usable as `with trace.span(...)`, also around awaits."""
+
+    __slots__ = ('trace', 'name', 'attrs', 'start')
+
+    def __init__(self, trace, name, attrs):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.monotonic()
+        record = {
+            'name': self.name,
+            'start_ms': round((self.start - self.trace.started) * 1000, 1),
+            'duration_ms': round((end - self.start) * 1000, 1),
+        }
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            record['error'] = f"{exc_type.__name__}: {exc}"
+        record.update(self.attrs)
+        self.trace.spans.append(record)
+        return False
+
+
+class Trace:
+    """One incoming message (or autopost attempt) from receipt to send, or to the reason it was dropped."""
+
+    def __init__(self, tracer, kind, attrs):
+        self.tracer = tracer
+        self.kind = kind
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.attrs = attrs
+        self.spans = []
+        self.started = time.monotonic()
+        self.wall_started = time.time()
+        self.outcome = None
+        self.drop_reason = None
+        self.ended = False
+
+    def span(self, name, **attrs):
+        return Span(self, name, attrs)
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def drop(self, reason):
+        self.outcome = 'dropped'
+        self.drop_reason = reason
+
+    def sent(self):
+        self.outcome = 'sent'
+
+    def shadow(self):
+        """Everything up to the send ran, but shadow mode logged the message instead of sending it."""
+        self.outcome = 'shadow'
+
+    def fail(self, error):
+        self.outcome = 'error'
+        self.drop_reason = str(error)
+
+    def end(self):
+        if self.ended:
+            return
+        self.ended = True
+        record = {
+            'trace_id': self.trace_id,
+            'kind': self.kind,
+            'ts': round(self.wall_started, 3),
+            'duration_ms': round((time.monotonic() - self.started) * 1000, 1),
+            'outcome': self.outcome or 'dropped',
+            'drop_reason': None if self.outcome in ('sent', 'shadow') else (self.drop_reason or 'unfinished'),
+            'spans': self.spans,
+        }
+        record.update(self.attrs)
+        self.tracer.record(record)
+
+
+class JsonLinesLog:
+    """
+    Append-only JSON lines file at `path`, rotated at `max_bytes` with
+    `backups` old files kept (path.1 is the newest). Records are buffered and
+    written in batches from the store thread pool, so logging never blocks
+    the event loop on disk I/O. With no path, records are discarded.
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=3, flush_interval=1.0):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._flush_handle = None
+        self._file_lock = threading.Lock()
+        self.stats = {'records': 0, 'written': 0, 'write_errors': 0}
+
+    def record(self, record):
+        self.stats['records'] += 1
+        if not self.path:
+            return
+        self._buffer.append(json.dumps(record, separators=(',', ':'), default=str))
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.flush()
+            return
+        if self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.flush_interval, self._flush_in_executor, loop)
+
+    def _flush_in_executor(self, loop):
+        self._flush_handle = None
+        lines, self._buffer = self._buffer, []
+        loop.run_in_executor(store_executor, self._write, lines)
+
+    def flush(self):
+        """Write buffered traces now (at shutdown, or before reading the files)."""
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        lines, self._buffer = self._buffer, []
+        self._write(lines)
+
+    def _write(self, lines):
+        if not lines:
+            return
+        payload = ''.join(line + '\n' for line in lines).encode('utf-8')
+        with self._file_lock:
+            try:
+                if os.path.exists(self.path) and os.path.getsize(self.path) + len(payload) > self.max_bytes:
+                    self._rotate()
+                with open(self.path, "ab") as f:
+                    f.write(payload)
+                self.stats['written'] += len(lines)
+            except OSError as e:
+                self.stats['write_errors'] += 1
+                log.error("Failed to write log records", path=self.path, error=e)
+
+    def _rotate(self):
+        for index in range(self.backups - 1, 0, -1):
+            older = f"{self.path}.{index}"
+            if os.path.exists(older):
+                os.replace(older, f"{self.path}.{index + 1}")
+        if self.backups:
+            os.replace(self.path, f"{self.path}.1")
+        else:
+            os.remove(self.path)
+
+    def files(self):
+        """Log files, oldest first."""
+        backups = [f"{self.path}.{index}" for index in range(self.backups, 0, -1)]
+        return [path for path in backups + [self.path] if os.path.exists(path)]
+
+
+class Tracer(JsonLinesLog):
+    """
+    Writes finished traces to a JsonLinesLog. Every finished trace is also
+    passed to each function in `listeners` (e.g. the action log).
+    """
+
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backups=3, flush_interval=1.0):
+        super().__init__(path, max_bytes, backups, flush_interval)
+        self.listeners = []
+
+    def start(self, kind, **attrs):
+        return Trace(self, kind, attrs)
+
+    def record(self, record):
+        for listener in self.listeners:
+            try:
+                listener(record)
+            except Exception as e:
+                log.error("Trace listener failed", listener=getattr(listener, '__qualname__', listener), error=e)
+        super().record(record)
+
+
+def read_traces(paths):
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+
+
+def busy_ms(trace):
+    """Trace duration minus the intentional waits (the random reply delay)."""
+    waited = sum(span['duration_ms'] for span in trace.get('spans', []) if span['name'] in INTENTIONAL_SPANS)
+    return trace['duration_ms'] - waited
+
+
+def _percentile(values, pct):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def summarize(traces, slow_ms=30000, kind=None, limit=5):
+    """
+    Summarize traces: outcomes and drop reasons per kind, how reply drafts
+    were used, per-stage latency, and the slowest traces over `slow_ms` (not
+    counting the intentional delay).
+    """
+    outcomes = Counter()
+    drop_reasons = Counter()
+    drafts = Counter()
+    stage_durations = {}
+    slow = []
+    total = 0
+    for trace in traces:
+        if kind and trace.get('kind') != kind:
+            continue
+        total += 1
+        outcomes[f"{trace['kind']}:{trace['outcome']}"] += 1
+        if trace['outcome'] not in ('sent', 'shadow') and trace.get('drop_reason'):
+            drop_reasons[f"{trace['kind']}:{trace['drop_reason']}"] += 1
+        if trace.get('draft'):
+            drafts[trace['draft']] += 1
+        for span in trace.get('spans', []):
+            stage_durations.setdefault(span['name'], []).append(span['duration_ms'])
+        busy = busy_ms(trace)
+        if busy >= slow_ms:
+            slow.append((busy, trace))
+
+    slow.sort(key=lambda item: item[0], reverse=True)
+    return {
+        'traces': total,
+        'outcomes': dict(outcomes.most_common()),
+        'drop_reasons': dict(drop_reasons.most_common(10)),
+        'drafts': dict(drafts.most_common()),
+        'stages_ms': {
+            name: {'count': len(values), 'p50': _percentile(values, 50), 'p95': _percentile(values, 95), 'max': max(values)}
+            for name, values in sorted(stage_durations.items())
+        },
+        'slow': [
+            {
+                'trace_id': trace['trace_id'],
+                'kind': trace['kind'],
+                'busy_ms': busy,
+                'outcome': trace['outcome'],
+                'drop_reason': trace.get('drop_reason'),
+                'chat_id': trace.get('chat_id'),
+                'stages': {span['name']: span['duration_ms'] for span in trace.get('spans', [])},
+            }
+            for busy, trace in slow[:limit]
+        ],
+        'slow_count': len(slow),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Summarize slow or dropped message traces.")
+    parser.add_argument('--file', default=os.environ.get('TRACE_FILE', 'traces.jsonl'),
+                        help="trace file; its rotated backups (.1, .2, ...) are read too")
+    parser.add_argument('--slow', type=float, default=30.0, help="seconds, not counting the reply delay")
+    parser.add_argument('--kind', choices=['reply', 'autopost'], help="only this kind of trace")
+    parser.add_argument('--limit', type=int, default=10, help="slow traces to list")
+    parser.add_argument('--trace', help="print one trace by ID")
+    args = parser.parse_args()
+
+    paths = Tracer(args.file, backups=100).files()
+    if args.trace:
+        for trace in read_traces(paths):
+            if trace['trace_id'] == args.trace:
+                print(json.dumps(trace, indent=2))
+                return
+        raise SystemExit(f"Trace {args.trace} not found")
+    print(json.dumps(summarize(read_traces(paths), args.slow * 1000, args.kind, args.limit), indent=2))
+
+
+if __name__ == '__main__':
+    main()